@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+"""
+Offline batch rendering of try-on previews.
+
+Renders every image of an input directory (or of a manifest listing image paths, one per line) with each
+of a list of looks and writes the results to an output directory, as `<output>/<image path>/<look>.<ext>`.
+Images are spread over a process pool sized to the CPU count; each worker reads, decodes, detects, renders
+and encodes one image at a time and only a bounded number of images is in flight, so memory stays flat
+however large the input is. Outputs that already exist are skipped, so an interrupted run can simply be
+started again; images without a face leave a `.no_face` marker in their output directory and are skipped
+as well (pass --overwrite, or delete the marker, to search them again). A throughput summary is printed at
+the end.
+
+    python batch.py photos/ previews/ --looks looks.json
+    python batch.py manifest.txt previews/ --looks '{"red": {}, "wine": {"lipstick_color": "Wine"}}' --workers 8
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, List, Optional
+
+from buffers import buffer_pool
+from encoding import OUTPUT_FORMATS
+from landmarks import detect_faces, warmup
+from render import MakeupConfig, OutputOptions, RenderContext, compile_look, render_makeup
+from metrics import Timings
+from uploads import decode_image
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff"}
+# Left in an image's output directory when no face was found, so resumed runs skip the image
+NO_FACE_MARKER = ".no_face"
+
+
+def parse_looks(text: str) -> Dict[str, MakeupConfig]:
+    """
+    Looks from a JSON file or inline JSON: a {name: config} object or a list of configs,
+    which are named look-000, look-001, ...
+    """
+    if os.path.exists(text):
+        with open(text) as f:
+            text = f.read()
+    looks = json.loads(text)
+    if isinstance(looks, list):
+        looks = {f"look-{i:03d}": look for i, look in enumerate(looks)}
+    if not isinstance(looks, dict) or not looks:
+        raise ValueError("Looks must be a non-empty JSON object or list of makeup configurations")
+    for name in looks:
+        if not name or os.sep in name or name.startswith("."):
+            raise ValueError(f"Invalid look name: {name!r}")
+    return {name: MakeupConfig(**config) for name, config in looks.items()}
+
+
+def collect_inputs(source: str, recursive: bool = True) -> List[tuple]:
+    """
+    (image path, path relative to the input root) pairs, sorted, from a directory or a manifest file.
+    Manifest lines are image paths relative to the manifest; blank lines and # comments are ignored.
+    """
+    if os.path.isdir(source):
+        inputs = []
+        for root, dirs, files in os.walk(source):
+            if not recursive:
+                dirs.clear()
+            dirs.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                    path = os.path.join(root, name)
+                    inputs.append((path, os.path.relpath(path, source)))
+        return inputs
+
+    base = os.path.dirname(os.path.abspath(source))
+    inputs = []
+    with open(source) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            path = line if os.path.isabs(line) else os.path.join(base, line)
+            relative = os.path.relpath(path, base)
+            # Files outside the manifest's directory keep only their name
+            inputs.append((path, os.path.basename(path) if relative.startswith("..") else relative))
+    return inputs
+
+
+def output_paths(relative: str, looks, output_dir: str, output_format: str) -> Dict[str, str]:
+    """Where each look of an image is written: one directory per image, one file per look"""
+    extension = OUTPUT_FORMATS[output_format][0]
+    directory = os.path.join(output_dir, relative)
+    return {name: os.path.join(directory, f"{name}{extension}") for name in looks}
+
+
+def no_face_marker(relative: str, output_dir: str) -> str:
+    """The marker left in an image's output directory when no face was found in it"""
+    return os.path.join(output_dir, relative, NO_FACE_MARKER)
+
+
+def found_no_face(marker: str, output_options: OutputOptions) -> bool:
+    """Whether an earlier run found no face in the image at the same decode size"""
+    try:
+        with open(marker) as f:
+            return json.load(f).get("max_side") == output_options.max_side
+    except (OSError, ValueError, AttributeError):
+        return False
+
+
+def init_worker(max_faces: int):
+    """Each worker process owns one warmed-up FaceMesh"""
+    # The per-render log lines of the server would drown the progress output
+    logging.getLogger("render").setLevel(logging.WARNING)
+    warmup(count=1, max_num_faces=max_faces)
+
+
+def render_file(path: str, outputs: Dict[str, str], looks: Dict[str, MakeupConfig], output_options: OutputOptions,
+                max_faces: int = 1, marker: Optional[str] = None) -> dict:
+    """
+    Renders the looks of one image and writes them to `outputs` ({look name: path}); without a face,
+    writes the `marker` file instead, if given.
+    Runs in a worker process and never raises: the result says what happened,
+    {"path", "state" (done / no_face / failed), "written", "faces", "error", "stages"}.
+    """
+    timings = Timings()
+    result = {"path": path, "state": "done", "written": 0, "faces": 0, "error": None}
+    try:
+        with timings.stage("read"):
+            with open(path, "rb") as f:
+                data = f.read()
+        with timings.stage("decode"):
+            img = decode_image(data, output_options.max_side)
+        del data
+        with timings.stage("landmarks"):
+            faces = detect_faces(img, max_faces)
+        result["faces"] = len(faces)
+        if not faces:
+            result["state"] = "no_face"
+            if marker is not None:
+                # The decode size is recorded, a run at another size may find the face
+                write_atomic(marker, json.dumps({"max_side": output_options.max_side}).encode())
+            return result
+
+        with timings.stage("geometry"):
+            context = RenderContext(img, faces)
+        # As in `process_batch`: shared geometry, one output buffer, cached foundation for repeated presets
+        presets = [compile_look(config).foundation_preset for config in looks.values()]
+        try:
+            with buffer_pool.borrow(img.shape) as out:
+                for (name, config), preset in zip(looks.items(), presets):
+                    reuse = preset is not None and presets.count(preset) > 1
+                    render_makeup(img, config, faces, context, reuse_foundation=reuse, timings=timings, out=out)
+                    with timings.stage("encode"):
+                        encoded = output_options.encode(out)
+                    with timings.stage("write"):
+                        write_atomic(outputs[name], encoded)
+                    result["written"] += 1
+        finally:
+            context.close()
+        if marker is not None and os.path.exists(marker):
+            os.remove(marker)
+    except Exception as e:
+        result["state"] = "failed"
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        result["stages"] = timings.stages
+    return result
+
+
+def write_atomic(path: str, data: bytes):
+    """Writes through a temporary file, so an interrupted run never leaves a truncated output behind"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+def summarize(results: List[dict], skipped: int, elapsed: float, workers: int, skipped_no_face: int = 0) -> dict:
+    """Counts, throughput and mean per-stage milliseconds of a run"""
+    states = {"done": 0, "no_face": 0, "failed": 0}
+    stages = Timings()
+    for result in results:
+        states[result["state"]] += 1
+        for stage, seconds in result["stages"].items():
+            stages.add(stage, seconds)
+    written = sum(result["written"] for result in results)
+    processed = len(results)
+    return {
+        "images": processed + skipped,
+        "processed": processed,
+        "skipped": skipped,
+        "skipped_no_face": skipped_no_face,
+        **states,
+        "renders_written": written,
+        "workers": workers,
+        "elapsed_s": round(elapsed, 3),
+        "images_per_s": round(processed / elapsed, 2) if elapsed > 0 else None,
+        "renders_per_s": round(written / elapsed, 2) if elapsed > 0 else None,
+        # Mean time per processed image, summed over all workers
+        "stage_ms": {stage: round(seconds / processed * 1000, 2) for stage, seconds in stages.stages.items()}
+        if processed else {},
+        "failures": [{"path": result["path"], "error": result["error"]} for result in results
+                     if result["state"] == "failed"],
+    }
+
+
+def run(inputs, looks, output_dir: str, output_options: OutputOptions, workers: int, max_in_flight: int,
+        max_faces: int = 1, overwrite: bool = False, progress_interval: float = 5.0) -> dict:
+    """
+    Renders every input on a process pool with at most `max_in_flight` images submitted at once.
+    Images whose outputs all exist, or where an earlier run found no face, are skipped unless `overwrite`;
+    otherwise only the missing looks are rendered.
+    """
+    start = time.perf_counter()
+    results, skipped, skipped_no_face = [], 0, 0
+
+    def pending_jobs():
+        nonlocal skipped, skipped_no_face
+        for path, relative in inputs:
+            outputs = output_paths(relative, looks, output_dir, output_options.output_format)
+            marker = no_face_marker(relative, output_dir)
+            if not overwrite and found_no_face(marker, output_options):
+                skipped_no_face += 1
+                continue
+            missing = {name: config for name, config in looks.items()
+                       if overwrite or not os.path.exists(outputs[name])}
+            if not missing:
+                skipped += 1
+                continue
+            yield path, outputs, missing, marker
+
+    jobs = pending_jobs()
+    next_progress = start + progress_interval
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_worker, initargs=(max_faces,)) as pool:
+        in_flight = set()
+        while True:
+            for path, outputs, missing, marker in jobs:
+                in_flight.add(pool.submit(render_file, path, outputs, missing, output_options, max_faces, marker))
+                if len(in_flight) >= max_in_flight:
+                    break
+            if not in_flight:
+                break
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                results.append(result)
+                if result["state"] == "failed":
+                    print(f"Failed: {result['path']}: {result['error']}", file=sys.stderr)
+            if time.perf_counter() >= next_progress:
+                elapsed = time.perf_counter() - start
+                print(f"{len(results)} rendered, {skipped + skipped_no_face} skipped, "
+                      f"{len(results) / elapsed:.1f} images/s")
+                next_progress += progress_interval
+
+    return summarize(results, skipped, time.perf_counter() - start, workers, skipped_no_face)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="Directory of images, or a manifest file with one image path per line")
+    parser.add_argument("output", help="Directory the renders are written to")
+    parser.add_argument("--looks", default='{"default": {}}',
+                        help="JSON file or inline JSON: {name: makeup config} or a list of makeup configs")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Worker processes")
+    parser.add_argument("--max-in-flight", type=int, default=None,
+                        help="Images submitted to the pool at once (default: 2 per worker)")
+    parser.add_argument("--format", dest="output_format", default="jpeg", choices=sorted(OUTPUT_FORMATS))
+    parser.add_argument("--quality", type=int, default=90, help="JPEG/WebP quality (1-100)")
+    parser.add_argument("--png-compression", type=int, default=3, help="PNG compression level (0-9)")
+    parser.add_argument("--max-side", type=int, default=None, help="Longest side of the renders in pixels")
+    parser.add_argument("--max-faces", type=int, default=1, help="Most faces to render per image")
+    parser.add_argument("--no-recursive", action="store_true", help="Only read the top level of the input directory")
+    parser.add_argument("--overwrite", action="store_true", help="Render again even if the output exists or no face was found before")
+    parser.add_argument("--summary", help="Also write the summary to this JSON file")
+    args = parser.parse_args(argv)
+
+    try:
+        looks = parse_looks(args.looks)
+        output_options = OutputOptions(output_format=args.output_format, quality=args.quality,
+                                       png_compression=args.png_compression, max_side=args.max_side)
+    except ValueError as e:
+        parser.error(str(e))
+    inputs = collect_inputs(args.input, recursive=not args.no_recursive)
+    workers = max(1, args.workers)
+    print(f"Rendering {len(inputs)} images x {len(looks)} looks on {workers} workers")
+
+    summary = run(inputs, looks, args.output, output_options, workers, args.max_in_flight or 2 * workers,
+                  max_faces=args.max_faces, overwrite=args.overwrite)
+
+    print(f"{summary['processed']} images processed ({summary['done']} done, {summary['no_face']} without a face, "
+          f"{summary['failed']} failed), {summary['skipped']} skipped as already rendered, "
+          f"{summary['skipped_no_face']} as without a face before")
+    print(f"{summary['renders_written']} renders in {summary['elapsed_s']:.1f}s: "
+          f"{summary['images_per_s']} images/s, {summary['renders_per_s']} renders/s")
+    if summary["stage_ms"]:
+        print("Mean per image: " + ", ".join(f"{stage} {ms:.1f} ms" for stage, ms in summary["stage_ms"].items()))
+    if args.summary:
+        with open(args.summary, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"Summary written to {args.summary}")
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
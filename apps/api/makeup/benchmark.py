@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+"""
+Benchmark for the makeup pipeline stages.
+
+Renders synthetic face images at several resolutions, times every stage and reports p50/p95 latency,
+throughput and peak memory. Also times importing the rendering core and
+its frontends in fresh interpreters, the cold start paid by every API worker, batch process and test run.
+Results can be stored as JSON and compared against a stored baseline, failing when a stage or an import
+got slower than the allowed percentage. Runs offline on CPU.
+
+    python benchmark.py --output results.json
+    python benchmark.py --baseline results.json --threshold 20
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from landmarks import detect_landmarks, normalize_landmarks
+from utils import face_conn, face_skin_mask, left_eye, mask_skin, right_eye
+from encoding import encode_image
+from tracking import LandmarkTracker
+from uploads import decode_image
+from render import (UPPER_LIP, LOWER_LIP, CHEEKS, LIPSTICK_COLORS, BLUSH_COLORS, apply_lipstick, apply_blush,
+                    apply_foundation)
+
+RESOLUTIONS = {
+    "vga": (480, 640),
+    "hd": (720, 1280),
+    "fhd": (1080, 1920),
+    "12mp": (3000, 4000),
+}
+
+# Modules whose import is timed: the rendering core, the frontends and the tools built on it
+IMPORT_MODULES = ["render", "landmarks", "batch", "app", "main"]
+# Slow imports kept off the startup path, reported when a module loads them anyway
+HEAVY_MODULES = ["mediapipe", "gradio", "fastapi"]
+
+IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "loaded": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+SKIN_BGR = (130, 160, 210)
+LIP_BGR = (90, 80, 170)
+
+
+def synthetic_landmarks(seed: int = 0) -> np.ndarray:
+    """
+    A packed (468, 3) landmark array shaped like a frontal face centred in the frame: the face oval,
+    eyes and lips on ellipses where `synthetic_face` draws them, cheeks either side of the nose,
+    everything else inside the face oval
+    """
+    rng = np.random.default_rng(seed)
+    landmarks = np.zeros((468, 3), dtype=np.float32)
+    angles = rng.uniform(0, 2 * np.pi, 468)
+    radii = np.sqrt(rng.uniform(0, 1, 468))
+    landmarks[:, 0] = 0.5 + 0.16 * radii * np.cos(angles)
+    landmarks[:, 1] = 0.5 + 0.24 * radii * np.sin(angles)
+
+    lips = list(dict.fromkeys(UPPER_LIP + LOWER_LIP))
+    lip_angles = np.linspace(0, 2 * np.pi, len(lips), endpoint=False)
+    landmarks[lips, 0] = 0.5 + 0.06 * np.cos(lip_angles)
+    landmarks[lips, 1] = 0.62 + 0.025 * np.sin(lip_angles)
+    landmarks[CHEEKS, :2] = [[0.6, 0.52], [0.4, 0.52]]
+
+    for contour, (x, y), (rx, ry) in [(face_conn, (0.5, 0.5), (0.16, 0.25)),
+                                      (left_eye, (0.44, 0.42), (0.025, 0.02)),
+                                      (right_eye, (0.56, 0.42), (0.025, 0.02))]:
+        contour_angles = np.linspace(-np.pi / 2, 1.5 * np.pi, len(contour), endpoint=False)
+        landmarks[contour, 0] = x + rx * np.cos(contour_angles)
+        landmarks[contour, 1] = y + ry * np.sin(contour_angles)
+    return landmarks
+
+
+def synthetic_face(height: int, width: int, landmarks: np.ndarray, seed: int = 0) -> np.ndarray:
+    """A noisy background with a skin-toned face oval, eyes and lips drawn where `landmarks` put them"""
+    rng = np.random.default_rng(seed)
+    img = rng.integers(30, 90, (height, width, 3), dtype=np.uint8)
+    center = (width // 2, height // 2)
+    axes = (int(width * 0.17), int(height * 0.26))
+    cv2.ellipse(img, center, axes, 0, 0, 360, SKIN_BGR, cv2.FILLED)
+    for eye_x in (0.44, 0.56):
+        cv2.circle(img, (int(width * eye_x), int(height * 0.42)), max(2, width // 60), (40, 30, 30), cv2.FILLED)
+    lips = normalize_landmarks(landmarks, height, width, UPPER_LIP)
+    cv2.fillPoly(img, [cv2.convexHull(normalize_landmarks(landmarks, height, width, UPPER_LIP + LOWER_LIP))], LIP_BGR)
+    cv2.polylines(img, [lips], False, (60, 50, 120), max(1, width // 400))
+    return img
+
+
+def measure(fn, iterations: int, warmup: int = 1) -> dict:
+    """Times `fn` and records the peak Python/NumPy allocation of a single call"""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    samples = np.array(samples)
+    return {
+        "p50_ms": round(float(np.percentile(samples, 50)), 3),
+        "p95_ms": round(float(np.percentile(samples, 95)), 3),
+        "mean_ms": round(float(samples.mean()), 3),
+        "throughput_per_s": round(1000.0 / float(samples.mean()), 2) if samples.mean() > 0 else None,
+        "peak_alloc_mb": round(peak / 2 ** 20, 2),
+    }
+
+
+def benchmark_resolution(name: str, iterations: int) -> dict:
+    height, width = RESOLUTIONS[name]
+    synthetic = synthetic_landmarks()
+    img = synthetic_face(height, width, synthetic)
+    encoded = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+    detected = detect_landmarks(img)
+    # FaceMesh rarely recognizes the drawn face, rendering then uses the synthetic landmarks
+    landmarks = detected if detected is not None else synthetic
+    lipstick, blush = LIPSTICK_COLORS["Red"], BLUSH_COLORS["Pink"]
+    # Video frames between keyframes: the face moving by a few pixels, followed with optical flow
+    tracker = LandmarkTracker(keyframe_interval=2 ** 30, detect=lambda frame: [landmarks])
+    video = [img, np.roll(img, (2, 3), axis=(0, 1))]
+    tracker.process(video[1])
+
+    stages = {
+        "decode": lambda: decode_image(encoded),
+        "detect_landmarks": lambda: detect_landmarks(img),
+        "track_landmarks": lambda: tracker.process(video[tracker.frames % 2]),
+        "normalize_landmarks": lambda: (normalize_landmarks(landmarks, height, width, UPPER_LIP + LOWER_LIP),
+                                        normalize_landmarks(landmarks, height, width, CHEEKS)),
+        "apply_lipstick": lambda: apply_lipstick(img.copy(), lipstick, landmarks),
+        "apply_blush": lambda: apply_blush(img.copy(), blush, landmarks, intensity=0.5),
+        "apply_foundation": lambda: apply_foundation(img, "Medium"),
+        "mask_skin": lambda: mask_skin(img),
+        "face_skin_mask": lambda: face_skin_mask(img, landmarks),
+        "encode": lambda: encode_image(img),
+    }
+    results = {}
+    for stage, fn in stages.items():
+        results[stage] = measure(fn, iterations)
+        print(f"  {name:>5} {stage:<20} p50 {results[stage]['p50_ms']:>9.2f} ms   "
+              f"p95 {results[stage]['p95_ms']:>9.2f} ms   peak {results[stage]['peak_alloc_mb']:>8.2f} MB")
+    return {"shape": [height, width], "face_detected": detected is not None, "stages": results}
+
+
+def measure_import(module: str, runs: int) -> dict:
+    """
+    Import time of `module` in a fresh interpreter, interpreter startup excluded, over `runs` runs,
+    and which of HEAVY_MODULES the import loaded
+    """
+    probe = IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)
+    samples, loaded = [], []
+    for _ in range(runs):
+        completed = subprocess.run([sys.executable, "-c", probe], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   capture_output=True, text=True)
+        if completed.returncode != 0:
+            error = completed.stderr.strip().splitlines()
+            return {"error": error[-1] if error else f"exit status {completed.returncode}"}
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        samples.append(result["seconds"] * 1000)
+        loaded = result["loaded"]
+    return {"p50_ms": round(float(np.percentile(samples, 50)), 1), "max_ms": round(max(samples), 1), "loads": loaded}
+
+
+def benchmark_imports(runs: int) -> dict:
+    results = {}
+    for module in IMPORT_MODULES:
+        results[module] = measure_import(module, runs)
+        if "error" in results[module]:
+            print(f"  import {module:<14} failed: {results[module]['error']}")
+            continue
+        print(f"  import {module:<14} p50 {results[module]['p50_ms']:>9.1f} ms   "
+              f"loads {', '.join(results[module]['loads']) or '-'}")
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Returns a description of every (resolution, stage) and every import whose p50 is more than
+    `threshold` percent slower than in `baseline`
+    """
+    regressions = []
+    for module, current in results.get("imports", {}).items():
+        before = baseline.get("imports", {}).get(module, {}).get("p50_ms")
+        if not before or "p50_ms" not in current:
+            continue
+        change = (current["p50_ms"] - before) / before * 100
+        if change > threshold:
+            regressions.append(f"import {module}: p50 {before:.1f} -> {current['p50_ms']:.1f} ms (+{change:.0f}%)")
+    for name, current in results["resolutions"].items():
+        reference = baseline.get("resolutions", {}).get(name)
+        if reference is None:
+            continue
+        for stage, stats in current["stages"].items():
+            before = reference["stages"].get(stage, {}).get("p50_ms")
+            if not before:
+                continue
+            change = (stats["p50_ms"] - before) / before * 100
+            if change > threshold:
+                regressions.append(f"{name}/{stage}: p50 {before:.2f} -> {stats['p50_ms']:.2f} ms (+{change:.0f}%)")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--resolutions", default=",".join(RESOLUTIONS),
+                        help=f"Comma separated subset of {', '.join(RESOLUTIONS)}")
+    parser.add_argument("--iterations", type=int, default=10, help="Timed runs per stage")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--baseline", help="Compare against results stored in this JSON file")
+    parser.add_argument("--threshold", type=float, default=20.0,
+                        help="Allowed p50 slowdown per stage in percent before failing")
+    parser.add_argument("--import-runs", type=int, default=5,
+                        help="Fresh interpreters per timed module import (0 skips the import timings)")
+    args = parser.parse_args(argv)
+
+    results = {
+        "python": sys.version.split()[0],
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "iterations": args.iterations,
+        "resolutions": {},
+    }
+    if args.import_runs > 0:
+        results["imports"] = benchmark_imports(args.import_runs)
+    for name in args.resolutions.split(","):
+        if name not in RESOLUTIONS:
+            parser.error(f"Unknown resolution: {name}")
+        results["resolutions"][name] = benchmark_resolution(name, args.iterations)
+    results["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    print(f"Peak RSS: {results['max_rss_mb']} MB")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"Regressions beyond {args.threshold:.0f}%:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print(f"No stage regressed beyond {args.threshold:.0f}%")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
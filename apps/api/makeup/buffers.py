@@ -0,0 +1,145 @@
+"""
+Reusable full-frame buffers for the makeup pipeline.
+
+Every render needs a few frame-sized arrays (the output, the skin mask, cached foundation frames) that
+live for one request. Allocations that large bypass the allocator's free lists: each one maps fresh
+pages, faults them in while the frame is written and unmaps them again, and with several threads
+rendering the peaks add up. Borrowing them from a pool keyed by (shape, dtype) keeps a few warm buffers
+per resolution instead.
+"""
+
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+# Bytes of idle buffers kept for reuse, the least recently used resolutions are dropped beyond it (0 disables)
+BUFFER_POOL_MAX_BYTES = int(os.environ.get("MAKEUP_BUFFER_POOL_MAX_BYTES", 128 * 1024 * 1024))
+# Smaller arrays are cheap to allocate and are never pooled
+BUFFER_POOL_MIN_BYTES = int(os.environ.get("MAKEUP_BUFFER_POOL_MIN_BYTES", 64 * 1024))
+
+
+class BufferPool:
+    """
+    A thread-safe pool of NumPy arrays keyed by (shape, dtype).
+    `acquire` hands out an idle buffer of the requested layout, or a new one, which belongs to the caller
+    until it is given back with `release`; any thread may release it. Idle buffers are retained up to
+    `max_bytes`. A buffer that is never released is simply freed by the garbage collector.
+    Contents of a reused buffer are whatever its previous user left unless `zero` is asked for.
+    """
+
+    def __init__(self, max_bytes: int = BUFFER_POOL_MAX_BYTES, min_bytes: int = BUFFER_POOL_MIN_BYTES):
+        self.max_bytes = max_bytes
+        self.min_bytes = min_bytes
+        self.acquired = 0
+        self.reused = 0
+        self.evictions = 0
+        self._idle = OrderedDict()  # (shape, dtype) -> [buffer, ...], least recently released key first
+        self._idle_bytes = 0
+        self._in_use = {}  # id(buffer) -> weakref, buffers handed out and not released yet
+        self._in_use_bytes = 0
+        self._high_water = 0
+        # Reentrant: the weakref callback of a dropped buffer may run while the lock is held
+        self._lock = threading.RLock()
+
+    def acquire(self, shape, dtype=np.uint8, zero: bool = False) -> np.ndarray:
+        """A C-contiguous array of `shape` and `dtype`, zero-filled with `zero`"""
+        shape, dtype = tuple(shape), np.dtype(dtype)
+        key = (shape, dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        if nbytes < self.min_bytes:
+            return np.zeros(shape, dtype) if zero else np.empty(shape, dtype)
+
+        with self._lock:
+            self.acquired += 1
+            idle = self._idle.get(key)
+            buffer = None
+            if idle:
+                # Last released first, its pages are the most likely to still be in cache
+                buffer = idle.pop()
+                if not idle:
+                    del self._idle[key]
+                self._idle_bytes -= nbytes
+                self.reused += 1
+        if buffer is None:
+            buffer = np.zeros(shape, dtype) if zero else np.empty(shape, dtype)
+        elif zero:
+            buffer.fill(0)
+
+        with self._lock:
+            self._in_use[id(buffer)] = weakref.ref(buffer, self._dropped(id(buffer), nbytes))
+            self._in_use_bytes += nbytes
+            self._high_water = max(self._high_water, self._in_use_bytes + self._idle_bytes)
+        return buffer
+
+    def _dropped(self, key: int, nbytes: int):
+        """Weakref callback forgetting a buffer that was garbage collected without being released"""
+        def callback(ref):
+            with self._lock:
+                if self._in_use.get(key) is ref:
+                    del self._in_use[key]
+                    self._in_use_bytes -= nbytes
+        return callback
+
+    def release(self, buffer: np.ndarray):
+        """
+        Gives back a buffer obtained from `acquire`; it must not be used afterwards, views of it included.
+        Arrays too small to be pooled are ignored, anything else not currently borrowed raises ValueError.
+        """
+        if buffer.nbytes < self.min_bytes:
+            return
+        with self._lock:
+            ref = self._in_use.get(id(buffer))
+            if ref is None or ref() is not buffer:
+                raise ValueError("Buffer was not acquired from this pool or was already released")
+            del self._in_use[id(buffer)]
+            self._in_use_bytes -= buffer.nbytes
+            if buffer.nbytes > self.max_bytes:
+                return
+
+            key = (buffer.shape, buffer.dtype)
+            self._idle.setdefault(key, []).append(buffer)
+            self._idle.move_to_end(key)
+            self._idle_bytes += buffer.nbytes
+            while self._idle_bytes > self.max_bytes:
+                oldest = next(iter(self._idle))
+                idle = self._idle[oldest]
+                self._idle_bytes -= idle.pop(0).nbytes
+                if not idle:
+                    del self._idle[oldest]
+                self.evictions += 1
+
+    @contextmanager
+    def borrow(self, shape, dtype=np.uint8, zero: bool = False):
+        """`acquire` as a context manager, the buffer is released when the block exits"""
+        buffer = self.acquire(shape, dtype, zero)
+        try:
+            yield buffer
+        finally:
+            self.release(buffer)
+
+    def clear(self):
+        """Drops every idle buffer, buffers in use are unaffected"""
+        with self._lock:
+            self._idle.clear()
+            self._idle_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "idle_buffers": sum(len(idle) for idle in self._idle.values()),
+                "idle_bytes": self._idle_bytes,
+                "in_use_buffers": len(self._in_use),
+                "in_use_bytes": self._in_use_bytes,
+                "high_water_bytes": self._high_water,
+                "acquired": self.acquired,
+                "reused": self.reused,
+                "evictions": self.evictions,
+                "reuse_rate": self.reused / self.acquired if self.acquired else 0.0,
+            }
+
+
+buffer_pool = BufferPool()
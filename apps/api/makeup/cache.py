@@ -0,0 +1,546 @@
+"""
+Caches shared by the makeup pipeline: detected landmarks and rendered results, in memory and on disk.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+import numpy as np
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LANDMARK_CACHE_ENTRIES = int(os.environ.get("MAKEUP_LANDMARK_CACHE_ENTRIES", 64))
+LANDMARK_CACHE_MAX_BYTES = int(os.environ.get("MAKEUP_LANDMARK_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+LANDMARK_CACHE_TTL = float(os.environ.get("MAKEUP_LANDMARK_CACHE_TTL", 600))
+# Directory of the on-disk tier, landmark tokens are valid in every API process pointed at it. It holds the
+# uploaded photos, so it is off unless configured
+LANDMARK_CACHE_DIR = os.environ.get("MAKEUP_LANDMARK_CACHE_DIR") or None
+LANDMARK_CACHE_DISK_BYTES = int(os.environ.get("MAKEUP_LANDMARK_CACHE_DISK_BYTES", 1024 * 1024 * 1024))
+
+RESULT_CACHE_ENTRIES = int(os.environ.get("MAKEUP_RESULT_CACHE_ENTRIES", 512))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("MAKEUP_RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# Directory of the on-disk tier, shared by the API processes pointed at it. It holds rendered photos, so it is
+# off unless configured
+RESULT_CACHE_DIR = os.environ.get("MAKEUP_RESULT_CACHE_DIR") or None
+RESULT_CACHE_DISK_BYTES = int(os.environ.get("MAKEUP_RESULT_CACHE_DISK_BYTES", 1024 * 1024 * 1024))
+# Seconds a rendered result is kept, in memory and on disk
+RESULT_CACHE_TTL = float(os.environ.get("MAKEUP_RESULT_CACHE_TTL", 600))
+# Part of every result key: bump it when rendering or encoding changes, so stale results on disk are never served
+RESULT_CACHE_VERSION = "1"
+
+
+def content_key(data: bytes) -> str:
+    """A content hash of raw (still encoded) upload bytes"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class DiskTier:
+    """
+    The on-disk tier of a cache: one file per key in `directory`, which several processes may share.
+    Files are replaced atomically, so readers never see a partial one. The tier is bounded by `max_bytes`
+    with the least recently used files removed first; each process only accounts for the files it wrote
+    or read (plus those present when the tier was first used), so the bound holds per process.
+    With `ttl`, files are deleted `ttl` seconds after they were written: expired files are never read, and
+    writes sweep the directory for them at most every minute, whoever wrote them.
+    A file's modification time is when it was written, its access time when it was last used.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, suffix: str, on_evict: Callable[[], None] = None,
+                 ttl: Optional[float] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.on_evict = on_evict
+        self.ttl = ttl
+        self.evictions = 0
+        self.expirations = 0
+        self._files = None  # key -> file size, least recently used first; scanned on first access
+        self._bytes = 0
+        self._next_sweep = 0.0
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}{self.suffix}")
+
+    def _expired(self, stat: os.stat_result, now: float) -> bool:
+        return self.ttl is not None and stat.st_mtime + self.ttl < now
+
+    def _listing(self):
+        """(last used, key, size, expired) of every file in the directory"""
+        now = time.time()
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(self.suffix):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue  # Removed meanwhile
+                    files.append((stat.st_atime, entry.name[:-len(self.suffix)], stat.st_size,
+                                  self._expired(stat, now)))
+        return files
+
+    def _scan(self):
+        """Indexes the files already in the directory, least recently used first; called with the lock held"""
+        if self._files is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        files = sorted(self._listing())
+        for _, key, _, expired in files:
+            if expired:
+                self._delete(key)
+        self._files = OrderedDict((key, size) for _, key, size, expired in files if not expired)
+        self._bytes = sum(self._files.values())
+
+    def _delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def sweep(self):
+        """Deletes the expired files in the directory, also those written by other processes"""
+        if self.ttl is None:
+            return
+        with self._lock:
+            self._scan()
+        expired = [key for _, key, _, expired in self._listing() if expired]
+        for key in expired:
+            self.remove(key)
+        with self._lock:
+            self.expirations += len(expired)
+        if expired:
+            logger.info("Removed %d expired cache files from %s", len(expired), self.directory)
+
+    def read(self, key: str) -> Optional[bytes]:
+        """The content of the file for `key`, None when there is none or it cannot be read"""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                data = None if self._expired(stat, time.time()) else f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning("Dropping unreadable cache file %s: %s", path, e)
+            self.remove(key)
+            return None
+        if data is None:
+            self.remove(key)
+            return None
+        with self._lock:
+            self._scan()
+            self._account(key, len(data))
+        try:
+            # The access time orders files for eviction, also for the next process scanning the directory;
+            # the modification time stays the time of writing, which expiry counts from
+            os.utime(path, (time.time(), stat.st_mtime))
+        except OSError:
+            pass
+        return data
+
+    def write(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with self._lock:
+            self._scan()
+        try:
+            with open(temporary, "wb") as f:
+                f.write(data)
+            os.replace(temporary, path)
+        except OSError as e:
+            # The disk tier is an optimization, a full or read-only disk must not fail the request
+            logger.warning("Could not write cache file %s: %s", path, e)
+            return
+        with self._lock:
+            self._account(key, len(data))
+            while self._bytes > self.max_bytes:
+                oldest, size = self._files.popitem(last=False)
+                self._bytes -= size
+                self.evictions += 1
+                if self.on_evict is not None:
+                    self.on_evict()
+                self._delete(oldest)
+            now = time.time()
+            sweep = self.ttl is not None and now >= self._next_sweep
+            if sweep:
+                self._next_sweep = now + min(60.0, max(self.ttl, 1.0))
+        if sweep:
+            self.sweep()
+
+    def _account(self, key: str, size: int):
+        """Marks a file as most recently used; called with the lock held"""
+        self._bytes += size - self._files.pop(key, 0)
+        self._files[key] = size
+
+    def remove(self, key: str):
+        with self._lock:
+            if self._files is not None and key in self._files:
+                self._bytes -= self._files.pop(key)
+        self._delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._scan()
+            keys = list(self._files)
+        for key in keys:
+            self.remove(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"files": len(self._files or ()), "bytes": self._bytes, "evictions": self.evictions,
+                    "expirations": self.expirations}
+
+
+class CachedLandmarks:
+    """
+    The faces detected in one uploaded image, searching for up to `searched` faces, with the encoded
+    upload (`source`) they were detected in and its decoded `image`, decoded to fit `max_side` (None for
+    full resolution). The image is None for an entry read back from disk, until the source is decoded again.
+    """
+
+    def __init__(self, faces: List[np.ndarray], searched: int, source: bytes, image: Optional[np.ndarray] = None,
+                 max_side: Optional[int] = None):
+        self.faces = faces
+        self.searched = searched
+        self.source = source
+        self.image = image
+        self.max_side = max_side
+
+    def covers(self, max_side: Optional[int]) -> bool:
+        """Whether the held image is as large as decoding the source to fit `max_side` would give"""
+        if self.image is None:
+            return False
+        if self.max_side is None or max(self.image.shape[:2]) < self.max_side:
+            # Decoded in full, or smaller than the bound anyway
+            return True
+        return max_side is not None and max_side <= self.max_side
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.source) + (self.image.nbytes if self.image is not None else 0)
+
+    def dumps(self, expires_at: float) -> bytes:
+        """A JSON header line with the faces and the wall-clock expiry, then the source bytes"""
+        header = json.dumps({"expires_at": expires_at, "searched": self.searched,
+                             "faces": [face.tolist() for face in self.faces]})
+        return header.encode() + b"\n" + self.source
+
+    @classmethod
+    def loads(cls, data: bytes):
+        """The entry and its wall-clock expiry, see `dumps`"""
+        header, source = data.split(b"\n", 1)
+        fields = json.loads(header)
+        faces = [np.array(face, dtype=np.float32).reshape(-1, 3) for face in fields["faces"]]
+        return cls(faces, fields["searched"], source), fields["expires_at"]
+
+
+class LandmarkCache:
+    """
+    A thread-safe LRU cache mapping the content hash of an uploaded image to its detected landmarks.
+    Entries expire after `ttl` seconds. In memory the cache is bounded by entry count and by the bytes of
+    the held source and decoded images. With a `directory`, every entry is also written through to a disk tier
+    there, so its key, which doubles as the `landmark_token` handed to clients, is valid in any process sharing
+    the directory: API workers, executor processes, and after restarts. Entries found on disk hold no decoded
+    image; their files, which contain the uploaded photo, are deleted once they expire.
+    """
+
+    def __init__(self, max_entries: int = LANDMARK_CACHE_ENTRIES, max_bytes: int = LANDMARK_CACHE_MAX_BYTES,
+                 ttl: float = LANDMARK_CACHE_TTL, directory: Optional[str] = LANDMARK_CACHE_DIR,
+                 disk_bytes: int = LANDMARK_CACHE_DISK_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires_at, CachedLandmarks)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk = None
+        if directory and disk_bytes > 0:
+            self._disk = DiskTier(directory, disk_bytes, ".landmarks", ttl=ttl)
+
+    @property
+    def shared(self) -> bool:
+        """Whether tokens are valid beyond this process, through the disk tier"""
+        return self._disk is not None
+
+    def __contains__(self, key: str) -> bool:
+        """Whether `key` is known and unexpired; an entry found on disk is loaded into memory"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= time.monotonic():
+                return True
+        return self._read(key) is not None
+
+    def get(self, key: str) -> Optional[CachedLandmarks]:
+        """The entry for `key`, from memory or disk, or None when it is unknown or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        landmarks = self._read(key)
+        with self._lock:
+            if landmarks is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.disk_hits += 1
+        return landmarks
+
+    def _read(self, key: str) -> Optional[CachedLandmarks]:
+        """Loads an unexpired entry from disk into memory"""
+        data = self._disk.read(key) if self._disk is not None else None
+        if data is None:
+            return None
+        try:
+            landmarks, expires_at = CachedLandmarks.loads(data)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("Dropping unreadable cached landmarks %s: %s", key, e)
+            self._disk.remove(key)
+            return None
+        remaining = expires_at - time.time()
+        if remaining <= 0:
+            self._disk.remove(key)
+            return None
+        self._remember(key, landmarks, remaining)
+        return landmarks
+
+    def put(self, key: str, landmarks: CachedLandmarks, persist: bool = True):
+        """
+        Stores an entry, and with `persist` writes it to disk. The decoded image is marked read-only as it
+        is shared between requests.
+        """
+        if landmarks.image is not None:
+            landmarks.image.setflags(write=False)
+        self._remember(key, landmarks, self.ttl)
+        if persist and self._disk is not None:
+            self._disk.write(key, landmarks.dumps(time.time() + self.ttl))
+
+    def _remember(self, key: str, landmarks: CachedLandmarks, ttl: float):
+        if self.max_entries <= 0 or landmarks.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, landmarks)
+            self._bytes += landmarks.nbytes
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key: str):
+        """Drops an entry from memory; called with the lock held"""
+        _, landmarks = self._entries.pop(key)
+        self._bytes -= landmarks.nbytes
+
+    def clear(self):
+        """Empties both tiers"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self._disk is not None:
+            self._disk.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+        disk = self._disk.stats() if self._disk is not None else {"files": 0, "bytes": 0}
+        stats.update(disk_files=disk["files"], disk_bytes=disk["bytes"])
+        return stats
+
+
+def result_key(image_id: str, *params) -> str:
+    """
+    Key of a rendered result: the identity of the source image plus every parameter that changes the
+    output, which must have a stable repr (tuples, strings, numbers, None)
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{RESULT_CACHE_VERSION}|{image_id}|{params!r}".encode())
+    return digest.hexdigest()
+
+
+class CachedResult:
+    """
+    An encoded rendered image with what the response says about it: the landmark token of its source
+    image and the rendered faces. The ETag is a hash of the image bytes.
+    """
+
+    def __init__(self, image: bytes, landmark_token: str, faces: List[dict], etag: Optional[str] = None):
+        self.image = image
+        self.landmark_token = landmark_token
+        self.faces = faces
+        self.etag = etag or f'"{content_key(image)}"'
+
+    def dumps(self, expires_at: float) -> bytes:
+        """A JSON header line with the response fields and the wall-clock expiry, then the image bytes"""
+        header = json.dumps({"expires_at": expires_at, "etag": self.etag, "landmark_token": self.landmark_token,
+                             "faces": self.faces})
+        return header.encode() + b"\n" + self.image
+
+    @classmethod
+    def loads(cls, data: bytes):
+        """The result and its wall-clock expiry, see `dumps`"""
+        header, image = data.split(b"\n", 1)
+        fields = json.loads(header)
+        return cls(image, fields["landmark_token"], fields["faces"], fields["etag"]), fields["expires_at"]
+
+
+class ResultCache:
+    """
+    A thread-safe two-tier cache of rendered results, which expire `ttl` seconds after they were rendered.
+    The memory tier is an LRU bounded by entry count and image bytes. With a `directory`, a disk tier (see
+    `DiskTier`) there is written through on every `put` and bounded by `disk_bytes`; results evicted from
+    memory are still found there, also by other processes sharing the directory, and survive restarts.
+    Expired files are deleted by the disk tier's sweep.
+    A result stored under several keys is shared in memory and written once per key on disk.
+    """
+
+    def __init__(self, max_entries: int = RESULT_CACHE_ENTRIES, max_bytes: int = RESULT_CACHE_MAX_BYTES,
+                 directory: Optional[str] = RESULT_CACHE_DIR, disk_bytes: int = RESULT_CACHE_DISK_BYTES,
+                 ttl: float = RESULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires_at, CachedResult)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk = None
+        if directory and disk_bytes > 0:
+            self._disk = DiskTier(directory, disk_bytes, ".result", ttl=ttl,
+                                  on_evict=lambda: metrics.result_cache_evictions_total.inc("disk"))
+
+    def get(self, keys: List[str]):
+        """
+        The result stored under the first of `keys` found, memory first, as (result, tier);
+        (None, None) on a miss. Disk hits are promoted to memory.
+        """
+        with self._lock:
+            now = time.monotonic()
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] < now:
+                    self._remove(key)
+                    entry = None
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    return self._hit(entry[1], "memory")
+
+        for key in keys if self._disk is not None else ():
+            result = self._read(key)
+            if result is not None:
+                with self._lock:
+                    return self._hit(result, "disk")
+
+        with self._lock:
+            self.misses += 1
+        metrics.result_cache_lookups_total.inc("miss")
+        return None, None
+
+    def _hit(self, result: CachedResult, tier: str):
+        """Counts a hit, called with the lock held"""
+        self.hits[tier] += 1
+        metrics.result_cache_lookups_total.inc(tier)
+        return result, tier
+
+    def _read(self, key: str) -> Optional[CachedResult]:
+        """Loads an unexpired result from disk into memory"""
+        data = self._disk.read(key)
+        if data is None:
+            return None
+        try:
+            result, expires_at = CachedResult.loads(data)
+        except (ValueError, KeyError) as e:
+            logger.warning("Dropping unreadable cached result %s: %s", key, e)
+            self._disk.remove(key)
+            return None
+        remaining = expires_at - time.time()
+        if remaining <= 0:
+            self._disk.remove(key)
+            return None
+        self._remember(key, result, remaining)
+        return result
+
+    def put(self, keys: List[str], result: CachedResult):
+        """Stores `result` under each of `keys`, in memory and on disk"""
+        data = result.dumps(time.time() + self.ttl) if self._disk is not None else None
+        for key in keys:
+            self._remember(key, result, self.ttl)
+            if data is not None:
+                self._disk.write(key, data)
+
+    def _remember(self, key: str, result: CachedResult, ttl: float):
+        if self.max_entries <= 0 or len(result.image) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, result)
+            self._bytes += len(result.image)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+                metrics.result_cache_evictions_total.inc("memory")
+
+    def _remove(self, key: str):
+        """Drops a result from memory; called with the lock held"""
+        _, result = self._entries.pop(key)
+        self._bytes -= len(result.image)
+
+    def clear(self):
+        """Empties both tiers"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self._disk is not None:
+            self._disk.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = sum(self.hits.values()) + self.misses
+            stats = {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "memory_hits": self.hits["memory"],
+                "disk_hits": self.hits["disk"],
+                "misses": self.misses,
+                "memory_evictions": self.evictions,
+                "hit_rate": sum(self.hits.values()) / lookups if lookups else 0.0,
+            }
+        disk = self._disk.stats() if self._disk is not None else {"files": 0, "bytes": 0, "evictions": 0}
+        stats.update(disk_evictions=disk["evictions"], disk_files=disk["files"], disk_bytes=disk["bytes"])
+        return stats
+
+
+landmark_cache = LandmarkCache()
+result_cache = ResultCache()
@@ -0,0 +1,124 @@
+"""
+Output encoding for rendered images.
+
+Images are encoded straight from the BGR array with `cv2.imencode`, no PIL round-trip or RGB conversion.
+"""
+
+import base64
+import os
+from typing import Optional
+
+import cv2
+import numpy as np
+
+# format name -> (cv2 extension, media type)
+OUTPUT_FORMATS = {
+    "jpeg": (".jpg", "image/jpeg"),
+    "webp": (".webp", "image/webp"),
+    "png": (".png", "image/png"),
+}
+MEDIA_TYPES = {media_type: name for name, (_, media_type) in OUTPUT_FORMATS.items()}
+
+DEFAULT_OUTPUT_FORMAT = os.environ.get("MAKEUP_OUTPUT_FORMAT", "jpeg")
+DEFAULT_QUALITY = int(os.environ.get("MAKEUP_OUTPUT_QUALITY", 90))
+DEFAULT_PNG_COMPRESSION = int(os.environ.get("MAKEUP_PNG_COMPRESSION", 3))
+
+# Preference order when the client accepts several image types equally
+FORMAT_PREFERENCE = ["webp", "jpeg", "png"]
+
+
+def encode_image(image: np.ndarray, output_format: str = DEFAULT_OUTPUT_FORMAT, quality: int = DEFAULT_QUALITY,
+                 png_compression: int = DEFAULT_PNG_COMPRESSION) -> bytes:
+    """
+    Encodes a BGR image. `quality` (1-100) applies to JPEG and WebP, `png_compression` (0-9) to PNG.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format: {output_format}")
+    extension, _ = OUTPUT_FORMATS[output_format]
+    if output_format == "jpeg":
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    elif output_format == "webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    else:
+        params = [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+    ok, buffer = cv2.imencode(extension, image, params)
+    if not ok:
+        raise RuntimeError(f"Could not encode image as {output_format}")
+    return buffer.tobytes()
+
+
+def encode_image_to_base64(image: np.ndarray, output_format: str = DEFAULT_OUTPUT_FORMAT,
+                           quality: int = DEFAULT_QUALITY, png_compression: int = DEFAULT_PNG_COMPRESSION) -> str:
+    """Encodes a BGR image as a base64 data URI"""
+    return data_uri(encode_image(image, output_format, quality, png_compression), output_format)
+
+
+def data_uri(data: bytes, output_format: str) -> str:
+    """An encoded image as a base64 data URI"""
+    return f"data:{media_type(output_format)};base64,{base64.b64encode(data).decode()}"
+
+
+def media_type(output_format: str) -> str:
+    return OUTPUT_FORMATS[output_format][1]
+
+
+def parse_accept(accept: Optional[str]) -> dict:
+    """
+    Parses an Accept header into {media type: q}
+    """
+    preferences = {}
+    for part in (accept or "").split(","):
+        fields = [field.strip() for field in part.split(";")]
+        if not fields[0]:
+            continue
+        q = 1.0
+        for param in fields[1:]:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        preferences[fields[0].lower()] = max(q, preferences.get(fields[0].lower(), 0.0))
+    return preferences
+
+
+def accepted(preferences: dict, media: str):
+    """
+    The q value `preferences` give a media type and how specifically: 2 when it is named,
+    1 through `type/*`, 0 through `*/*`. No Accept header accepts everything.
+    """
+    if not preferences:
+        return 1.0, 0
+    for specificity, pattern in ((2, media), (1, media.split("/")[0] + "/*"), (0, "*/*")):
+        if pattern in preferences:
+            return preferences[pattern], specificity
+    return 0.0, 0
+
+
+def negotiate_output(accept: Optional[str], output_format: Optional[str] = None,
+                     return_base64: Optional[bool] = None):
+    """
+    Picks the output format and whether to answer with binary image bytes or base64 JSON.
+    Explicit parameters win. Otherwise the response is binary, in the client's preferred supported image
+    format, unless `application/json` ranks above every image type: by q value, then by how specifically
+    it is named. So clients without an Accept header or with `*/*` (curl, SDKs) get bytes, clients asking
+    for `application/json` get JSON.
+    Returns (output_format, return_base64).
+    """
+    preferences = parse_accept(accept)
+    image_q = {name: accepted(preferences, media) for media, name in MEDIA_TYPES.items()}
+
+    if return_base64 is None:
+        return_base64 = accepted(preferences, "application/json") > max(image_q.values())
+
+    if output_format is None:
+        output_format = DEFAULT_OUTPUT_FORMAT
+        if not return_base64 and max(q for q, _ in image_q.values()) > 0:
+            # Highest q first, then types named explicitly over `image/*` and `*/*`, then the configured default
+            output_format = max(image_q, key=lambda name: (
+                image_q[name],
+                name == DEFAULT_OUTPUT_FORMAT,
+                -FORMAT_PREFERENCE.index(name),
+            ))
+    return output_format, return_base64
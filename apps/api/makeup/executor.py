@@ -0,0 +1,127 @@
+"""
+Runs the CPU-bound makeup pipeline off the asyncio event loop.
+
+Work is handed to a thread pool (OpenCV, NumPy and MediaPipe release the GIL for the heavy parts)
+or, optionally, to a process pool that runs the whole pipeline per request. Admission is bounded:
+once every worker is busy and the wait queue is full, new work is rejected instead of piling up.
+"""
+
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+import landmarks
+
+logger = logging.getLogger(__name__)
+
+EXECUTOR_MODE = os.environ.get("MAKEUP_EXECUTOR", "thread")  # "thread" or "process"
+MAX_WORKERS = int(os.environ.get("MAKEUP_WORKERS", landmarks.POOL_SIZE))
+MAX_QUEUE = int(os.environ.get("MAKEUP_MAX_QUEUE", MAX_WORKERS * 2))
+RETRY_AFTER = int(os.environ.get("MAKEUP_RETRY_AFTER", 1))
+
+
+class ExecutorSaturated(Exception):
+    """Raised when every worker is busy and the admission queue is full"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Makeup pipeline is saturated")
+        self.retry_after = retry_after
+
+
+def _init_process_worker():
+    """Each worker process owns one warmed-up FaceMesh"""
+    landmarks.warmup(count=1)
+
+
+class PipelineExecutor:
+    """
+    Bounded executor for the makeup pipeline.
+    At most `max_workers` jobs run at once and at most `max_queue` more wait for a worker;
+    anything beyond that raises `ExecutorSaturated`.
+    """
+
+    def __init__(self, mode: str = EXECUTOR_MODE, max_workers: int = MAX_WORKERS,
+                 max_queue: int = MAX_QUEUE, retry_after: int = RETRY_AFTER):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"Unknown executor mode: {mode}")
+        self.mode = mode
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self.retry_after = retry_after
+        self._pool: Executor = None
+        self._thread_pool: ThreadPoolExecutor = None  # Only used in process mode, for work that cannot be pickled
+        self._pending = 0  # Only touched from the event loop thread
+
+    @property
+    def in_flight(self) -> int:
+        return min(self._pending, self.max_workers)
+
+    @property
+    def queued(self) -> int:
+        return max(0, self._pending - self.max_workers)
+
+    def start(self):
+        if self._pool is not None:
+            return
+        if self.mode == "process":
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_process_worker,
+            )
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="makeup")
+        logger.info("Started %s executor with %d workers and a queue of %d",
+                    self.mode, self.max_workers, self.max_queue)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=True, cancel_futures=True)
+            self._thread_pool = None
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Runs `fn(*args, **kwargs)` on the pool and awaits its result.
+        In process mode `fn` and its arguments must be picklable.
+        """
+        self.start()
+        return await self._submit(self._pool, fn, *args, **kwargs)
+
+    async def run_in_thread(self, fn, *args, **kwargs):
+        """
+        Like `run`, but always on a thread, for work holding unpicklable state such as a per-stream FaceMesh.
+        Shares the admission limit with `run`.
+        """
+        self.start()
+        if self.mode == "thread":
+            return await self._submit(self._pool, fn, *args, **kwargs)
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="makeup")
+        return await self._submit(self._thread_pool, fn, *args, **kwargs)
+
+    async def _submit(self, pool: Executor, fn, *args, **kwargs):
+        if self._pending >= self.max_workers + self.max_queue:
+            raise ExecutorSaturated(self.retry_after)
+        loop = asyncio.get_running_loop()
+        future = pool.submit(functools.partial(fn, *args, **kwargs))
+        self._pending += 1
+        # The slot is held until the job itself is done, not just its awaiter: a request cancelled by a client
+        # disconnect leaves its job running on the worker
+        future.add_done_callback(lambda _: self._release(loop))
+        return await asyncio.wrap_future(future, loop=loop)
+
+    def _release(self, loop: asyncio.AbstractEventLoop):
+        """Done-callback of a job, called on the worker thread (or the loop thread for a cancelled job)"""
+        try:
+            loop.call_soon_threadsafe(self._done)
+        except RuntimeError:
+            pass  # The loop is closed, nothing is admitted anymore
+
+    def _done(self):
+        self._pending -= 1
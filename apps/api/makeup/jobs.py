@@ -0,0 +1,370 @@
+"""
+Asynchronous render jobs for work that does not fit in a synchronous request: 12MP originals and bulk
+catalog batches.
+
+Jobs live in a local SQLite database with their input and result files next to it, so no broker is needed
+and queued jobs survive a restart. Worker threads claim jobs by priority lane: interactive jobs are always
+claimed first, and bulk jobs only run on `bulk_workers` of the threads, which also run at a lower OS
+scheduling priority, so a large bulk submission neither starves interactive jobs nor the synchronous
+endpoints. Finished jobs and their results are deleted `ttl` seconds after they finished.
+
+Several processes (API workers) may share the database. A running job carries the id of the queue that
+claimed it and a heartbeat renewed while it runs; only jobs whose heartbeat is older than `lease` seconds,
+left behind by a crashed or killed process, are queued again.
+"""
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+JOB_DIR = os.environ.get("MAKEUP_JOB_DIR", os.path.join(tempfile.gettempdir(), "makeup-jobs"))
+JOB_WORKERS = int(os.environ.get("MAKEUP_JOB_WORKERS", 2))
+# Threads that may also run bulk jobs, the others only ever run interactive ones
+JOB_BULK_WORKERS = int(os.environ.get("MAKEUP_JOB_BULK_WORKERS", max(1, JOB_WORKERS - 1)))
+# Niceness added to the bulk worker threads (Linux), so interactive work gets the CPU first
+JOB_BULK_NICE = int(os.environ.get("MAKEUP_JOB_BULK_NICE", 10))
+JOB_TTL = float(os.environ.get("MAKEUP_JOB_TTL", 3600))
+JOB_MAX_QUEUED = int(os.environ.get("MAKEUP_JOB_MAX_QUEUED", 1000))
+# Seconds without a heartbeat after which a running job counts as abandoned and is queued again
+JOB_LEASE = float(os.environ.get("MAKEUP_JOB_LEASE", 60))
+
+# In claim order
+PRIORITIES = ("interactive", "bulk")
+_RANK = "CASE priority WHEN 'interactive' THEN 0 ELSE 1 END"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    priority TEXT NOT NULL,
+    state TEXT NOT NULL,
+    params TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    expires_at REAL,
+    success INTEGER,
+    status TEXT,
+    error TEXT,
+    media_type TEXT,
+    metadata TEXT,
+    worker TEXT,
+    heartbeat_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (state, priority, created_at);
+CREATE INDEX IF NOT EXISTS jobs_expiry ON jobs (expires_at);
+"""
+
+# Added after the first release, databases created before get them on open
+_ADDED_COLUMNS = {"worker": "TEXT", "heartbeat_at": "REAL"}
+
+
+class JobQueueFull(Exception):
+    """Raised when `max_queued` jobs are already waiting"""
+
+
+class JobResult:
+    """
+    What a job handler returns: whether it succeeded, a status line and optionally the result file's
+    content and media type plus JSON-serializable metadata for the job status
+    """
+
+    def __init__(self, success: bool, status: str, content: Optional[bytes] = None,
+                 media_type: Optional[str] = None, metadata: Optional[dict] = None):
+        self.success = success
+        self.status = status
+        self.content = content
+        self.media_type = media_type
+        self.metadata = metadata or {}
+
+
+class JobQueue:
+    """
+    A persistent job queue with its own worker threads.
+    Handlers are registered per job kind and called as `handler(params, data)` with the JSON params and
+    the input bytes given to `submit`; they return a `JobResult`, exceptions mark the job as failed.
+    """
+
+    def __init__(self, directory: str = JOB_DIR, workers: int = JOB_WORKERS, bulk_workers: int = JOB_BULK_WORKERS,
+                 ttl: float = JOB_TTL, max_queued: int = JOB_MAX_QUEUED, bulk_nice: int = JOB_BULK_NICE,
+                 lease: float = JOB_LEASE):
+        self.directory = directory
+        self.workers = max(1, workers)
+        self.bulk_workers = min(self.workers, max(1, bulk_workers))
+        self.ttl = ttl
+        self.max_queued = max_queued
+        self.bulk_nice = bulk_nice
+        self.lease = lease
+        # Marks the jobs this queue claimed, unique per process and queue
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.completed = 0
+        self.failed = 0
+        self._handlers: Dict[str, Callable] = {}
+        self._threads = []
+        self._stop = threading.Event()
+        self._wakeup = threading.Condition()
+        self._next_sweep = 0.0
+
+    @property
+    def database(self) -> str:
+        return os.path.join(self.directory, "jobs.sqlite3")
+
+    def register(self, kind: str, handler: Callable[[dict, bytes], JobResult]):
+        self._handlers[kind] = handler
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.database, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def _path(self, job_id: str, kind: str) -> str:
+        return os.path.join(self.directory, kind, job_id)
+
+    def open(self):
+        """Creates the directories and the database; jobs can be submitted from here on"""
+        for kind in ("inputs", "results"):
+            os.makedirs(os.path.join(self.directory, kind), exist_ok=True)
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(_SCHEMA)
+            columns = {row["name"] for row in db.execute("PRAGMA table_info(jobs)")}
+            for name, kind in _ADDED_COLUMNS.items():
+                if name not in columns:
+                    db.execute(f"ALTER TABLE jobs ADD COLUMN {name} {kind}")
+        self._requeue_abandoned()
+
+    def _requeue_abandoned(self):
+        """
+        Queues jobs again whose worker stopped renewing their heartbeat, interrupted by a crash; jobs
+        running in other live processes sharing the database are left alone
+        """
+        with self._connect() as db:
+            requeued = db.execute(
+                "UPDATE jobs SET state = 'queued', started_at = NULL, worker = NULL, heartbeat_at = NULL "
+                "WHERE state = 'running' AND (heartbeat_at IS NULL OR heartbeat_at < ?)",
+                (time.time() - self.lease,)
+            ).rowcount
+        if requeued:
+            logger.info("Requeued %d interrupted jobs", requeued)
+
+    def start(self):
+        """Opens the queue and starts the worker threads"""
+        if self._threads:
+            return
+        self.open()
+        self._stop.clear()
+        for index in range(self.workers):
+            # The last `bulk_workers` threads also take bulk jobs
+            priorities = PRIORITIES if index >= self.workers - self.bulk_workers else PRIORITIES[:1]
+            thread = threading.Thread(target=self._work, args=(priorities,), name=f"makeup-job-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        heartbeat = threading.Thread(target=self._heartbeat, name="makeup-job-heartbeat", daemon=True)
+        heartbeat.start()
+        self._threads.append(heartbeat)
+        logger.info("Started %d job workers (%d for bulk jobs) in %s", self.workers, self.bulk_workers, self.directory)
+
+    def shutdown(self):
+        """Stops the workers after their current job; queued jobs stay in the database"""
+        self._stop.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, kind: str, params: dict, data: bytes, priority: str = "interactive") -> dict:
+        """Stores the job and its input and queues it. Returns the job status, see `get`."""
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority}")
+        job_id = uuid.uuid4().hex
+        with self._connect() as db:
+            queued = db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+            if self.max_queued and queued >= self.max_queued:
+                raise JobQueueFull(f"{queued} jobs are already queued")
+            _write_file(self._path(job_id, "inputs"), data)
+            db.execute("INSERT INTO jobs (id, kind, priority, state, params, created_at) "
+                       "VALUES (?, ?, ?, 'queued', ?, ?)", (job_id, kind, priority, json.dumps(params), time.time()))
+        with self._wakeup:
+            self._wakeup.notify()
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        """
+        The job's status as a dict, with its queue `position` (0 = next) while queued;
+        None for unknown or expired jobs
+        """
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or (row["expires_at"] is not None and row["expires_at"] < time.time()):
+                return None
+            job = _job_dict(row)
+            if row["state"] == "queued":
+                rank = PRIORITIES.index(row["priority"])
+                job["position"] = db.execute(
+                    f"SELECT COUNT(*) FROM jobs WHERE state = 'queued' "
+                    f"AND ({_RANK} < ? OR ({_RANK} = ? AND created_at < ?))",
+                    (rank, rank, row["created_at"])
+                ).fetchone()[0]
+        return job
+
+    def result_path(self, job_id: str) -> Optional[str]:
+        """The result file of a finished job, None when it has none (yet)"""
+        path = self._path(job_id, "results")
+        return path if os.path.exists(path) else None
+
+    def counts(self) -> Dict[str, int]:
+        """Number of jobs per state"""
+        if not os.path.exists(self.database):
+            return {}
+        with self._connect() as db:
+            rows = db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return {state: count for state, count in rows}
+
+    def _work(self, priorities):
+        if "bulk" in priorities and self.bulk_nice:
+            try:
+                # Linux applies niceness per thread
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.bulk_nice)
+            except (AttributeError, OSError) as e:
+                logger.debug("Could not lower the bulk worker priority: %s", e)
+        while not self._stop.is_set():
+            try:
+                job = self._claim(priorities)
+                if job is None:
+                    self._sweep()
+                    with self._wakeup:
+                        # Other processes sharing the database do not notify us, so poll as well
+                        self._wakeup.wait(timeout=1.0)
+                    continue
+                self._run(job)
+            except Exception:
+                logger.error("Job worker failed", exc_info=True)
+                self._stop.wait(1.0)
+
+    def _heartbeat(self):
+        """Renews the heartbeat of the jobs this queue is running, several times per lease"""
+        while not self._stop.wait(self.lease / 4):
+            try:
+                with self._connect() as db:
+                    db.execute("UPDATE jobs SET heartbeat_at = ? WHERE state = 'running' AND worker = ?",
+                               (time.time(), self.worker_id))
+            except Exception:
+                logger.error("Job heartbeat failed", exc_info=True)
+
+    def _claim(self, priorities) -> Optional[sqlite3.Row]:
+        placeholders = ", ".join("?" * len(priorities))
+        with self._connect() as db:
+            # IMMEDIATE takes the write lock up front, so two workers (or processes) never claim the same job
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute(
+                    f"SELECT * FROM jobs WHERE state = 'queued' AND priority IN ({placeholders}) "
+                    f"ORDER BY {_RANK}, created_at LIMIT 1",
+                    priorities
+                ).fetchone()
+                if row is not None:
+                    now = time.time()
+                    db.execute("UPDATE jobs SET state = 'running', started_at = ?, worker = ?, heartbeat_at = ? "
+                               "WHERE id = ?", (now, self.worker_id, now, row["id"]))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return row
+
+    def _run(self, job: sqlite3.Row):
+        input_path = self._path(job["id"], "inputs")
+        try:
+            with open(input_path, "rb") as file:
+                data = file.read()
+            result = self._handlers[job["kind"]](json.loads(job["params"]), data)
+            if result.content is not None:
+                _write_file(self._path(job["id"], "results"), result.content)
+            update = ("done", int(result.success), result.status, None, result.media_type, json.dumps(result.metadata))
+            self.completed += 1
+        except ValueError as e:
+            # Bad input such as an undecodable image, not a server error
+            logger.warning("Job %s failed: %s", job["id"], e)
+            update = ("failed", 0, None, str(e), None, None)
+            self.failed += 1
+        except Exception as e:
+            logger.error("Job %s failed", job["id"], exc_info=True)
+            update = ("failed", 0, None, str(e), None, None)
+            self.failed += 1
+        finished = time.time()
+        with self._connect() as db:
+            # Only while the job is still ours, it was queued again if our heartbeat stalled for a whole lease
+            updated = db.execute(
+                "UPDATE jobs SET state = ?, success = ?, status = ?, error = ?, media_type = ?, metadata = ?, "
+                "finished_at = ?, expires_at = ? WHERE id = ? AND worker = ?",
+                (*update, finished, finished + self.ttl, job["id"], self.worker_id)
+            ).rowcount
+        if not updated:
+            logger.warning("Job %s was taken over by another worker, dropping this run", job["id"])
+            return
+        _remove_file(input_path)
+
+    def _sweep(self):
+        """Deletes expired jobs and their results and requeues abandoned ones, at most every minute"""
+        now = time.time()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + min(60.0, self.ttl, self.lease)
+        self._requeue_abandoned()
+        with self._connect() as db:
+            expired = [row[0] for row in db.execute("SELECT id FROM jobs WHERE expires_at < ?", (now,))]
+            for job_id in expired:
+                _remove_file(self._path(job_id, "results"))
+            db.execute("DELETE FROM jobs WHERE expires_at < ?", (now,))
+        if expired:
+            logger.info("Removed %d expired jobs", len(expired))
+
+
+def _job_dict(row: sqlite3.Row) -> dict:
+    return {
+        "job_id": row["id"],
+        "kind": row["kind"],
+        "priority": row["priority"],
+        "state": row["state"],
+        "created_at": row["created_at"],
+        "started_at": row["started_at"],
+        "finished_at": row["finished_at"],
+        "expires_at": row["expires_at"],
+        "success": None if row["success"] is None else bool(row["success"]),
+        "status": row["status"],
+        "error": row["error"],
+        "media_type": row["media_type"],
+        "metadata": json.loads(row["metadata"]) if row["metadata"] else {},
+    }
+
+
+def _write_file(path: str, data: bytes):
+    """Writes through a temporary file, so readers never see a partial file"""
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(data)
+    os.replace(temporary, path)
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
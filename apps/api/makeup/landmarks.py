@@ -1,29 +1,247 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
 import cv2
 import numpy as np
-from typing import List, Iterable
-from mediapipe.python.solutions.face_mesh import FaceMesh
+from typing import TYPE_CHECKING, List, Iterable
+
+if TYPE_CHECKING:
+    from mediapipe.python.solutions.face_mesh import FaceMesh
+
+# Number of FaceMesh graphs kept alive per pool. Each instance is only ever used by one thread at a time.
+POOL_SIZE = int(os.environ.get("MAKEUP_FACEMESH_POOL_SIZE", min(4, os.cpu_count() or 1)))
+# Longest image side used for detection, larger images are downscaled first (0 disables).
+# FaceMesh works on 192x192 crops internally, so detecting on full-resolution photos is wasted work.
+DETECTION_MAX_SIDE = int(os.environ.get("MAKEUP_DETECTION_MAX_SIDE", 640))
+# Upper bound on faces detected per image; each face costs one run of the landmark model
+MAX_FACES = int(os.environ.get("MAKEUP_MAX_FACES", 4))
+
+
+def load_face_mesh():
+    """
+    The FaceMesh class, imported on first use: loading MediaPipe takes longer than the rest of the
+    service's imports together, and tests, the benchmark and the offline tools mostly never run detection.
+    """
+    from mediapipe.python.solutions.face_mesh import FaceMesh
+    return FaceMesh
+
+
+class FaceMeshPool:
+    """
+    A pool of long-lived FaceMesh instances.
+    Building a FaceMesh loads the TFLite graph and model, which costs far more than a single inference,
+    so instances are created once and checked out / in around each `process` call.
+    FaceMesh is not thread-safe, hence one instance per concurrent caller.
+    """
+
+    def __init__(self, size: int = POOL_SIZE, static_image_mode: bool = True, max_num_faces: int = 1):
+        self.size = max(1, size)
+        self.static_image_mode = static_image_mode
+        self.max_num_faces = max_num_faces
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _create(self) -> "FaceMesh":
+        return load_face_mesh()(static_image_mode=self.static_image_mode, max_num_faces=self.max_num_faces)
+
+    def _checkout(self, timeout: float = None) -> "FaceMesh":
+        if self._closed:
+            raise RuntimeError("FaceMesh pool has been shut down")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._create()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get(timeout=timeout)
+
+    def _checkin(self, face_mesh: "FaceMesh"):
+        if self._closed:
+            face_mesh.close()
+        else:
+            self._idle.put(face_mesh)
 
+    def _discard(self, face_mesh: "FaceMesh"):
+        with self._lock:
+            self._created -= 1
+        face_mesh.close()
 
-def detect_landmarks(src: np.ndarray, is_stream: bool = False):
+    @contextmanager
+    def acquire(self, timeout: float = None):
+        """
+        Checks out a FaceMesh for the duration of the `with` block.
+        Instances that raised while in use are discarded rather than returned to the pool.
+        """
+        face_mesh = self._checkout(timeout)
+        try:
+            yield face_mesh
+        except Exception:
+            self._discard(face_mesh)
+            raise
+        self._checkin(face_mesh)
+
+    def warmup(self, count: int = None):
+        """
+        Eagerly builds `count` instances (the whole pool by default) and runs one inference on each
+        so the first real requests do not pay for graph construction.
+        """
+        count = self.size if count is None else min(count, self.size)
+        blank = np.zeros((192, 192, 3), dtype=np.uint8)
+        instances = [self._checkout() for _ in range(count)]
+        try:
+            for face_mesh in instances:
+                face_mesh.process(blank)
+        finally:
+            for face_mesh in instances:
+                self._checkin(face_mesh)
+
+    def close(self):
+        """
+        Closes every idle instance; instances still checked out are closed when returned.
+        """
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(is_stream: bool = False, max_num_faces: int = 1) -> FaceMeshPool:
+    """
+    Returns the process-wide pool for the requested mode and face count, creating it on first use
+    """
+    with _pools_lock:
+        pool = _pools.get((is_stream, max_num_faces))
+        if pool is None:
+            pool = _pools[(is_stream, max_num_faces)] = FaceMeshPool(static_image_mode=not is_stream,
+                                                                     max_num_faces=max_num_faces)
+        return pool
+
+
+def warmup(is_stream: bool = False, count: int = None, max_num_faces: int = 1):
+    """
+    Warms up the pool used by `detect_landmarks`, intended to be called at application startup
+    """
+    get_pool(is_stream, max_num_faces).warmup(count)
+
+
+def shutdown():
+    """
+    Releases every pooled FaceMesh, intended to be called at application shutdown
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def pack_landmarks(landmarks) -> np.ndarray:
+    """
+    Converts a sequence of mediapipe landmark objects into a compact float32 (N, 3) array of (x, y, z),
+    so the protobuf objects are walked exactly once per detection
+    """
+    return np.array([(landmark.x, landmark.y, landmark.z) for landmark in landmarks], dtype=np.float32)
+
+
+def detection_input(src: np.ndarray, max_side: int = DETECTION_MAX_SIDE) -> np.ndarray:
+    """
+    Returns the RGB image fed to FaceMesh: `src` downscaled so its longest side is at most `max_side`.
+    The aspect ratio is kept, so normalized landmark coordinates are valid for the original image.
+    """
+    height, width = src.shape[:2]
+    longest = max(height, width)
+    if max_side and longest > max_side:
+        scale = max_side / longest
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        src = cv2.resize(src, size, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(src, cv2.COLOR_BGR2RGB)
+
+
+def detect_landmarks(src: np.ndarray, is_stream: bool = False, max_side: int = DETECTION_MAX_SIDE):
     """
     Given an image `src` retrieves the facial landmarks associated with it
+    as a packed float32 (N, 3) array of coordinates in [0, 1]
+    Detection runs on a copy downscaled to `max_side`, rendering can still use the full resolution image
+    """
+    with get_pool(is_stream).acquire() as face_mesh:
+        return process_landmarks(face_mesh, src, max_side)
+
+
+def detect_faces(src: np.ndarray, max_faces: int = 1, is_stream: bool = False,
+                 max_side: int = DETECTION_MAX_SIDE) -> List[np.ndarray]:
+    """
+    Like `detect_landmarks` for up to `max_faces` faces (capped at MAX_FACES).
+    Returns one packed landmark array per face, largest face first; empty when no face is found.
     """
-    with FaceMesh(static_image_mode=not is_stream, max_num_faces=1) as face_mesh:
-        results = face_mesh.process(cv2.cvtColor(src, cv2.COLOR_BGR2RGB))
+    max_faces = max(1, min(max_faces, MAX_FACES))
+    with get_pool(is_stream, max_faces).acquire() as face_mesh:
+        return process_faces(face_mesh, src, max_side)
+
+
+def create_tracker(max_num_faces: int = 1) -> "FaceMesh":
+    """
+    A FaceMesh in tracking mode for a single video stream. It carries state from frame to frame,
+    so it must not be pooled or shared between streams; close it when the stream ends.
+    """
+    return load_face_mesh()(static_image_mode=False, max_num_faces=max_num_faces)
+
+
+def process_landmarks(face_mesh: "FaceMesh", src: np.ndarray, max_side: int = DETECTION_MAX_SIDE):
+    """
+    Runs a specific FaceMesh instance on `src`, see `detect_landmarks`
+    """
+    results = face_mesh.process(detection_input(src, max_side))
     if results.multi_face_landmarks:
-        return results.multi_face_landmarks[0].landmark
+        return pack_landmarks(results.multi_face_landmarks[0].landmark)
     return None
 
 
-def normalize_landmarks(landmarks, height: int, width: int, mask: Iterable = None):
+def process_faces(face_mesh: "FaceMesh", src: np.ndarray, max_side: int = DETECTION_MAX_SIDE) -> List[np.ndarray]:
+    """
+    Runs a specific FaceMesh instance on `src` and returns every face it found, see `detect_faces`
+    """
+    results = face_mesh.process(detection_input(src, max_side))
+    faces = [pack_landmarks(face.landmark) for face in results.multi_face_landmarks or []]
+    return sorted(faces, key=face_area, reverse=True)
+
+
+def face_area(landmarks: np.ndarray) -> float:
+    """Area of the landmarks' bounding box in normalized coordinates"""
+    extent = landmarks[:, :2].max(axis=0) - landmarks[:, :2].min(axis=0)
+    return float(extent[0] * extent[1])
+
+
+def normalize_landmarks(landmarks: np.ndarray, height: int, width: int, mask: Iterable = None):
     """
     The landmarks returned by mediapipe have coordinates between [0, 1].
     This function normalizes them in the range of the image dimensions so they can be played with.
+    `landmarks` is the packed array returned by `detect_landmarks`; subsetting, scaling and truncation
+    to integer pixels happen in a single vectorized expression. Scaling is done in float64, as
+    `int(x * width)` on Python floats does, so the pixels are exactly the same.
     """
-    normalized_landmarks = np.array([(int(landmark.x * width), int(landmark.y * height)) for landmark in landmarks])
-    if mask:
-        normalized_landmarks = normalized_landmarks[mask]
-    return normalized_landmarks
+    points = landmarks[:, :2] if mask is None else landmarks[np.asarray(mask), :2]
+    return (points * np.array([width, height], dtype=np.float64)).astype(np.int32)
 
 
 def plot_landmarks(src: np.array, landmarks: List, show: bool = False):
@@ -32,7 +250,7 @@ def plot_landmarks(src: np.array, landmarks: List, show: bool = False):
     """
     dst = src.copy()
     for x, y in landmarks:
-        cv2.circle(dst, (x, y), 2, 0, cv2.FILLED)
+        cv2.circle(dst, (int(x), int(y)), 2, 0, cv2.FILLED)
     if show:
         print("Displaying image plotted with landmarks")
         cv2.imshow("Plotted Landmarks", dst)
@@ -4,32 +4,77 @@ FastAPI Makeup Try-On Service
 Provides REST API endpoints for virtual makeup application
 """
 
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from fastapi import (FastAPI, File, UploadFile, Form, HTTPException, Header, Query, Response, WebSocket,
+                     WebSocketDisconnect)
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
-from pydantic import BaseModel, Field
-from typing import Optional, List
-import cv2
+from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.websockets import WebSocketState
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError, model_validator
+from typing import Optional, List, Literal
+from contextlib import asynccontextmanager
 import numpy as np
-from PIL import Image
+import asyncio
 import io
-import base64
+import json
+import os
+import shutil
+import tempfile
+import threading
 import logging
-
-from landmarks import detect_landmarks, normalize_landmarks
-from utils import gamma_correction, mask_skin
+import time
+import uuid
+import zipfile
+
+import landmarks as landmark_engine
+import metrics
+from buffers import buffer_pool
+from cache import CachedLandmarks, CachedResult, content_key, landmark_cache, result_cache, result_key
+from encoding import (DEFAULT_OUTPUT_FORMAT, DEFAULT_PNG_COMPRESSION, DEFAULT_QUALITY, OUTPUT_FORMATS, data_uri,
+                      encode_image_to_base64, media_type, negotiate_output)
+from executor import PipelineExecutor, ExecutorSaturated
+from jobs import PRIORITIES, JobQueue, JobQueueFull, JobResult
+from landmarks import MAX_FACES, detect_faces
+from metrics import ServerTimingMiddleware, Timings, record_face, request_timings
+from render import (BLUSH_COLORS, FOUNDATION_PRESETS, LIPSTICK_COLORS, PREVIEW_QUALITY, MakeupConfig, OutputOptions,
+                    RenderContext, compile_look, face_info, preview_frame, render_makeup, shutdown_face_pool)
+from tracking import KEYFRAME_INTERVAL, LandmarkTracker
+from uploads import MAX_UPLOAD_BYTES, UploadLimitMiddleware, decode_base64, decode_image, fit_to_max_side
+from video import VIDEO_FORMATS, VIDEO_MAX_UPLOAD_BYTES, render_video
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+executor = PipelineExecutor()
+job_queue = JobQueue()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warm up the FaceMesh pool and pipeline executor before serving and release them on shutdown"""
+    if executor.mode == "thread":
+        logger.info("Warming up FaceMesh pool (%d instances)...", landmark_engine.POOL_SIZE)
+        landmark_engine.warmup()
+    if executor.mode == "process" and not landmark_cache.shared:
+        logger.warning("Landmark tokens are only known to the executor process that issued them, "
+                       "set MAKEUP_LANDMARK_CACHE_DIR to share them")
+    executor.start()
+    job_queue.start()
+    yield
+    logger.info("Shutting down job workers, pipeline executor and FaceMesh pool")
+    job_queue.shutdown()
+    executor.shutdown()
+    shutdown_face_pool()
+    landmark_engine.shutdown()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Makeup Try-On API",
     description="Virtual makeup application service using MediaPipe FaceMesh",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    lifespan=lifespan
 )
 
 # Configure CORS
@@ -39,176 +84,481 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Processing-Time", "X-Landmark-Token", "X-Face-Count"],
 )
+# Server-Timing header and latency histograms for /api/makeup/*
+app.add_middleware(ServerTimingMiddleware, prefix="/api/makeup")
+# Rejects oversized bodies with 413 while they stream in
+app.add_middleware(UploadLimitMiddleware, max_bytes=MAX_UPLOAD_BYTES, prefix="/api/makeup",
+                   path_limits={"/api/makeup/video": VIDEO_MAX_UPLOAD_BYTES})
 
-# ----------------------------
-# Color presets
-# ----------------------------
-
-LIPSTICK_COLORS = {
-    "Red": (0, 0, 255),
-    "Pink": (203, 192, 255),
-    "Burgundy": (75, 0, 130),
-    "Orange": (0, 165, 255),
-    "Nude": (180, 140, 200),
-    "Wine": (0, 0, 120),
-    "Coral": (100, 165, 255),
-}
-
-BLUSH_COLORS = {
-    "Coral": (66, 135, 245),
-    "Pink": (192, 135, 220),
-    "Peach": (152, 165, 255),
-    "Rose": (100, 70, 200),
-    "Berry": (140, 50, 150),
-    "Apricot": (140, 140, 230),
-}
-
-FOUNDATION_PRESETS = {
-    "Low": {"intensity": 0.2, "gamma": 1.15, "warm_shift": 0.0},
-    "Medium": {"intensity": 0.35, "gamma": 1.3, "warm_shift": 0.0},
-    "High": {"intensity": 0.5, "gamma": 1.45, "warm_shift": 0.0},
-    "Warm": {"intensity": 0.35, "gamma": 1.3, "warm_shift": 0.08},
-}
-
-# Landmark indices
-UPPER_LIP = [61, 185, 40, 39, 37, 0, 267, 269, 270, 408, 415, 272, 271, 268, 12, 38, 41, 42, 191, 78, 76]
-LOWER_LIP = [61, 146, 91, 181, 84, 17, 314, 405, 320, 307, 308, 324, 318, 402, 317, 14, 87, 178, 88, 95]
-CHEEKS = [425, 205]
+# Upper bound on looks rendered by a single /api/makeup/apply-batch request
+BATCH_MAX_VARIANTS = int(os.environ.get("MAKEUP_BATCH_MAX_VARIANTS", 64))
+# Concurrent /ws/makeup/stream connections per worker, each holds its own landmark tracker and FaceMesh
+STREAM_MAX_CONNECTIONS = int(os.environ.get("MAKEUP_STREAM_MAX_CONNECTIONS", 8))
 
 # ----------------------------
 # Pydantic Models
 # ----------------------------
 
-class MakeupConfig(BaseModel):
-    apply_lipstick: bool = Field(default=True, description="Apply lipstick effect")
-    lipstick_color: str = Field(default="Red", description="Lipstick color")
-    apply_blush: bool = Field(default=True, description="Apply blush effect")
-    blush_color: str = Field(default="Pink", description="Blush color")
-    blush_intensity: int = Field(default=50, ge=0, le=100, description="Blush intensity (0-100)")
-    apply_foundation: bool = Field(default=True, description="Apply foundation effect")
-    foundation_preset: str = Field(default="Medium", description="Foundation preset")
+class Base64Request(BaseModel):
+    image_base64: Optional[str] = Field(default=None, description="Base64 image, bare or as a data URI")
+    landmark_token: Optional[str] = Field(default=None, description="Token from an earlier response for the same image")
+    max_faces: int = Field(default=1, ge=1, le=MAX_FACES, description="Most faces to render, largest first")
+    config: MakeupConfig = Field(default_factory=MakeupConfig)
+    output: OutputOptions = Field(default_factory=OutputOptions)
+
+    @model_validator(mode="before")
+    @classmethod
+    def accept_bare_config(cls, data):
+        """Older clients send the MakeupConfig itself as the body"""
+        if isinstance(data, dict) and data and set(data) <= set(MakeupConfig.model_fields):
+            return {"config": data}
+        return data
 
 class ColorInfo(BaseModel):
     lipstick: List[str]
     blush: List[str]
     foundation: List[str]
 
+class FaceInfo(BaseModel):
+    index: int
+    box: List[int] = Field(description="Bounding box in pixels of the result image: [x, y, width, height]")
+
 class ProcessResponse(BaseModel):
     success: bool
     image: Optional[str] = None
     status: str
     processing_time_ms: Optional[int] = None
+    landmark_token: Optional[str] = None
+    faces: List[FaceInfo] = []
 
-# ----------------------------
-# Helper functions
-# ----------------------------
-
-def decode_base64_image(image_str: str) -> Image.Image:
-    """Decode a base64 image string to PIL.Image"""
-    if image_str.startswith("data:image"):
-        image_str = image_str.split(",")[1]
-    image_bytes = base64.b64decode(image_str)
-    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-    return image
-
-def encode_image_to_base64(image: np.ndarray) -> str:
-    """Encode numpy image to base64 string"""
-    # Convert BGR to RGB if needed
-    if len(image.shape) == 3 and image.shape[2] == 3:
-        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    else:
-        image_rgb = image
-
-    # Convert to PIL Image
-    pil_image = Image.fromarray(image_rgb)
-
-    # Encode to base64
-    buffer = io.BytesIO()
-    pil_image.save(buffer, format="PNG", quality=95)
-    image_base64 = base64.b64encode(buffer.getvalue()).decode()
-
-    return f"data:image/png;base64,{image_base64}"
-
-def apply_lipstick(image: np.ndarray, color_rgb: tuple, landmarks, alpha: float = 0.4) -> np.ndarray:
-    """Apply lipstick to the image"""
-    if landmarks is None:
-        return image
-
-    h, w = image.shape[:2]
-    mask = np.zeros_like(image)
-    lip_points = normalize_landmarks(landmarks, h, w, UPPER_LIP + LOWER_LIP)
-
-    if len(lip_points) > 0:
-        lip_points = lip_points.astype(np.int32)
-        cv2.fillPoly(mask, [lip_points], color_rgb)
-        mask = cv2.GaussianBlur(mask, (15, 15), 3)
-
-    return cv2.addWeighted(image, 1.0, mask, alpha, 0)
-
-def apply_blush(image: np.ndarray, color_rgb: tuple, landmarks, intensity: float = 0.3, radius: int = 40) -> np.ndarray:
-    """Apply blush to the image"""
-    if landmarks is None:
-        return image
-
-    h, w = image.shape[:2]
-    mask = np.zeros_like(image)
-    cheek_points = normalize_landmarks(landmarks, h, w, CHEEKS)
-
-    for point in cheek_points:
-        x, y = int(point[0]), int(point[1])
-        y_min, y_max = max(0, y-radius), min(h, y+radius+1)
-        x_min, x_max = max(0, x-radius), min(w, x+radius+1)
+class BatchVariant(BaseModel):
+    index: int
+    filename: Optional[str] = None
+    status: str
 
-        yy, xx = np.ogrid[y_min:y_max, x_min:x_max]
-        dist = np.sqrt((yy - y)**2 + (xx - x)**2)
+class BatchManifest(BaseModel):
+    success: bool
+    status: str
+    landmark_token: Optional[str] = None
+    processing_time_ms: Optional[int] = None
+    faces: List[FaceInfo] = []
+    variants: List[BatchVariant] = []
+
+class JobInfo(BaseModel):
+    job_id: str
+    kind: Literal["apply", "batch"]
+    priority: Literal[PRIORITIES]
+    state: Literal["queued", "running", "done", "failed"]
+    position: Optional[int] = Field(default=None, description="Jobs ahead of this one while queued")
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    expires_at: Optional[float] = None
+    success: Optional[bool] = None
+    status: Optional[str] = None
+    error: Optional[str] = None
+    result_url: Optional[str] = None
+    landmark_token: Optional[str] = None
+    faces: List[FaceInfo] = []
+
+class StreamUpdate(BaseModel):
+    config: Optional[MakeupConfig] = None
+    output: Optional[OutputOptions] = None
+
+class CacheStats(BaseModel):
+    entries: int
+    bytes: int
+    hits: int
+    disk_hits: int
+    misses: int
+    evictions: int
+    hit_rate: float
+    disk_files: int
+    disk_bytes: int
 
-        gradient = np.zeros_like(dist, dtype=np.float32)
-        valid = dist <= radius
-        gradient[valid] = (1.0 + np.cos(np.pi * dist[valid] / radius)) / 2.0
+# ----------------------------
+# Pipeline
+# ----------------------------
 
-        for c in range(3):
-            color_val = color_rgb[c]
-            mask[y_min:y_max, x_min:x_max, c] = np.maximum(
-                mask[y_min:y_max, x_min:x_max, c],
-                (color_val * gradient).astype(np.uint8)
-            )
+class UnknownLandmarkToken(LookupError):
+    """Raised when a landmark_token is unknown or expired and no image was sent along with it"""
 
-    blur_rad = max(3, radius // 3)
-    if blur_rad % 2 == 0:
-        blur_rad += 1
-    mask = cv2.GaussianBlur(mask, (blur_rad, blur_rad), blur_rad // 2)
+def cached_faces(entry: CachedLandmarks, max_faces: int):
+    """
+    The faces of a landmark cache entry if its detection covers `max_faces`: it searched for at least as
+    many faces, or found fewer than it searched for. None when detection has to run again.
+    """
+    if max_faces <= entry.searched or len(entry.faces) < entry.searched:
+        return entry.faces[:max_faces]
+    return None
 
-    alpha = intensity * 0.5
-    return cv2.addWeighted(image, 1.0, mask, alpha, 0)
+def detect_and_cache(key: str, source: bytes, img: np.ndarray, max_side: Optional[int], max_faces: int,
+                     timings: Timings):
+    """
+    Detects up to `max_faces` faces in `img`, decoded from `source` to fit `max_side`, and caches them under `key`
+    """
+    logger.info("Detecting facial landmarks...")
+    with timings.stage("landmarks"):
+        faces = detect_faces(img, max_faces)
+    landmark_cache.put(key, CachedLandmarks(faces, max_faces, source, img, max_side))
+    return faces
+
+def load_image(contents: Optional[bytes], landmark_token: Optional[str], max_side: Optional[int] = None,
+               timings: Timings = None, max_faces: int = 1):
+    """
+    Resolve the image and up to `max_faces` faces to render on, preferring a cached landmark_token over the
+    sent `contents`. Landmarks are cached by the content hash of the upload, which is the landmark_token
+    returned: uploading the same image again skips detection, sending the token skips decoding too.
+    With `max_side` JPEGs are decoded at reduced scale and the image is downscaled to fit, landmarks
+    being normalized coordinates stay valid. A cached image smaller than the request asks for is decoded
+    again from the cached upload. Returns (img, faces, landmark_token).
+    """
+    timings = timings or Timings()
+    with timings.stage("cache"):
+        entry = landmark_cache.get(landmark_token) if landmark_token else None
+        if entry is None:
+            if not contents:
+                raise UnknownLandmarkToken("Unknown or expired landmark_token, please upload the image again")
+            landmark_token = content_key(contents)
+            entry = landmark_cache.get(landmark_token)
+
+    if entry is None:
+        with timings.stage("decode"):
+            img = decode_image(contents, max_side)
+        faces = detect_and_cache(landmark_token, contents, img, max_side, max_faces, timings)
+        return img, faces, landmark_token
+
+    img, decoded_side = entry.image, entry.max_side
+    if not entry.covers(max_side):
+        # Read back from the disk tier, written by another process, or decoded for a smaller output:
+        # decode the upload it was detected in
+        with timings.stage("decode"):
+            img = decode_image(entry.source, max_side)
+        decoded_side = max_side
+        landmark_cache.put(landmark_token,
+                           CachedLandmarks(entry.faces, entry.searched, entry.source, img, decoded_side), persist=False)
+    faces = cached_faces(entry, max_faces)
+    if faces is None:
+        # Cached with a lower face limit, detect again on the cached image
+        faces = detect_and_cache(landmark_token, entry.source, img, decoded_side, max_faces, timings)
+    return fit_to_max_side(img, max_side), faces, landmark_token
+
+
+def result_keys(params: tuple, upload_key: Optional[str], landmark_token: Optional[str]) -> List[str]:
+    """
+    Result cache keys of a rendered image, by the landmark token of its source image and by the content
+    hash of the uploaded bytes, whichever are known. `params` is everything else that changes the output.
+    """
+    keys = []
+    if landmark_token:
+        keys.append(result_key(f"token:{landmark_token}", *params))
+    if upload_key:
+        keys.append(result_key(f"upload:{upload_key}", *params))
+    return keys
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Whether an If-None-Match header lists `etag`, compared weakly as HTTP prescribes for this header"""
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    return any((tag[2:] if tag.startswith("W/") else tag) == opaque
+               for tag in (tag.strip() for tag in if_none_match.split(",")))
+
+def record_effects(config: MakeupConfig):
+    """Counts the effects of one rendered look, by the shade actually used"""
+    for effect, shade in compile_look(config).shades:
+        metrics.effects_total.inc(effect, shade)
+
+def process_upload(contents: Optional[bytes], config: MakeupConfig, output_options: OutputOptions,
+                   return_base64: bool = True, landmark_token: Optional[str] = None, max_faces: int = 1):
+    """
+    Full pipeline for an uploaded image file: decode, render up to `max_faces` faces and encode.
+    A known landmark_token skips both decoding and detection.
+    Runs on the pipeline executor, so everything it takes and returns must be picklable.
+    Returns (status, image, landmark_token, faces, timings) where image is None when no face was detected
+    and faces describes every rendered face.
+    """
+    timings = Timings()
+    img, faces, landmark_token = load_image(contents, landmark_token, output_options.max_side, timings, max_faces)
+    # The rendered frame only lives until it is encoded
+    with buffer_pool.borrow(img.shape) as out:
+        output, _ = render_makeup(img, config, faces, timings=timings, out=out)
+        if output is None:
+            return "No face detected in the image", None, None, [], timings
+
+        status = compile_look(config).status
+        with timings.stage("encode"):
+            image = output_options.encode_to_base64(output) if return_base64 else output_options.encode(output)
+    return status, image, landmark_token, face_info(img, faces), timings
+
+def process_preview(contents: Optional[bytes], config: MakeupConfig, output_options: OutputOptions,
+                    landmark_token: Optional[str] = None, max_faces: int = 1):
+    """
+    First half of a progressive render: decode, detect and render the look on a copy downscaled to
+    `PREVIEW_MAX_SIDE`, encoded as a quick JPEG data URI. The landmarks are cached under the returned
+    landmark_token, so the full-resolution `process_upload` that follows skips decoding and detection.
+    Returns (status, preview, landmark_token, faces, timings); preview is None when no face was detected
+    or the image is no larger than a preview, faces is empty when no face was detected.
+    """
+    timings = Timings()
+    img, faces, landmark_token = load_image(contents, landmark_token, output_options.max_side, timings, max_faces)
+    if not faces:
+        return "No face detected in the image", None, None, [], timings
+
+    status = compile_look(config).status
+    preview = None
+    small = preview_frame(img)
+    if small is not None:
+        with timings.stage("preview"):
+            output, _ = render_makeup(small, config, faces)
+            preview = encode_image_to_base64(output, "jpeg", PREVIEW_QUALITY)
+    return status, preview, landmark_token, face_info(img, faces), timings
+
+def process_base64(image_base64: Optional[str], config: MakeupConfig, output_options: OutputOptions,
+                   landmark_token: Optional[str] = None, max_faces: int = 1):
+    """
+    Full pipeline for a base64 encoded image: decode, render up to `max_faces` faces and encode back to base64.
+    A known landmark_token skips both decoding and detection.
+    Returns (status, image, landmark_token, faces, timings) where image is None when no face was detected.
+    """
+    timings = Timings()
+    contents = None
+    if image_base64 and not (landmark_token and landmark_token in landmark_cache):
+        with timings.stage("decode"):
+            contents = decode_base64(image_base64)
+    img, faces, landmark_token = load_image(contents, landmark_token, output_options.max_side, timings, max_faces)
+    with buffer_pool.borrow(img.shape) as out:
+        output, _ = render_makeup(img, config, faces, timings=timings, out=out)
+        if output is None:
+            return "No face detected in the image", None, None, [], timings
+
+        status = compile_look(config).status
+        with timings.stage("encode"):
+            image = output_options.encode_to_base64(output)
+    return status, image, landmark_token, face_info(img, faces), timings
+
+def process_batch(contents: Optional[bytes], configs: List[MakeupConfig], output_options: OutputOptions,
+                  landmark_token: Optional[str] = None, max_faces: int = 1):
+    """
+    Renders several looks on up to `max_faces` faces of one image. Decoding, landmark detection,
+    lip/cheek geometry, the skin mask and the foundation frame of each preset are computed once and
+    shared by all variants.
+    Returns (status, landmark_token, [(status, encoded image)], faces, timings), the list is empty when
+    no face was detected.
+    """
+    timings = Timings()
+    img, faces, landmark_token = load_image(contents, landmark_token, output_options.max_side, timings, max_faces)
+    if not faces:
+        return "No face detected in the image", None, [], [], timings
+
+    with timings.stage("geometry"):
+        context = RenderContext(img, faces)
+    looks = [compile_look(config) for config in configs]
+    # The cached foundation frame only pays off when a preset is used by more than one variant
+    presets = [look.foundation_preset for look in looks]
+    variants = []
+    # Every variant is encoded before the next one is rendered, so they can share one output buffer
+    try:
+        with buffer_pool.borrow(img.shape) as out:
+            for config, look in zip(configs, looks):
+                reuse = look.foundation_preset is not None and presets.count(look.foundation_preset) > 1
+                output, _ = render_makeup(img, config, faces, context, reuse_foundation=reuse, timings=timings,
+                                          out=out)
+                with timings.stage("encode"):
+                    variants.append((look.status, output_options.encode(output)))
+    finally:
+        context.close()
+
+    return f"Rendered {len(variants)} variants", landmark_token, variants, face_info(img, faces), timings
+
+def batch_manifest(status: str, landmark_token: str, variants, faces, output_options: OutputOptions,
+                   processing_time: int):
+    """The manifest of a rendered batch and its images, in variant order"""
+    extension = OUTPUT_FORMATS[output_options.output_format][0]
+    manifest = BatchManifest(
+        success=True,
+        status=status,
+        landmark_token=landmark_token,
+        processing_time_ms=processing_time,
+        faces=faces,
+        variants=[
+            BatchVariant(index=i, filename=f"variant-{i:03d}{extension}", status=variant_status)
+            for i, (variant_status, _) in enumerate(variants)
+        ]
+    )
+    return manifest, [image for _, image in variants]
 
-def apply_foundation(image: np.ndarray, preset_name: str = "Medium") -> np.ndarray:
-    """Apply foundation to the image"""
+def zip_batch(manifest: BatchManifest, images: List[bytes]) -> bytes:
+    """Stores the rendered variants and a manifest.json in an uncompressed zip archive"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+        archive.writestr("manifest.json", manifest.model_dump_json())
+        for variant, image in zip(manifest.variants, images):
+            archive.writestr(variant.filename, image)
+    return buffer.getvalue()
+
+def multipart_batch(manifest: BatchManifest, images: List[bytes], image_type: str, boundary: str):
+    """Yields a multipart/mixed body: the JSON manifest followed by one part per variant"""
+    yield (f"--{boundary}\r\nContent-Type: application/json\r\n\r\n").encode()
+    yield manifest.model_dump_json().encode()
+    for variant, image in zip(manifest.variants, images):
+        yield (
+            f"\r\n--{boundary}\r\n"
+            f"Content-Type: {image_type}\r\n"
+            f'Content-Disposition: attachment; filename="{variant.filename}"\r\n'
+            f"Content-Length: {len(image)}\r\n\r\n"
+        ).encode()
+        yield image
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+def run_apply_job(params: dict, contents: bytes) -> JobResult:
+    """Job handler for a single look, see `process_upload`"""
+    config, output_options = MakeupConfig(**params["config"]), OutputOptions(**params["output"])
+    status, image, landmark_token, faces, timings = process_upload(
+        contents, config, output_options, False, None, params["max_faces"]
+    )
+    timings.observe()
+    record_face(image is not None)
     if image is None:
-        return image
-
-    preset = FOUNDATION_PRESETS.get(preset_name, FOUNDATION_PRESETS["Medium"])
-    intensity, gamma_val, warm_shift = preset["intensity"], preset["gamma"], preset["warm_shift"]
+        return JobResult(False, status)
+    record_effects(config)
+    return JobResult(True, status, image, media_type(output_options.output_format),
+                     {"landmark_token": landmark_token, "faces": faces})
 
-    skin_mask_binary = mask_skin(image)
-    if skin_mask_binary.ndim == 3:
-        skin_mask_binary = skin_mask_binary[:, :, 0]
-
-    corrected = gamma_correction(image, gamma_val, coefficient=1)
-
-    if warm_shift > 0:
-        corrected = corrected.astype(np.float32)
-        corrected[:, :, 2] = np.clip(corrected[:, :, 2] * (1.0 + warm_shift), 0, 255)
-        corrected = corrected.astype(np.uint8)
+def run_batch_job(params: dict, contents: bytes) -> JobResult:
+    """Job handler for several looks on one image, the result is the zip archive of `/api/makeup/apply-batch`"""
+    start_time = time.time()
+    configs = [MakeupConfig(**config) for config in params["configs"]]
+    output_options = OutputOptions(**params["output"])
+    status, landmark_token, variants, faces, timings = process_batch(
+        contents, configs, output_options, None, params["max_faces"]
+    )
+    timings.observe()
+    record_face(bool(variants))
+    if not variants:
+        return JobResult(False, status)
+    for config in configs:
+        record_effects(config)
+    manifest, images = batch_manifest(status, landmark_token, variants, faces, output_options,
+                                      int((time.time() - start_time) * 1000))
+    return JobResult(True, status, zip_batch(manifest, images), "application/zip",
+                     {"landmark_token": landmark_token, "faces": faces})
+
+job_queue.register("apply", run_apply_job)
+job_queue.register("batch", run_batch_job)
+
+def job_info(job: dict) -> JobInfo:
+    metadata = job.pop("metadata")
+    result_url = f"/api/makeup/jobs/{job['job_id']}/result" if job["media_type"] else None
+    return JobInfo(**job, result_url=result_url, **metadata)
+
+class StreamSession:
+    """
+    State of one /ws/makeup/stream connection: a landmark tracker that runs FaceMesh on keyframes and
+    follows the faces with optical flow in between (see `tracking.py`), plus frame counters.
+    Rendering and closing are serialized by a lock because the tracker is used from executor threads.
+    Output frames are borrowed from the buffer pool for the time of one frame, so idle connections hold none.
+    """
 
-    output = image.copy()
-    skin_pixels = skin_mask_binary > 0
-    output[skin_pixels] = cv2.addWeighted(
-        image[skin_pixels], 1.0 - intensity,
-        corrected[skin_pixels], intensity, 0
+    def __init__(self, max_faces: int = 1, keyframe_interval: int = KEYFRAME_INTERVAL):
+        self.tracker = LandmarkTracker(max_faces, keyframe_interval)
+        self.config = MakeupConfig()
+        self.output_options = OutputOptions()
+        self.frames = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def render(self, frame: bytes, config: MakeupConfig, output_options: OutputOptions) -> bytes:
+        """Decode a frame, track the face, apply the look and encode the result"""
+        timings = Timings()
+        with timings.stage("decode"):
+            try:
+                img = decode_image(frame, output_options.max_side)
+            except ValueError:
+                raise ValueError("Invalid frame")
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Stream closed")
+            start = time.perf_counter()
+            faces = self.tracker.process(img)
+            # Tracked frames get their own stage, so the histogram shows what skipping detection saves
+            timings.add("landmarks" if self.tracker.detected else "tracking", time.perf_counter() - start)
+            metrics.stream_landmark_frames_total.inc("detected" if self.tracker.detected else "tracked")
+        with buffer_pool.borrow(img.shape) as out:
+            output, _ = render_makeup(img, config, faces, timings=timings, out=out)
+            with timings.stage("encode"):
+                encoded = output_options.encode(img if output is None else output)
+        self.frames += 1
+        timings.observe()
+        record_face(bool(faces))
+        if faces:
+            record_effects(config)
+        return encoded
+
+    def stats(self) -> dict:
+        return {"frames": self.frames, "dropped": self.dropped,
+                "detection_skipped": round(self.tracker.skipped_fraction, 3)}
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self.tracker.close()
+
+def saturated_response(error: ExecutorSaturated) -> HTTPException:
+    """503 telling the client when to retry"""
+    logger.warning("Rejecting request: pipeline saturated (%d queued)", executor.queued)
+    return HTTPException(
+        status_code=503,
+        detail="Server is busy, please retry shortly",
+        headers={"Retry-After": str(error.retry_after)}
     )
 
-    return output.astype(np.uint8)
+async def run_pipeline(fn, *args):
+    """
+    Runs a `process_*` pipeline function on the executor and merges the stage timings it returns into
+    the current request's timings. Time not covered by any stage is recorded as "queue": waiting for
+    a worker, plus pickling in process mode.
+    Returns the pipeline result without the timings.
+    """
+    start = time.perf_counter()
+    *result, timings = await executor.run(fn, *args)
+    elapsed = time.perf_counter() - start
+    request = request_timings()
+    request.add("queue", max(0.0, elapsed - sum(timings.stages.values())))
+    request.merge(timings)
+    return result
+
+def executor_gauge(attribute: str):
+    return lambda: getattr(executor, attribute)
+
+metrics.register_gauge("makeup_executor_queue_depth", "Jobs waiting for a pipeline worker", executor_gauge("queued"))
+metrics.register_gauge("makeup_executor_in_flight", "Jobs running on a pipeline worker", executor_gauge("in_flight"))
+metrics.register_gauge("makeup_active_streams", "Open /ws/makeup/stream connections", lambda: active_streams)
+metrics.register_gauge("makeup_landmark_cache_entries", "Images held by the landmark cache",
+                       lambda: landmark_cache.stats()["entries"])
+metrics.register_gauge("makeup_result_cache_memory_bytes", "Image bytes held by the rendered-result cache in memory",
+                       lambda: result_cache.stats()["bytes"])
+metrics.register_gauge("makeup_result_cache_disk_bytes", "Bytes of rendered-result cache files on disk",
+                       lambda: result_cache.stats()["disk_bytes"])
+metrics.register_gauge("makeup_jobs_queued", "Jobs waiting for a job worker",
+                       lambda: job_queue.counts().get("queued", 0))
+metrics.register_gauge("makeup_jobs_running", "Jobs running on a job worker",
+                       lambda: job_queue.counts().get("running", 0))
+
+def buffer_pool_gauge(key: str):
+    return lambda: buffer_pool.stats()[key]
+
+metrics.register_gauge("makeup_buffer_pool_idle_bytes", "Bytes of idle frame buffers kept for reuse",
+                       buffer_pool_gauge("idle_bytes"))
+metrics.register_gauge("makeup_buffer_pool_in_use_bytes", "Bytes of frame buffers borrowed by renders",
+                       buffer_pool_gauge("in_use_bytes"))
+metrics.register_gauge("makeup_buffer_pool_high_water_bytes", "Most bytes of frame buffers held at once",
+                       buffer_pool_gauge("high_water_bytes"))
+metrics.register_gauge("makeup_buffer_pool_reuse_ratio", "Fraction of frame buffer requests served by a reused buffer",
+                       buffer_pool_gauge("reuse_rate"))
 
 # ----------------------------
 # API Endpoints
@@ -223,7 +573,15 @@ async def root():
         "status": "running",
         "endpoints": {
             "POST /api/makeup/apply": "Apply makeup to an image",
+            "POST /api/makeup/apply-batch": "Apply several makeup looks to one image",
+            "POST /api/makeup/jobs": "Queue a makeup job for large images or bulk batches",
+            "GET /api/makeup/jobs/{job_id}": "Job status",
+            "GET /api/makeup/jobs/{job_id}/result": "Job result",
+            "POST /api/makeup/video": "Apply makeup to every frame of a video clip",
+            "WS /ws/makeup/stream": "Live video makeup try-on",
             "GET /api/makeup/colors": "Get available colors",
+            "GET /api/makeup/cache": "Landmark cache statistics",
+            "GET /metrics": "Prometheus metrics",
             "GET /health": "Health check"
         }
     }
@@ -242,9 +600,96 @@ async def get_colors():
         foundation=list(FOUNDATION_PRESETS.keys())
     )
 
+@app.get("/api/makeup/cache", response_model=CacheStats)
+async def get_cache_stats():
+    """Landmark cache hit/miss counters"""
+    return CacheStats(**landmark_cache.stats())
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics: stage and request latency histograms, effect and face counters, queue gauges"""
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+async def render_result(contents: Optional[bytes], config: MakeupConfig, output_options: OutputOptions,
+                        landmark_token: Optional[str], max_faces: int, params: tuple, upload_key: Optional[str]):
+    """
+    Renders an apply request on the pipeline executor and stores the result in the result cache.
+    Returns (result, status), result is None when no face was detected.
+    """
+    status, image, landmark_token, faces = await run_pipeline(
+        process_upload, contents, config, output_options, False, landmark_token, max_faces
+    )
+    if image is None:
+        return None, status
+    result = CachedResult(image, landmark_token, faces)
+    with request_timings().stage("cache"):
+        await asyncio.to_thread(result_cache.put, result_keys(params, upload_key, landmark_token), result)
+    return result, status
+
+def sse_event(event: str, data: str) -> bytes:
+    return f"event: {event}\ndata: {data}\n\n".encode()
+
+async def progressive_response(start_time: float, result: Optional[CachedResult], contents: Optional[bytes],
+                               config: MakeupConfig, output_options: OutputOptions, landmark_token: Optional[str],
+                               max_faces: int, params: tuple, upload_key: Optional[str]) -> StreamingResponse:
+    """
+    Server-sent events for a progressive apply: a `preview` event with the look rendered on a downscaled
+    copy as soon as it is ready, then a `result` event with the full-resolution render, both carrying a
+    ProcessResponse. The full render reuses the landmarks detected for the preview through the landmark
+    cache. A cached `result`, or an image no larger than a preview, is sent alone. The preview is rendered
+    before the response starts so that its errors still get a status code; later errors arrive as an
+    `error` event with a `detail`.
+    """
+    status = compile_look(config).status
+    preview, faces = None, result.faces if result is not None else []
+    if result is None:
+        status, preview, landmark_token, faces = await run_pipeline(
+            process_preview, contents, config, output_options, landmark_token, max_faces
+        )
+
+    def elapsed_ms() -> int:
+        return int((time.time() - start_time) * 1000)
+
+    async def events():
+        final = result
+        if preview is not None:
+            metrics.first_image_seconds.observe(time.time() - start_time, "preview")
+            yield sse_event("preview", ProcessResponse(success=True, image=preview, status=status,
+                                                       processing_time_ms=elapsed_ms(), landmark_token=landmark_token,
+                                                       faces=faces).model_dump_json())
+        if final is None and faces:
+            try:
+                final, _ = await render_result(contents, config, output_options, landmark_token, max_faces,
+                                               params, upload_key)
+            except ExecutorSaturated:
+                yield sse_event("error", json.dumps({"detail": "Server is busy, please retry shortly"}))
+                return
+            except Exception as e:
+                logger.error(f"Error processing image: {str(e)}", exc_info=True)
+                yield sse_event("error", json.dumps({"detail": f"Error processing image: {str(e)}"}))
+                return
+
+        record_face(final is not None)
+        if final is None:
+            yield sse_event("result", ProcessResponse(success=False, status=status,
+                                                      processing_time_ms=elapsed_ms()).model_dump_json())
+            return
+        record_effects(config)
+        if preview is None:
+            metrics.first_image_seconds.observe(time.time() - start_time, "result")
+        image = data_uri(final.image, output_options.output_format)
+        yield sse_event("result", ProcessResponse(success=True, image=image, status=status,
+                                                  processing_time_ms=elapsed_ms(), landmark_token=final.landmark_token,
+                                                  faces=final.faces).model_dump_json())
+
+    # No buffering by proxies, the preview must reach the client before the full render is done
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.post("/api/makeup/apply")
 async def apply_makeup_endpoint(
-    file: UploadFile = File(...),
+    response: Response,
+    file: Optional[UploadFile] = File(None),
     apply_lipstick: bool = Form(True),
     lipstick_color: str = Form("Red"),
     apply_blush: bool = Form(True),
@@ -252,13 +697,22 @@ async def apply_makeup_endpoint(
     blush_intensity: int = Form(50),
     apply_foundation: bool = Form(True),
     foundation_preset: str = Form("Medium"),
-    return_base64: bool = Form(True)
+    return_base64: Optional[bool] = Form(None),
+    output_format: Optional[Literal["jpeg", "webp", "png"]] = Form(None),
+    quality: int = Form(DEFAULT_QUALITY),
+    png_compression: int = Form(DEFAULT_PNG_COMPRESSION),
+    max_side: Optional[int] = Form(None),
+    max_faces: int = Form(1, ge=1, le=MAX_FACES),
+    landmark_token: Optional[str] = Form(None),
+    progressive: bool = Form(False),
+    accept: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None)
 ):
     """
     Apply makeup to an uploaded image
 
     Args:
-        file: Image file to process
+        file: Image file to process, optional when a valid landmark_token is sent
         apply_lipstick: Whether to apply lipstick
         lipstick_color: Color of lipstick
         apply_blush: Whether to apply blush
@@ -266,151 +720,528 @@ async def apply_makeup_endpoint(
         blush_intensity: Intensity of blush (0-100)
         apply_foundation: Whether to apply foundation
         foundation_preset: Foundation preset level
-        return_base64: Return image as base64 string (default) or binary
+        return_base64: Return image as base64 JSON or binary; negotiated from Accept when omitted
+        output_format: jpeg, webp or png; negotiated from Accept when omitted
+        quality: JPEG/WebP quality (1-100)
+        png_compression: PNG compression level (0-9)
+        max_side: Longest side of the result in pixels; JPEGs are decoded at reduced scale when possible
+        max_faces: Most faces to render, largest first
+        landmark_token: Token from an earlier response for the same image, skips upload and detection
+        progressive: Stream a quick low-resolution preview, then the full result, as server-sent events
+        if_none_match: ETags of earlier responses; a matching result is answered with 304 and no body
 
     Returns:
         Processed image with makeup applied
     """
-    import time
     start_time = time.time()
 
     try:
-        # Read image file
-        contents = await file.read()
-        nparr = np.frombuffer(contents, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-        if img is None:
-            raise HTTPException(status_code=400, detail="Invalid image file")
-
-        # Detect facial landmarks
-        logger.info("Detecting facial landmarks...")
-        landmarks = detect_landmarks(img)
-
-        if landmarks is None:
-            return ProcessResponse(
-                success=False,
-                status="No face detected in the image",
-                processing_time_ms=int((time.time() - start_time) * 1000)
-            )
-
-        # Apply makeup effects
-        output = img.copy()
-        applied_features = []
-
-        if apply_lipstick:
-            logger.info(f"Applying lipstick: {lipstick_color}")
-            color = LIPSTICK_COLORS.get(lipstick_color, LIPSTICK_COLORS["Red"])
-            output = apply_lipstick(output, color, landmarks, alpha=0.4)
-            applied_features.append("Lipstick")
+        config = MakeupConfig(
+            apply_lipstick=apply_lipstick,
+            lipstick_color=lipstick_color,
+            apply_blush=apply_blush,
+            blush_color=blush_color,
+            blush_intensity=blush_intensity,
+            apply_foundation=apply_foundation,
+            foundation_preset=foundation_preset
+        )
 
-        if apply_blush:
-            logger.info(f"Applying blush: {blush_color} at {blush_intensity}%")
-            color = BLUSH_COLORS.get(blush_color, BLUSH_COLORS["Pink"])
-            intensity = blush_intensity / 100.0
-            output = apply_blush(output, color, landmarks, intensity=intensity)
-            applied_features.append(f"Blush ({blush_intensity}%)")
+        output_format, return_base64 = negotiate_output(accept, output_format, return_base64)
+        output_options = OutputOptions(output_format=output_format, quality=quality, png_compression=png_compression,
+                                       max_side=max_side)
+        response.headers["Vary"] = "Accept"
 
-        if apply_foundation:
-            logger.info(f"Applying foundation: {foundation_preset}")
-            output = apply_foundation(output, preset_name=foundation_preset)
-            applied_features.append(f"Foundation ({foundation_preset})")
+        # Read image file
+        with request_timings().stage("upload"):
+            contents = await file.read() if file is not None else None
+        if not contents and not landmark_token:
+            raise ValueError("file or landmark_token required")
+
+        # Results are cached by source image and normalized look, see `result_keys`. A token only identifies
+        # the rendered image when it is used, i.e. known to the landmark cache or sent without an image.
+        params = (compile_look(config).key, output_options.key, max_faces)
+        with request_timings().stage("cache"):
+            upload_key = await asyncio.to_thread(content_key, contents) if contents else None
+            # Membership may read the entry from the disk tier, so it is checked off the event loop
+            token_known = bool(upload_key and landmark_token) and await asyncio.to_thread(
+                landmark_cache.__contains__, landmark_token)
+            token = landmark_token if not upload_key or token_known else None
+            result, tier = await asyncio.to_thread(result_cache.get, result_keys(params, upload_key, token))
+
+        if progressive:
+            return await progressive_response(start_time, result, contents, config, output_options, landmark_token,
+                                              max_faces, params, upload_key)
+
+        if result is None:
+            result, status = await render_result(contents, config, output_options, landmark_token, max_faces,
+                                                 params, upload_key)
+            if result is None:
+                record_face(False)
+                return ProcessResponse(
+                    success=False,
+                    status=status,
+                    processing_time_ms=int((time.time() - start_time) * 1000)
+                )
 
         processing_time = int((time.time() - start_time) * 1000)
-        status = f"Applied: {', '.join(applied_features) if applied_features else 'None'}"
-
+        record_face(True)
         logger.info(f"Processing completed in {processing_time}ms")
+        record_effects(config)
+        status = compile_look(config).status
+
+        # Binary responses are the image bytes, so their ETag is strong. JSON ones also carry the processing
+        # time, so they get a weak ETag of their own.
+        etag = f'W/"{result.etag[1:-1]}-json"' if return_base64 else result.etag
+        cache_headers = {"ETag": etag, "X-Result-Cache": tier or "miss", "Vary": "Accept"}
+        if if_none_match and etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=cache_headers)
 
         # Return response
         if return_base64:
             # Return as base64 JSON response
-            image_base64 = encode_image_to_base64(output)
+            response.headers.update(cache_headers)
             return ProcessResponse(
                 success=True,
-                image=image_base64,
+                image=data_uri(result.image, output_options.output_format),
                 status=status,
-                processing_time_ms=processing_time
+                processing_time_ms=processing_time,
+                landmark_token=result.landmark_token,
+                faces=result.faces
             )
         else:
             # Return as binary image
-            output_rgb = cv2.cvtColor(output, cv2.COLOR_BGR2RGB)
-            pil_image = Image.fromarray(output_rgb)
-            buffer = io.BytesIO()
-            pil_image.save(buffer, format="PNG", quality=95)
-            buffer.seek(0)
-
-            return StreamingResponse(
-                buffer,
-                media_type="image/png",
-                headers={"X-Processing-Time": str(processing_time)}
+            return Response(
+                content=result.image,
+                media_type=media_type(output_options.output_format),
+                headers={
+                    "X-Processing-Time": str(processing_time),
+                    "X-Landmark-Token": result.landmark_token,
+                    "X-Face-Count": str(len(result.faces)),
+                    **cache_headers
+                }
             )
 
+    except ExecutorSaturated as e:
+        raise saturated_response(e)
+    except UnknownLandmarkToken as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error processing image: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
 
-@app.post("/api/makeup/apply-base64")
-async def apply_makeup_base64(config: MakeupConfig, image_base64: str):
+@app.post("/api/makeup/apply-batch")
+async def apply_makeup_batch(
+    file: Optional[UploadFile] = File(None),
+    configs: str = Form(...),
+    output_format: Literal["jpeg", "webp", "png"] = Form(DEFAULT_OUTPUT_FORMAT),
+    quality: int = Form(DEFAULT_QUALITY),
+    png_compression: int = Form(DEFAULT_PNG_COMPRESSION),
+    max_side: Optional[int] = Form(None),
+    max_faces: int = Form(1, ge=1, le=MAX_FACES),
+    landmark_token: Optional[str] = Form(None),
+    accept: Optional[str] = Header(None)
+):
     """
-    Apply makeup to a base64 encoded image
+    Apply several makeup looks to one image in a single request
 
     Args:
-        config: Makeup configuration
-        image_base64: Base64 encoded image string
+        file: Image file to process, optional when a valid landmark_token is sent
+        configs: JSON list of makeup configurations, one per variant
+        output_format: jpeg, webp or png
+        quality: JPEG/WebP quality (1-100)
+        png_compression: PNG compression level (0-9)
+        max_side: Longest side of the result in pixels; JPEGs are decoded at reduced scale when possible
+        max_faces: Most faces to render, largest first
+        landmark_token: Token from an earlier response for the same image, skips upload and detection
 
     Returns:
-        Processed image as base64 string
+        A zip archive with manifest.json and one image per variant, or a multipart/mixed stream
+        (manifest part first) when the Accept header asks for multipart/mixed
     """
-    import time
     start_time = time.time()
 
     try:
-        # Decode base64 image
-        image_pil = decode_base64_image(image_base64)
-        img = cv2.cvtColor(np.array(image_pil), cv2.COLOR_RGB2BGR)
+        try:
+            config_list = TypeAdapter(List[MakeupConfig]).validate_json(configs)
+        except ValidationError as e:
+            raise ValueError(f"Invalid configs: {e}")
+        if not config_list:
+            raise ValueError("configs must contain at least one makeup configuration")
+        if len(config_list) > BATCH_MAX_VARIANTS:
+            raise ValueError(f"At most {BATCH_MAX_VARIANTS} configurations per batch")
+        output_options = OutputOptions(output_format=output_format, quality=quality, png_compression=png_compression,
+                                       max_side=max_side)
+
+        with request_timings().stage("upload"):
+            contents = await file.read() if file is not None else None
+        if not contents and not landmark_token:
+            raise ValueError("file or landmark_token required")
+        status, landmark_token, variants, faces = await run_pipeline(
+            process_batch, contents, config_list, output_options, landmark_token, max_faces
+        )
 
-        # Detect facial landmarks
-        landmarks = detect_landmarks(img)
+        processing_time = int((time.time() - start_time) * 1000)
+        logger.info(f"Batch of {len(config_list)} processed in {processing_time}ms")
+        record_face(bool(variants))
+        if variants:
+            for config in config_list:
+                record_effects(config)
 
-        if landmarks is None:
-            return ProcessResponse(
-                success=False,
-                status="No face detected in the image",
-                processing_time_ms=int((time.time() - start_time) * 1000)
+        if not variants:
+            return BatchManifest(success=False, status=status, processing_time_ms=processing_time)
+
+        manifest, images = batch_manifest(status, landmark_token, variants, faces, output_options, processing_time)
+        headers = {"X-Processing-Time": str(processing_time), "X-Landmark-Token": landmark_token,
+                   "X-Face-Count": str(len(faces))}
+
+        if "multipart/mixed" in (accept or ""):
+            boundary = uuid.uuid4().hex
+            return StreamingResponse(
+                multipart_batch(manifest, images, media_type(output_options.output_format), boundary),
+                media_type=f"multipart/mixed; boundary={boundary}",
+                headers=headers
             )
+        return StreamingResponse(
+            iter([zip_batch(manifest, images)]),
+            media_type="application/zip",
+            headers={**headers, "Content-Disposition": 'attachment; filename="makeup-batch.zip"'}
+        )
 
-        # Apply makeup effects
-        output = img.copy()
-        applied_features = []
+    except ExecutorSaturated as e:
+        raise saturated_response(e)
+    except UnknownLandmarkToken as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error processing batch: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error processing batch: {str(e)}")
 
-        if config.apply_lipstick:
-            color = LIPSTICK_COLORS.get(config.lipstick_color, LIPSTICK_COLORS["Red"])
-            output = apply_lipstick(output, color, landmarks, alpha=0.4)
-            applied_features.append("Lipstick")
+@app.post("/api/makeup/jobs", response_model=JobInfo, status_code=202)
+async def create_job(
+    file: UploadFile = File(...),
+    config: Optional[str] = Form(None),
+    configs: Optional[str] = Form(None),
+    priority: Literal[PRIORITIES] = Form("interactive"),
+    output_format: Literal["jpeg", "webp", "png"] = Form(DEFAULT_OUTPUT_FORMAT),
+    quality: int = Form(DEFAULT_QUALITY),
+    png_compression: int = Form(DEFAULT_PNG_COMPRESSION),
+    max_side: Optional[int] = Form(None),
+    max_faces: int = Form(1, ge=1, le=MAX_FACES)
+):
+    """
+    Queue a makeup job, for images or batches too slow for a synchronous request
 
-        if config.apply_blush:
-            color = BLUSH_COLORS.get(config.blush_color, BLUSH_COLORS["Pink"])
-            intensity = config.blush_intensity / 100.0
-            output = apply_blush(output, color, landmarks, intensity=intensity)
-            applied_features.append(f"Blush ({config.blush_intensity}%)")
+    Args:
+        file: Image file to process
+        config: JSON makeup configuration for a single look (default: the default look)
+        configs: JSON list of makeup configurations, renders a batch like /api/makeup/apply-batch
+        priority: interactive jobs are always run before bulk ones
+        output_format: jpeg, webp or png
+        quality: JPEG/WebP quality (1-100)
+        png_compression: PNG compression level (0-9)
+        max_side: Longest side of the result in pixels; JPEGs are decoded at reduced scale when possible
+        max_faces: Most faces to render, largest first
 
-        if config.apply_foundation:
-            output = apply_foundation(output, preset_name=config.foundation_preset)
-            applied_features.append(f"Foundation ({config.foundation_preset})")
+    Returns:
+        The queued job; poll GET /api/makeup/jobs/{job_id} until it is done, then fetch its result_url
+    """
+    try:
+        if config is not None and configs is not None:
+            raise ValueError("Send either config or configs, not both")
+        try:
+            if configs is not None:
+                kind, looks = "batch", TypeAdapter(List[MakeupConfig]).validate_json(configs)
+            else:
+                kind, looks = "apply", [MakeupConfig.model_validate_json(config) if config else MakeupConfig()]
+            output_options = OutputOptions(output_format=output_format, quality=quality,
+                                           png_compression=png_compression, max_side=max_side)
+        except ValidationError as e:
+            raise ValueError(f"Invalid job: {e}")
+        if not looks:
+            raise ValueError("configs must contain at least one makeup configuration")
+        if len(looks) > BATCH_MAX_VARIANTS:
+            raise ValueError(f"At most {BATCH_MAX_VARIANTS} configurations per batch")
+
+        params = {"output": output_options.model_dump(), "max_faces": max_faces}
+        if kind == "batch":
+            params["configs"] = [look.model_dump() for look in looks]
+        else:
+            params["config"] = looks[0].model_dump()
+
+        with request_timings().stage("upload"):
+            contents = await file.read()
+        if not contents:
+            raise ValueError("Empty image file")
+        job = await asyncio.to_thread(job_queue.submit, kind, params, contents, priority)
+        return job_info(job)
+
+    except JobQueueFull as e:
+        raise HTTPException(status_code=503, detail=f"Job queue is full: {e}",
+                            headers={"Retry-After": str(executor.retry_after)})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/makeup/jobs/{job_id}", response_model=JobInfo)
+async def get_job(job_id: str):
+    """Status of a job; finished jobs are kept for MAKEUP_JOB_TTL seconds"""
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job")
+    return job_info(job)
+
+@app.get("/api/makeup/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """The rendered image, or the zip archive of a batch job"""
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job")
+    path = job_queue.result_path(job_id)
+    if path is None:
+        # Still queued or running, failed, or done without a result (no face found)
+        reason = job["error"] or job["status"] or f"job is {job['state']}"
+        raise HTTPException(status_code=409, detail=f"No result: {reason}")
+    filename = "makeup-batch.zip" if job["kind"] == "batch" else None
+    return FileResponse(path, media_type=job["media_type"], filename=filename)
+
+@app.post("/api/makeup/video")
+async def apply_makeup_video(
+    file: UploadFile = File(...),
+    apply_lipstick: bool = Form(True),
+    lipstick_color: str = Form("Red"),
+    apply_blush: bool = Form(True),
+    blush_color: str = Form("Pink"),
+    blush_intensity: int = Form(50),
+    apply_foundation: bool = Form(True),
+    foundation_preset: str = Form("Medium"),
+    video_format: Literal["mp4", "webm"] = Form("mp4"),
+    max_side: Optional[int] = Form(None, ge=16),
+    max_faces: int = Form(1, ge=1, le=MAX_FACES),
+    keyframe_interval: int = Form(KEYFRAME_INTERVAL, ge=1),
+):
+    """
+    Apply makeup to every frame of an uploaded video clip
+
+    Args:
+        file: Video file to process (anything FFmpeg reads: mp4, mov, webm, ...)
+        apply_lipstick ... foundation_preset: The look, as for /api/makeup/apply
+        video_format: Container of the result, mp4 or webm; audio is not kept
+        max_side: Longest side of the result in pixels, larger frames are downscaled
+        max_faces: Most faces to render per frame, largest first
+        keyframe_interval: Frames per FaceMesh detection, landmarks follow the faces with optical flow in between
+
+    Returns:
+        The rendered clip, streamed from disk
+    """
+    start_time = time.time()
+    directory = tempfile.mkdtemp(prefix="makeup-video-")
+    try:
+        config = MakeupConfig(
+            apply_lipstick=apply_lipstick,
+            lipstick_color=lipstick_color,
+            apply_blush=apply_blush,
+            blush_color=blush_color,
+            blush_intensity=blush_intensity,
+            apply_foundation=apply_foundation,
+            foundation_preset=foundation_preset
+        )
+        extension, _, video_media_type = VIDEO_FORMATS[video_format]
+        source, destination = os.path.join(directory, "input"), os.path.join(directory, f"output{extension}")
+
+        # The upload is already spooled to disk, copy it in chunks to a path VideoCapture can open
+        with request_timings().stage("upload"):
+            with open(source, "wb") as f:
+                await asyncio.to_thread(shutil.copyfileobj, file.file, f, 2 ** 20)
+        [summary] = await run_pipeline(render_video, source, destination, config, video_format, max_faces, max_side,
+                                       keyframe_interval)
+        os.remove(source)
 
         processing_time = int((time.time() - start_time) * 1000)
-        status = f"Applied: {', '.join(applied_features) if applied_features else 'None'}"
+        logger.info(f"Rendered {summary['frames']} video frames in {processing_time}ms")
+        record_effects(config)
+        return FileResponse(
+            destination,
+            media_type=video_media_type,
+            filename=f"makeup{extension}",
+            headers={
+                "X-Processing-Time": str(processing_time),
+                "X-Frame-Count": str(summary["frames"]),
+                "X-Face-Frames": str(summary["face_frames"]),
+                "X-Detection-Skipped": str(summary["detection_skipped"]),
+                "X-Video-Codec": summary["codec"],
+            },
+            background=BackgroundTask(shutil.rmtree, directory, ignore_errors=True),
+        )
+
+    except ExecutorSaturated as e:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise saturated_response(e)
+    except ValueError as e:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        shutil.rmtree(directory, ignore_errors=True)
+        logger.error(f"Error processing video: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error processing video: {str(e)}")
+
+active_streams = 0
+
+@app.websocket("/ws/makeup/stream")
+async def makeup_stream(websocket: WebSocket):
+    """
+    Live video try-on
+
+    Binary messages are JPEG frames; each processed frame is answered with the encoded result.
+    Text messages are JSON `{"config": MakeupConfig, "output": OutputOptions}` updates, both optional,
+    answered with `{"type": "ack", "frames": ..., "dropped": ..., "detection_skipped": ...}`.
+    Only the newest frame is kept while one is being processed, older ones are dropped,
+    so latency stays bounded when the client sends faster than frames can be rendered.
+    The `max_faces` query parameter (default 1) sets how many faces are tracked and rendered,
+    `keyframe_interval` how many frames share one FaceMesh detection (1 detects on every frame).
+    """
+    global active_streams
+    try:
+        max_faces = min(max(int(websocket.query_params.get("max_faces", 1)), 1), MAX_FACES)
+        keyframe_interval = max(int(websocket.query_params.get("keyframe_interval", KEYFRAME_INTERVAL)), 1)
+    except ValueError:
+        await websocket.close(code=1008, reason="max_faces and keyframe_interval must be integers")
+        return
+    if active_streams >= STREAM_MAX_CONNECTIONS:
+        await websocket.close(code=1013, reason="Too many streams, retry later")
+        return
+
+    active_streams += 1
+    session = None
+    try:
+        await websocket.accept()
+        session = await asyncio.to_thread(StreamSession, max_faces, keyframe_interval)
+        latest = None
+        frame_ready = asyncio.Event()
+
+        async def receive_messages():
+            nonlocal latest
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    return
+                if message.get("bytes") is not None:
+                    if latest is not None:
+                        session.dropped += 1
+                    latest = message["bytes"]
+                    frame_ready.set()
+                elif message.get("text") is not None:
+                    try:
+                        update = StreamUpdate.model_validate_json(message["text"])
+                    except ValidationError as e:
+                        await websocket.send_json({"type": "error", "detail": str(e)})
+                        continue
+                    if update.config is not None:
+                        session.config = update.config
+                    if update.output is not None:
+                        session.output_options = update.output
+                    await websocket.send_json({"type": "ack", **session.stats()})
+
+        async def render_frames():
+            nonlocal latest
+            while True:
+                await frame_ready.wait()
+                frame_ready.clear()
+                frame, latest = latest, None
+                try:
+                    result = await executor.run_in_thread(
+                        session.render, frame, session.config, session.output_options
+                    )
+                except ExecutorSaturated:
+                    session.dropped += 1
+                    continue
+                except ValueError as e:
+                    await websocket.send_json({"type": "error", "detail": str(e)})
+                    continue
+                await websocket.send_bytes(result)
+
+        tasks = [asyncio.create_task(receive_messages()), asyncio.create_task(render_frames())]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            if not isinstance(task.exception(), (WebSocketDisconnect, type(None))):
+                logger.error("Stream failed", exc_info=task.exception())
+    except WebSocketDisconnect:
+        pass
+    except Exception:
+        logger.error("Stream failed", exc_info=True)
+    finally:
+        active_streams -= 1
+        # Only a failure leaves both sides connected, the client disconnecting ends the stream otherwise
+        if (websocket.application_state == WebSocketState.CONNECTED
+                and websocket.client_state == WebSocketState.CONNECTED):
+            try:
+                await websocket.close(code=1011, reason="Internal error")
+            except RuntimeError:
+                pass
+        if session is not None:
+            logger.info("Stream closed after %d frames (%d dropped)", session.frames, session.dropped)
+            # Waits for a frame still rendering on an executor thread before releasing the tracker
+            await asyncio.to_thread(session.close)
+
+@app.post("/api/makeup/apply-base64")
+async def apply_makeup_base64(body: Base64Request,
+                              image_base64: Optional[str] = Query(None, deprecated=True),
+                              landmark_token: Optional[str] = Query(None, deprecated=True),
+                              output_format: Optional[Literal["jpeg", "webp", "png"]] = Query(None, deprecated=True),
+                              quality: Optional[int] = Query(None, ge=1, le=100, deprecated=True),
+                              png_compression: Optional[int] = Query(None, ge=0, le=9, deprecated=True)):
+    """
+    Apply makeup to a base64 encoded image
+
+    Args:
+        body: JSON object with `image_base64` (bare or data URI, optional when a valid `landmark_token` is
+            sent), `landmark_token`, `max_faces`, `config` (MakeupConfig) and `output` (OutputOptions). A bare
+            MakeupConfig is still accepted as the body.
+        image_base64, landmark_token, output_format, quality, png_compression: Deprecated query parameter
+            forms of the body fields, used when the body leaves them unset
+
+    Returns:
+        Processed image as base64 string
+    """
+    start_time = time.time()
 
-        # Encode result
-        image_base64_result = encode_image_to_base64(output)
+    try:
+        image_base64 = body.image_base64 or image_base64
+        landmark_token = body.landmark_token or landmark_token
+        if not image_base64 and not landmark_token:
+            raise ValueError("image_base64 or landmark_token required")
+        overrides = {"output_format": output_format, "quality": quality, "png_compression": png_compression}
+        output_options = body.output.model_copy(
+            update={name: value for name, value in overrides.items()
+                    if value is not None and name not in body.output.model_fields_set}
+        )
+        status, image, landmark_token, faces = await run_pipeline(
+            process_base64, image_base64, body.config, output_options, landmark_token, body.max_faces
+        )
+
+        processing_time = int((time.time() - start_time) * 1000)
+        record_face(image is not None)
+        if image is not None:
+            record_effects(body.config)
 
         return ProcessResponse(
-            success=True,
-            image=image_base64_result,
+            success=image is not None,
+            image=image,
             status=status,
-            processing_time_ms=processing_time
+            processing_time_ms=processing_time,
+            landmark_token=landmark_token,
+            faces=faces
         )
 
+    except ExecutorSaturated as e:
+        raise saturated_response(e)
+    except UnknownLandmarkToken as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error processing image: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
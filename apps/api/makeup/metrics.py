@@ -0,0 +1,271 @@
+"""
+Low-overhead request instrumentation: per-stage timings and Prometheus metrics.
+
+Pipeline functions record how long each stage took in a `Timings` object, which is plain data so it can
+travel back from a process-pool worker. `ServerTimingMiddleware` turns the timings of every request into a
+`Server-Timing` header and feeds them into the stage histogram. Metrics are rendered in the Prometheus
+text format by `render()`; updating one is a dict lookup and an increment under a lock.
+"""
+
+import abc
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from a fast ROI render up to a slow 12MP upload
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric(abc.ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    @abc.abstractmethod
+    def samples(self) -> list:
+        """The sample lines of the metric in the Prometheus text format"""
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def samples(self) -> list:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+                for labels, value in values]
+
+
+class Gauge(Metric):
+    """A gauge read from `callback` at scrape time, so nothing is paid on the request path"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def samples(self) -> list:
+        return [f"{self.name} {_format_value(self.callback())}"]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def count(self, *labels: str) -> int:
+        entry = self._values.get(labels)
+        return sum(entry[0]) if entry else 0
+
+    def samples(self) -> list:
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        lines = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name: str):
+        self._metrics.pop(name, None)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.header())
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_seconds = registry.register(Histogram(
+    "makeup_stage_seconds", "Time spent in each pipeline stage", labels=("stage",)))
+request_seconds = registry.register(Histogram(
+    "makeup_request_seconds", "Request latency of the /api/makeup endpoints", labels=("path", "status")))
+effects_total = registry.register(Counter(
+    "makeup_effects_total", "Makeup effects rendered", labels=("effect", "shade")))
+face_detections_total = registry.register(Counter(
+    "makeup_face_detections_total", "Images processed, by whether a face was found", labels=("result",)))
+stream_landmark_frames_total = registry.register(Counter(
+    "makeup_stream_landmark_frames_total", "Stream frames by where their landmarks came from, FaceMesh or optical flow",
+    labels=("source",)))
+first_image_seconds = registry.register(Histogram(
+    "makeup_first_image_seconds", "Progressive /api/makeup/apply: time until the first image was sent, by event",
+    labels=("event",)))
+result_cache_lookups_total = registry.register(Counter(
+    "makeup_result_cache_lookups_total", "Rendered-result cache lookups, by the tier that had the result or miss",
+    labels=("result",)))
+result_cache_evictions_total = registry.register(Counter(
+    "makeup_result_cache_evictions_total", "Results dropped from a rendered-result cache tier", labels=("tier",)))
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format"""
+    return registry.render()
+
+
+def register_gauge(name: str, documentation: str, callback: Callable[[], float]):
+    """Registers (or replaces) a gauge read from `callback` on every scrape"""
+    registry.unregister(name)
+    registry.register(Gauge(name, documentation, callback))
+
+
+def record_face(found: bool):
+    face_detections_total.inc("found" if found else "not_found")
+
+
+class Timings:
+    """
+    Wall-clock seconds per pipeline stage of one request, in the order the stages first ran.
+    Repeated stages (e.g. encode for every batch variant) accumulate.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def merge(self, other: Optional["Timings"]):
+        if other is not None:
+            for name, seconds in other.stages.items():
+                self.add(name, seconds)
+
+    def observe(self):
+        """Feeds every stage into the stage histogram"""
+        for name, seconds in self.stages.items():
+            stage_seconds.observe(seconds, name)
+
+    def server_timing(self, total: Optional[float] = None) -> str:
+        """The `Server-Timing` header value, durations in milliseconds"""
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+        if total is not None:
+            entries.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(entries)
+
+
+_request_timings: contextvars.ContextVar = contextvars.ContextVar("makeup_request_timings", default=None)
+
+
+def request_timings() -> Timings:
+    """
+    The `Timings` of the request being served; a throwaway instance outside of `ServerTimingMiddleware`
+    """
+    timings = _request_timings.get()
+    return timings if timings is not None else Timings()
+
+
+class ServerTimingMiddleware:
+    """
+    ASGI middleware for HTTP requests under `prefix`: collects the stage timings recorded through
+    `request_timings()`, sends them as a `Server-Timing` header with the total time, and records
+    the stage and request latency histograms.
+    """
+
+    def __init__(self, app, prefix: str = "/api/makeup"):
+        self.app = app
+        self.prefix = prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+
+        timings = Timings()
+        token = _request_timings.set(timings)
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                header = timings.server_timing(time.perf_counter() - start).encode()
+                message = {**message, "headers": [*message.get("headers", []), (b"server-timing", header)]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
+            timings.observe()
+            # Label by route template, never by raw path, to keep the series count bounded
+            path = getattr(scope.get("route"), "path", "unmatched")
+            request_seconds.observe(time.perf_counter() - start, path, str(status[0]))
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""Checks for the HTTP API, with synthetic landmarks standing in for FaceMesh"""
+import base64
+import io
+import json
+import threading
+import zipfile
+from email import message_from_bytes
+
+import cv2
+import numpy as np
+import pytest
+from fastapi import WebSocketDisconnect
+from fastapi.testclient import TestClient
+
+import main
+import metrics
+from benchmark import synthetic_face, synthetic_landmarks
+from cache import LandmarkCache, ResultCache
+from render import MakeupConfig, OutputOptions, render_makeup
+
+LANDMARKS = synthetic_landmarks()
+
+
+def jpeg(height: int = 480, width: int = 640) -> bytes:
+    return cv2.imencode(".jpg", synthetic_face(height, width, LANDMARKS))[1].tobytes()
+
+
+@pytest.fixture
+def detections(monkeypatch, tmp_path):
+    """Replaces detection and the caches; returns the list of images detection ran on"""
+    detected = []
+
+    def detect_faces(img, max_faces=1):
+        detected.append(img.shape)
+        return [LANDMARKS]
+
+    monkeypatch.setattr(main, "detect_faces", detect_faces)
+    monkeypatch.setattr(main, "landmark_cache", LandmarkCache(directory=str(tmp_path / "landmarks")))
+    monkeypatch.setattr(main, "result_cache", ResultCache(directory=None))
+    return detected
+
+
+@pytest.fixture
+def client(detections):
+    return TestClient(main.app)
+
+
+def apply(client, data: dict, image: bytes = None, **kwargs):
+    files = {"file": ("face.jpg", image, "image/jpeg")} if image is not None else None
+    return client.post("/api/makeup/apply", data={"output_format": "png", "return_base64": "false", **data},
+                       files=files, **kwargs)
+
+
+def test_landmark_token_skips_upload_and_detection(client, detections, monkeypatch, tmp_path):
+    image = jpeg()
+    uploaded = apply(client, {}, image)
+    assert uploaded.status_code == 200 and detections == [(480, 640, 3)]
+    token = uploaded.headers["X-Landmark-Token"]
+
+    restyled = apply(client, {"landmark_token": token, "lipstick_color": "Wine"})
+    assert restyled.status_code == 200 and restyled.headers["X-Landmark-Token"] == token
+    same = apply(client, {"landmark_token": token})
+    assert same.content == uploaded.content and len(detections) == 1
+
+    # Another worker process only shares the cache directory
+    monkeypatch.setattr(main, "landmark_cache", LandmarkCache(directory=str(tmp_path / "landmarks")))
+    monkeypatch.setattr(main, "result_cache", ResultCache(directory=None))
+    elsewhere = apply(client, {"landmark_token": token})
+    assert elsewhere.status_code == 200 and elsewhere.content == uploaded.content and len(detections) == 1
+
+    # The same photo uploaded again is recognized by its content
+    again = client.post("/api/makeup/apply-base64",
+                        json={"image_base64": base64.b64encode(image).decode(), "config": {"apply_blush": False}})
+    assert again.json()["landmark_token"] == token and len(detections) == 1
+
+
+def test_token_renders_at_the_size_asked_for(client, detections):
+    small = apply(client, {"max_side": "320"}, jpeg())
+    assert decode(small.content).shape == (240, 320, 3) and detections == [(240, 320, 3)]
+    token = small.headers["X-Landmark-Token"]
+
+    # The cached image was decoded for a smaller output, the upload is decoded again at full size
+    full = apply(client, {"landmark_token": token})
+    assert decode(full.content).shape == (480, 640, 3)
+    assert decode(apply(client, {"landmark_token": token, "max_side": "400"}).content).shape == (300, 400, 3)
+    assert decode(apply(client, {"landmark_token": token, "max_side": "320"}).content).shape == (240, 320, 3)
+    assert len(detections) == 1
+    np.testing.assert_array_equal(decode(full.content), decode(apply(client, {}, jpeg()).content))
+
+
+def test_binary_unless_json_is_asked_for(client):
+    image = jpeg()
+    default = client.post("/api/makeup/apply", files={"file": ("face.jpg", image, "image/jpeg")})
+    assert default.headers["content-type"] == "image/jpeg" and default.headers["Vary"] == "Accept"
+    webp = client.post("/api/makeup/apply", files={"file": ("face.jpg", image, "image/jpeg")},
+                       headers={"Accept": "image/webp,*/*;q=0.8"})
+    assert webp.headers["content-type"] == "image/webp"
+    as_json = client.post("/api/makeup/apply", files={"file": ("face.jpg", image, "image/jpeg")},
+                       headers={"Accept": "application/json"})
+    assert as_json.json()["image"].startswith("data:image/jpeg;base64,")
+
+
+BATCH = [{"lipstick_color": "Wine"}, {"apply_blush": False, "foundation_preset": "Warm"}, {"foundation_preset": "Warm"}]
+
+
+def batch(client, configs, **kwargs):
+    return client.post("/api/makeup/apply-batch", data={"configs": json.dumps(configs), "output_format": "png"},
+                       files={"file": ("face.jpg", jpeg(), "image/jpeg")}, **kwargs)
+
+
+def decode(data: bytes) -> np.ndarray:
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+
+def test_batch_archive_shares_one_decode_and_detection(client, detections, monkeypatch):
+    contexts = []
+
+    class CountedContext(main.RenderContext):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            contexts.append(self)
+
+    monkeypatch.setattr(main, "RenderContext", CountedContext)
+
+    response = batch(client, BATCH)
+    assert response.status_code == 200 and response.headers["content-type"] == "application/zip"
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    manifest = json.loads(archive.read("manifest.json"))
+    assert [variant["filename"] for variant in manifest["variants"]] == [f"variant-00{i}.png" for i in range(3)]
+    assert manifest["landmark_token"] == response.headers["X-Landmark-Token"] and len(manifest["faces"]) == 1
+    # Geometry, skin mask and the shared Warm foundation frame come from one context
+    assert len(detections) == 1 and len(contexts) == 1
+
+    # Every variant is what the single-look endpoint renders
+    for config, variant in zip(BATCH, manifest["variants"]):
+        single = apply(client, {key: str(value) for key, value in config.items()}, jpeg())
+        np.testing.assert_array_equal(decode(archive.read(variant["filename"])), decode(single.content))
+        assert variant["status"].startswith("Applied")
+
+
+def test_batch_multipart(client):
+    response = batch(client, BATCH[:2], headers={"Accept": "multipart/mixed"})
+    content_type = response.headers["content-type"]
+    assert content_type.startswith("multipart/mixed; boundary=")
+
+    message = message_from_bytes(f"Content-Type: {content_type}\r\n\r\n".encode() + response.content)
+    manifest, *images = message.get_payload()
+    assert manifest.get_content_type() == "application/json"
+    variants = json.loads(manifest.get_payload())["variants"]
+    assert [image.get_filename() for image in images] == [variant["filename"] for variant in variants]
+    for image in images:
+        data = image.get_payload(decode=True)
+        assert image.get_content_type() == "image/png" and int(image["Content-Length"]) == len(data)
+        assert decode(data).shape == (480, 640, 3)
+
+
+def test_batch_limits(client, monkeypatch):
+    monkeypatch.setattr(main, "BATCH_MAX_VARIANTS", 2)
+    too_many = batch(client, BATCH)
+    assert too_many.status_code == 400 and too_many.json()["detail"] == "At most 2 configurations per batch"
+    assert batch(client, []).status_code == 400
+    assert batch(client, [{"blush_intensity": 500}]).status_code == 400
+
+
+def test_root_lists_the_endpoints(client):
+    endpoints = client.get("/").json()["endpoints"]
+    for endpoint in ("POST /api/makeup/apply", "POST /api/makeup/apply-batch", "POST /api/makeup/jobs",
+                     "POST /api/makeup/video", "WS /ws/makeup/stream"):
+        assert endpoint in endpoints
+
+
+def test_missing_image_and_unknown_tokens(client):
+    assert apply(client, {}).status_code == 400
+    assert apply(client, {}).json()["detail"] == "file or landmark_token required"
+    assert client.post("/api/makeup/apply-base64", json={"apply_blush": False}).status_code == 400
+    assert client.post("/api/makeup/apply-batch", data={"configs": "[{}]"}).status_code == 400
+    assert apply(client, {"landmark_token": "unknown"}).status_code == 404
+
+
+def test_server_timing_header(client):
+    response = apply(client, {}, jpeg())
+    entries = dict(entry.split(";dur=") for entry in response.headers["Server-Timing"].split(", "))
+    assert {"upload", "cache", "queue", "decode", "landmarks", "lipstick", "encode", "total"} <= set(entries)
+    assert all(float(duration) >= 0 for duration in entries.values())
+    assert float(entries["total"]) >= max(float(duration) for duration in entries.values())
+    assert "Server-Timing" not in client.get("/health").headers
+
+
+def test_prometheus_scrape(client):
+    def sample(text, line):
+        return next((float(row.rsplit(" ", 1)[1]) for row in text.splitlines() if row.startswith(line + " ")), 0.0)
+
+    series = 'makeup_request_seconds_count{path="/api/makeup/apply",status="200"}'
+    before = client.get("/metrics").text
+    apply(client, {}, jpeg())
+    scrape = client.get("/metrics")
+    assert scrape.status_code == 200 and scrape.headers["content-type"] == metrics.CONTENT_TYPE
+    text = scrape.text
+    assert sample(text, series) == sample(before, series) + 1
+    stage = 'makeup_stage_seconds_count{stage="lipstick"}'
+    assert sample(text, stage) == sample(before, stage) + 1
+    assert sample(text, 'makeup_face_detections_total{result="found"}') >= 1
+    assert "# TYPE makeup_stage_seconds histogram" in text and 'makeup_stage_seconds_bucket{stage="lipstick",le="+Inf"}' in text
+    assert "# TYPE makeup_executor_in_flight gauge" in text and sample(text, "makeup_executor_in_flight") == 0
+    # Every sample line is "name{labels} value"
+    for row in text.splitlines():
+        if not row.startswith("#"):
+            float(row.rsplit(" ", 1)[1].replace("+Inf", "inf"))
+
+
+class StubTracker:
+    """Stands in for the per-stream FaceMesh tracker; `hold` blocks the first frame until it is set"""
+    hold = threading.Event()
+    started = threading.Event()
+
+    def __init__(self, max_faces, keyframe_interval):
+        self.detected = True
+        self.skipped_fraction = 0.0
+        self.frames = 0
+
+    def process(self, img):
+        self.frames += 1
+        if self.frames == 1:
+            StubTracker.started.set()
+            StubTracker.hold.wait(10)
+        return [LANDMARKS]
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def stream_client(client, monkeypatch):
+    StubTracker.hold, StubTracker.started = threading.Event(), threading.Event()
+    monkeypatch.setattr(main, "LandmarkTracker", StubTracker)
+    yield client
+    StubTracker.hold.set()
+
+
+def test_stream_drops_stale_frames_and_applies_updates(stream_client):
+    frame = jpeg()
+    with stream_client.websocket_connect("/ws/makeup/stream") as websocket:
+        websocket.send_bytes(frame)
+        assert StubTracker.started.wait(10)
+        # Arrive while the first frame renders: only the newest is kept
+        websocket.send_bytes(b"stale")
+        websocket.send_bytes(frame)
+        websocket.send_text(json.dumps({"config": {"lipstick_color": "Wine"}}))
+        assert websocket.receive_json() == {"type": "ack", "frames": 0, "dropped": 1, "detection_skipped": 0.0}
+        StubTracker.hold.set()
+
+        img = cv2.imdecode(np.frombuffer(frame, np.uint8), cv2.IMREAD_COLOR)
+        for config in (MakeupConfig(), MakeupConfig(lipstick_color="Wine")):
+            expected, _ = render_makeup(img, config, [LANDMARKS])
+            assert websocket.receive_bytes() == OutputOptions().encode(expected)
+
+        websocket.send_text(json.dumps({"config": {"blush_intensity": 500}}))
+        assert websocket.receive_json()["type"] == "error"
+        websocket.send_bytes(b"not an image")
+        assert websocket.receive_json() == {"type": "error", "detail": "Invalid frame"}
+    assert main.active_streams == 0
+
+
+def test_stream_failure_closes_with_1011(stream_client, monkeypatch):
+    def fail(self, frame, config, output_options):
+        raise RuntimeError("renderer crashed")
+
+    monkeypatch.setattr(main.StreamSession, "render", fail)
+    with stream_client.websocket_connect("/ws/makeup/stream") as websocket:
+        websocket.send_bytes(jpeg())
+        with pytest.raises(WebSocketDisconnect) as closed:
+            websocket.receive_bytes()
+    assert closed.value.code == 1011 and main.active_streams == 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
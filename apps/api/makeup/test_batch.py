@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Checks for the offline batch renderer: inputs, looks, rendering one file and resuming"""
+import json
+
+import cv2
+import numpy as np
+import pytest
+
+import batch
+from benchmark import synthetic_face, synthetic_landmarks
+from render import MakeupConfig, OutputOptions, render_makeup
+
+
+@pytest.fixture
+def photos(tmp_path):
+    landmarks = synthetic_landmarks()
+    (tmp_path / "in" / "studio").mkdir(parents=True)
+    for name in ("a.jpg", "studio/b.png"):
+        cv2.imwrite(str(tmp_path / "in" / name), synthetic_face(240, 320, landmarks))
+    (tmp_path / "in" / "notes.txt").write_text("not an image")
+    return tmp_path
+
+
+def test_parse_looks(tmp_path):
+    looks = batch.parse_looks('[{"lipstick_color": "Wine"}, {}]')
+    assert list(looks) == ["look-000", "look-001"] and looks["look-000"].lipstick_color == "Wine"
+
+    path = tmp_path / "looks.json"
+    path.write_text(json.dumps({"nude": {"lipstick_color": "Nude", "apply_blush": False}}))
+    assert batch.parse_looks(str(path)) == {"nude": MakeupConfig(lipstick_color="Nude", apply_blush=False)}
+
+    for invalid in ("[]", '{"../up": {}}', '{"red": {"blush_intensity": 500}}'):
+        with pytest.raises(ValueError):
+            batch.parse_looks(invalid)
+
+
+def test_collect_inputs(photos):
+    source = str(photos / "in")
+    assert [relative for _, relative in batch.collect_inputs(source)] == ["a.jpg", "studio/b.png"]
+    assert [relative for _, relative in batch.collect_inputs(source, recursive=False)] == ["a.jpg"]
+
+    manifest = photos / "in" / "manifest.txt"
+    manifest.write_text(f"# Catalog\nstudio/b.png\n\n{photos / 'elsewhere.jpg'}\n")
+    assert batch.collect_inputs(str(manifest)) == [
+        (str(photos / "in" / "studio" / "b.png"), "studio/b.png"),
+        (str(photos / "elsewhere.jpg"), "elsewhere.jpg"),
+    ]
+
+
+def test_render_file(photos, monkeypatch):
+    landmarks = synthetic_landmarks()
+    monkeypatch.setattr(batch, "detect_faces", lambda img, max_faces=1: [landmarks])
+    looks = batch.parse_looks('{"red": {}, "wine": {"lipstick_color": "Wine", "apply_foundation": false}}')
+    options = OutputOptions(output_format="png")
+    outputs = batch.output_paths("a.jpg", looks, str(photos / "out"), "png")
+
+    result = batch.render_file(str(photos / "in" / "a.jpg"), outputs, looks, options)
+    assert result["state"] == "done" and result["written"] == 2 and result["faces"] == 1
+    assert {"decode", "landmarks", "lipstick", "encode", "write"} <= set(result["stages"])
+
+    img = cv2.imread(str(photos / "in" / "a.jpg"))
+    for name, config in looks.items():
+        expected, _ = render_makeup(img, config, [landmarks])
+        np.testing.assert_array_equal(cv2.imread(outputs[name]), expected)
+
+
+def test_render_file_failures(photos, monkeypatch):
+    monkeypatch.setattr(batch, "detect_faces", lambda img, max_faces=1: [])
+    looks = batch.parse_looks('{"red": {}}')
+    outputs = batch.output_paths("x", looks, str(photos / "out"), "jpeg")
+
+    assert batch.render_file(str(photos / "in" / "a.jpg"), outputs, looks, OutputOptions())["state"] == "no_face"
+    result = batch.render_file(str(photos / "in" / "notes.txt"), outputs, looks, OutputOptions())
+    assert result["state"] == "failed" and "Invalid image file" in result["error"]
+
+
+def test_finished_images_are_skipped(photos):
+    looks = batch.parse_looks('{"red": {}, "wine": {"lipstick_color": "Wine"}}')
+    inputs = batch.collect_inputs(str(photos / "in"))
+    for _, relative in inputs:
+        for path in batch.output_paths(relative, looks, str(photos / "out"), "jpeg").values():
+            batch.write_atomic(path, b"rendered earlier")
+
+    summary = batch.run(inputs, looks, str(photos / "out"), OutputOptions(), workers=1, max_in_flight=2)
+    assert summary["skipped"] == 2 and summary["processed"] == 0 and summary["renders_written"] == 0
+
+
+def test_images_without_a_face_are_skipped_when_resuming(photos, monkeypatch):
+    monkeypatch.setattr(batch, "detect_faces", lambda img, max_faces=1: [])
+    looks = batch.parse_looks('{"red": {}}')
+    output_dir = str(photos / "out")
+    inputs = batch.collect_inputs(str(photos / "in"))
+    for path, relative in inputs:
+        outputs = batch.output_paths(relative, looks, output_dir, "jpeg")
+        marker = batch.no_face_marker(relative, output_dir)
+        assert batch.render_file(path, outputs, looks, OutputOptions(), marker=marker)["state"] == "no_face"
+        assert batch.found_no_face(marker, OutputOptions())
+        # Detection at another size may find the face
+        assert not batch.found_no_face(marker, OutputOptions(max_side=100))
+
+    # Nothing is submitted to the pool
+    summary = batch.run(inputs, looks, output_dir, OutputOptions(), workers=1, max_in_flight=2)
+    assert summary["skipped_no_face"] == 2 and summary["processed"] == 0
+
+    # A face found later replaces the marker
+    landmarks = synthetic_landmarks()
+    monkeypatch.setattr(batch, "detect_faces", lambda img, max_faces=1: [landmarks])
+    path, relative = inputs[0]
+    marker = batch.no_face_marker(relative, output_dir)
+    outputs = batch.output_paths(relative, looks, output_dir, "jpeg")
+    assert batch.render_file(path, outputs, looks, OutputOptions(), marker=marker)["state"] == "done"
+    assert not batch.found_no_face(marker, OutputOptions())
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""Checks for the benchmark's regression check against a stored baseline"""
+import json
+
+import pytest
+
+import benchmark
+
+
+def run(lipstick_ms: float, import_ms: float = 100.0) -> dict:
+    return {
+        "imports": {"render": {"p50_ms": import_ms}},
+        "resolutions": {"vga": {"stages": {"lipstick": {"p50_ms": lipstick_ms}, "blush": {"p50_ms": 2.0}}}},
+    }
+
+
+BASELINE = run(10.0)
+
+
+def test_slowdowns_past_the_threshold_are_reported():
+    assert benchmark.compare(run(12.01), BASELINE, 20) == ["vga/lipstick: p50 10.00 -> 12.01 ms (+20%)"]
+    assert benchmark.compare(run(10.0, 120.1), BASELINE, 20) == ["import render: p50 100.0 -> 120.1 ms (+20%)"]
+    assert len(benchmark.compare(run(12.01, 120.1), BASELINE, 20)) == 2
+
+
+def test_slowdowns_within_the_threshold_pass():
+    assert benchmark.compare(run(11.99), BASELINE, 20) == []
+    assert benchmark.compare(run(10.0, 119.9), BASELINE, 20) == []
+    assert benchmark.compare(run(5.0, 50.0), BASELINE, 20) == []
+
+
+def test_stages_missing_from_either_side_are_skipped():
+    current = run(50.0)
+    current["resolutions"]["hd"] = current["resolutions"]["vga"]
+    current["resolutions"]["vga"]["stages"]["new_stage"] = {"p50_ms": 1.0}
+    del current["imports"]
+    assert benchmark.compare(current, {"resolutions": {}}, 20) == []
+    assert benchmark.compare(current, run(0.0), 20) == []
+
+
+@pytest.mark.parametrize("lipstick_ms, exit_status", [(12.01, 1), (11.99, 0)])
+def test_exit_status(tmp_path, monkeypatch, lipstick_ms, exit_status):
+    monkeypatch.setattr(benchmark, "benchmark_resolution",
+                        lambda name, iterations: run(lipstick_ms)["resolutions"][name])
+    baseline = tmp_path / "baseline.json"
+    baseline.write_text(json.dumps(BASELINE))
+    argv = ["--resolutions", "vga", "--import-runs", "0", "--baseline", str(baseline), "--threshold", "20"]
+    assert benchmark.main(argv) == exit_status
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
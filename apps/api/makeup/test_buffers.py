@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Checks for the frame buffer pool"""
+import gc
+import threading
+
+import numpy as np
+import pytest
+
+from benchmark import synthetic_face, synthetic_landmarks
+from buffers import BufferPool, buffer_pool
+from render import MakeupConfig, RenderContext, render_makeup
+
+FRAME = (480, 640, 3)
+FRAME_BYTES = 480 * 640 * 3
+
+
+def test_released_buffers_are_reused_per_shape_and_dtype():
+    pool = BufferPool(max_bytes=10 * FRAME_BYTES)
+    first = pool.acquire(FRAME)
+    first.fill(7)
+    pool.release(first)
+
+    floats = pool.acquire(FRAME, np.float32)
+    again = pool.acquire(FRAME)
+    assert again is first and (again == 7).all()
+    pool.release(again)
+    zeroed = pool.acquire(FRAME, zero=True)
+    assert zeroed is first and not zeroed.any() and floats is not first
+
+    stats = pool.stats()
+    assert (stats["acquired"], stats["reused"]) == (4, 2) and stats["reuse_rate"] == 0.5
+    assert stats["in_use_buffers"] == 2 and stats["in_use_bytes"] == FRAME_BYTES * 5
+    assert stats["high_water_bytes"] == FRAME_BYTES * 5
+
+
+def test_retained_bytes_are_capped_least_recently_used_first():
+    pool = BufferPool(max_bytes=2 * FRAME_BYTES)
+    small = [pool.acquire((240, 320, 3)) for _ in range(2)]
+    large = [pool.acquire(FRAME) for _ in range(2)]
+    for buffer in small + large:
+        pool.release(buffer)
+
+    stats = pool.stats()
+    assert stats["idle_bytes"] <= 2 * FRAME_BYTES and stats["evictions"] == 2
+    # The smaller resolution was released first and is the one dropped
+    assert pool.acquire(FRAME) is large[1] and pool.acquire(FRAME) is large[0]
+    assert pool.stats()["idle_buffers"] == 0
+
+    pool.release(pool.acquire((3 * FRAME[0], *FRAME[1:])))
+    assert pool.stats()["idle_bytes"] == 0
+
+
+def test_misuse_and_unreleased_buffers():
+    pool = BufferPool()
+    buffer = pool.acquire(FRAME)
+    with pytest.raises(ValueError):
+        pool.release(buffer[:100])
+    pool.release(buffer)
+    with pytest.raises(ValueError):
+        pool.release(buffer)
+    with pytest.raises(ValueError):
+        pool.release(np.empty(FRAME, np.uint8))
+
+    # Small arrays are not pooled at all
+    tiny = pool.acquire((8, 8))
+    pool.release(tiny)
+    assert pool.stats()["acquired"] == 1
+
+    # A forgotten buffer is freed by the garbage collector and no longer counted
+    del buffer
+    pool.acquire(FRAME)
+    gc.collect()
+    assert pool.stats()["in_use_bytes"] == 0
+
+
+def test_buffers_move_between_threads():
+    pool = BufferPool(max_bytes=8 * FRAME_BYTES)
+    borrowed = []
+
+    def borrow():
+        for _ in range(50):
+            with pool.borrow(FRAME) as buffer:
+                borrowed.append(id(buffer))
+
+    threads = [threading.Thread(target=borrow) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = pool.stats()
+    assert stats["acquired"] == 200 and stats["in_use_bytes"] == 0
+    # Never more buffers than threads borrowing at once
+    assert len(set(borrowed)) <= 4 and stats["high_water_bytes"] <= 4 * FRAME_BYTES
+
+
+def test_rendering_returns_its_buffers():
+    landmarks = synthetic_landmarks()
+    img = synthetic_face(*FRAME[:2], landmarks)
+    in_use = buffer_pool.stats()["in_use_bytes"]
+
+    with buffer_pool.borrow(img.shape) as out:
+        output, _ = render_makeup(img, MakeupConfig(), [landmarks], out=out)
+        assert output is out
+        assert buffer_pool.stats()["in_use_bytes"] == in_use + FRAME_BYTES
+
+    context = RenderContext(img, [landmarks])
+    render_makeup(img, MakeupConfig(foundation_preset="Warm"), [landmarks], context, reuse_foundation=True)
+    assert buffer_pool.stats()["in_use_bytes"] > in_use
+    context.close()
+    assert buffer_pool.stats()["in_use_bytes"] == in_use
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
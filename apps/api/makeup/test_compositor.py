@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""Parity check: the single-pass compositor vs applying lipstick, blush and foundation in turn"""
+import cv2
+import numpy as np
+import pytest
+from pydantic import ValidationError
+
+from benchmark import synthetic_face, synthetic_landmarks
+from render import (BLUSH_COLORS, LIPSTICK_COLORS, MakeupConfig, RenderContext, apply_blush, apply_foundation,
+                    apply_lipstick, as_faces, compile_look, preview_frame, render_makeup)
+from utils import face_skin_mask
+
+CONFIGS = [
+    {},
+    {"lipstick_color": "Wine", "blush_color": "Berry", "blush_intensity": 90, "foundation_preset": "Warm"},
+    {"apply_lipstick": False},
+    {"apply_blush": False},
+    {"apply_foundation": False},
+    {"apply_blush": False, "apply_foundation": False},
+    {"apply_lipstick": False, "apply_blush": False},
+    {"apply_lipstick": False, "apply_blush": False, "apply_foundation": False},
+    {"lipstick_color": "Unknown", "blush_color": "Unknown", "foundation_preset": "Unknown"},
+]
+
+# Where the face sits: centred, and pushed against the top left and bottom right corners so the
+# lipstick and blush regions are clipped by the frame
+OFFSETS = [(0.0, 0.0), (-0.45, -0.5), (0.4, 0.35)]
+
+
+# Several faces: apart, with overlapping blush regions, and stacked on top of each other
+GROUPS = [
+    [(-0.25, 0.0), (0.25, 0.0)],
+    [(-0.08, 0.0), (0.08, 0.02)],
+    [(0.0, 0.0), (0.0, 0.0)],
+    [(-0.3, -0.3), (0.3, -0.3), (-0.3, 0.3), (0.3, 0.3)],
+]
+
+
+def render_chained(img: np.ndarray, config: MakeupConfig, faces) -> np.ndarray:
+    """
+    Reference: lipstick and blush applied to the full frame face by face, then foundation,
+    skin mask of every face taken from the original photo
+    """
+    skin_mask = np.zeros((*img.shape[:2], 1), dtype=np.uint8)
+    for landmarks in as_faces(faces):
+        mask, roi = face_skin_mask(img, landmarks)
+        skin_mask[roi] |= mask
+    output = img.copy()
+    for landmarks in as_faces(faces):
+        if config.apply_lipstick:
+            color = LIPSTICK_COLORS.get(config.lipstick_color, LIPSTICK_COLORS["Red"])
+            output = apply_lipstick(output, color, landmarks, alpha=0.4)
+        if config.apply_blush:
+            color = BLUSH_COLORS.get(config.blush_color, BLUSH_COLORS["Pink"])
+            output = apply_blush(output, color, landmarks, intensity=config.blush_intensity / 100.0)
+    if config.apply_foundation:
+        output = apply_foundation(output, config.foundation_preset, skin_mask=skin_mask)
+    return output
+
+
+def face_at(offset, height: int = 480, width: int = 640):
+    landmarks = synthetic_landmarks()
+    landmarks[:, :2] += np.array(offset, dtype=np.float32)
+    return synthetic_face(height, width, synthetic_landmarks()), landmarks
+
+
+@pytest.mark.parametrize("offset", OFFSETS)
+@pytest.mark.parametrize("config", CONFIGS)
+def test_composite_matches_chained(config, offset):
+    img, landmarks = face_at(offset)
+    config = MakeupConfig(**config)
+
+    output, _ = render_makeup(img, config, landmarks)
+    np.testing.assert_array_equal(output, render_chained(img, config, landmarks))
+
+
+@pytest.mark.parametrize("offset", OFFSETS)
+def test_shared_buffer_and_foundation_frame(offset):
+    """Batch style rendering: one context, one output buffer and the cached foundation frame"""
+    img, landmarks = face_at(offset)
+    context = RenderContext(img, landmarks)
+    out = np.empty_like(img)
+    for config in map(lambda c: MakeupConfig(**c), CONFIGS):
+        for reuse_foundation in (False, True):
+            output, _ = render_makeup(img, config, landmarks, context, reuse_foundation=reuse_foundation, out=out)
+            assert output is out
+            np.testing.assert_array_equal(output, render_chained(img, config, landmarks))
+
+
+@pytest.mark.parametrize("offsets", GROUPS)
+@pytest.mark.parametrize("config", CONFIGS[:3])
+def test_multiple_faces_match_chained(config, offsets):
+    img = synthetic_face(480, 640, synthetic_landmarks())
+    faces = [face_at(offset)[1] for offset in offsets]
+    config = MakeupConfig(**config)
+
+    output, _ = render_makeup(img, config, faces)
+    np.testing.assert_array_equal(output, render_chained(img, config, faces))
+
+
+def test_face_groups():
+    img = synthetic_face(480, 640, synthetic_landmarks())
+    look = compile_look(MakeupConfig())
+
+    offsets = [(-0.3, -0.3), (0.3, -0.3), (-0.08, 0.3), (0.08, 0.3)]
+    context = RenderContext(img, [face_at(offset)[1] for offset in offsets])
+    groups = context.face_groups(look)
+    assert sorted(len(members) for _, members in groups) == [1, 1, 2]
+
+    # The face in the middle bridges the outer two, which only then end up in one group
+    context = RenderContext(img, [face_at(offset)[1] for offset in [(-0.3, 0.0), (0.3, 0.0), (0.0, 0.0)]])
+    (roi, members), = context.face_groups(look)
+    assert members == context.faces
+
+
+def test_compiled_looks_are_memoized():
+    look = compile_look(MakeupConfig(lipstick_color="Wine", blush_intensity=70))
+    # An equal configuration, built separately or parsed from a request, shares the compiled look
+    assert compile_look(MakeupConfig(lipstick_color="Wine", blush_intensity=70)) is look
+    assert compile_look(MakeupConfig.model_validate({"blush_intensity": 70, "lipstick_color": "Wine"})) is look
+
+    changed = [{"lipstick_color": "Nude"}, {"blush_intensity": 71}, {"apply_blush": False},
+               {"foundation_preset": "Warm"}]
+    looks = [compile_look(MakeupConfig(lipstick_color="Wine", blush_intensity=70).model_copy(update=update))
+             for update in changed]
+    assert all(other is not look for other in looks) and len({id(other) for other in looks}) == len(looks)
+    assert looks[1].key != look.key and looks[0].shades[0] == ("lipstick", "Nude")
+    with pytest.raises(ValidationError):
+        look.config.lipstick_color = "Red"
+
+
+def test_no_faces():
+    img = synthetic_face(480, 640, synthetic_landmarks())
+    assert render_makeup(img, MakeupConfig(), []) == (None, None)
+    assert render_makeup(img, MakeupConfig(), None) == (None, None)
+
+
+def test_source_image_untouched():
+    img, landmarks = face_at(OFFSETS[0])
+    original = img.copy()
+    render_makeup(img, MakeupConfig(), landmarks)
+    np.testing.assert_array_equal(img, original)
+
+
+def test_preview_frame():
+    img = synthetic_face(1500, 2000, synthetic_landmarks())
+    preview = preview_frame(img, 400)
+    assert preview.shape == (300, 400, 3)
+    # Close to a direct area-averaging resize, a plain bilinear one aliases (~24 dB)
+    reference = cv2.resize(img, (400, 300), interpolation=cv2.INTER_AREA)
+    assert cv2.PSNR(preview, reference) > 33
+    assert preview_frame(img, 2000) is None and preview_frame(img, 0) is None
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
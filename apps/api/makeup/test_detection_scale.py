@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Accuracy check: lip landmarks detected on downscaled copies vs full resolution"""
+import cv2
+import numpy as np
+import pytest
+
+from benchmark import synthetic_face, synthetic_landmarks
+from landmarks import detect_landmarks, normalize_landmarks
+from utils import upper_lip, lower_lip
+
+# Detection size -> allowed mean lip point error, as a fraction of the mouth width
+TOLERANCES = {320: 0.08, 480: 0.06, 640: 0.05, 960: 0.04}
+MOUTH_CORNERS = [61, 291]
+
+
+def load_reference_image(source: str):
+    """
+    A 12MP synthetic face, which FaceMesh detects, so the check runs in every checkout; or `pic.jpg`,
+    a real photo stored with git-lfs, which is only a pointer file without it
+    """
+    if source == "synthetic":
+        return synthetic_face(3000, 4000, synthetic_landmarks())
+    img = cv2.imread(source)
+    if img is None:
+        pytest.skip(f"{source} is not a readable image (is git-lfs installed?)")
+    return img
+
+
+def lip_polygon_error(reference: np.ndarray, candidate: np.ndarray, height: int, width: int) -> float:
+    """
+    Mean distance between the lip polygons of two landmark sets at full resolution,
+    relative to the mouth width of the reference
+    """
+    ref_points = normalize_landmarks(reference, height, width, upper_lip + lower_lip).astype(np.float32)
+    points = normalize_landmarks(candidate, height, width, upper_lip + lower_lip).astype(np.float32)
+    left, right = normalize_landmarks(reference, height, width, MOUTH_CORNERS).astype(np.float32)
+    mouth_width = max(1.0, float(np.linalg.norm(right - left)))
+    return float(np.linalg.norm(points - ref_points, axis=1).mean()) / mouth_width
+
+
+@pytest.mark.parametrize("source", ["synthetic", "pic.jpg"])
+@pytest.mark.parametrize("max_side", sorted(TOLERANCES))
+def test_lip_polygon_matches_full_resolution(max_side, source):
+    img = load_reference_image(source)
+    height, width = img.shape[:2]
+    reference = detect_landmarks(img, max_side=0)
+    assert reference is not None, "No face detected at full resolution"
+
+    candidate = detect_landmarks(img, max_side=max_side)
+    assert candidate is not None, f"No face detected at {max_side}px"
+    assert lip_polygon_error(reference, candidate, height, width) <= TOLERANCES[max_side]
+
+
+if __name__ == "__main__":
+    image = load_reference_image("synthetic")
+    h, w = image.shape[:2]
+    full = detect_landmarks(image, max_side=0)
+    for side in sorted(TOLERANCES):
+        error = lip_polygon_error(full, detect_landmarks(image, max_side=side), h, w)
+        print(f"{side:>4}px: mean lip error {error:.2%} of mouth width (limit {TOLERANCES[side]:.0%})")
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Checks for output encoding and Accept negotiation"""
+import cv2
+import numpy as np
+import pytest
+
+from encoding import DEFAULT_OUTPUT_FORMAT, encode_image, negotiate_output, parse_accept
+
+BROWSER_NAVIGATION = "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8"
+
+
+def test_parse_accept():
+    assert parse_accept(None) == {} and parse_accept("") == {}
+    assert parse_accept("Image/WebP, image/*;q=0.5 , application/json; q=0.9; charset=utf-8") == {
+        "image/webp": 1.0, "image/*": 0.5, "application/json": 0.9
+    }
+    # A malformed q counts as not acceptable, a type listed twice keeps its highest q
+    assert parse_accept("image/png;q=high, image/jpeg;q=0.2, image/jpeg;q=0.7") == {"image/png": 0.0,
+                                                                                    "image/jpeg": 0.7}
+
+
+@pytest.mark.parametrize("accept, expected", [
+    (None, (DEFAULT_OUTPUT_FORMAT, False)),
+    ("*/*", (DEFAULT_OUTPUT_FORMAT, False)),
+    ("image/*", (DEFAULT_OUTPUT_FORMAT, False)),
+    ("image/webp", ("webp", False)),
+    ("image/png, image/webp;q=0.9", ("png", False)),
+    (BROWSER_NAVIGATION, ("webp", False)),
+    ("application/json", (DEFAULT_OUTPUT_FORMAT, True)),
+    ("application/json, */*", (DEFAULT_OUTPUT_FORMAT, True)),
+    ("application/json;q=0.5, */*", (DEFAULT_OUTPUT_FORMAT, False)),
+    ("image/png;q=0.5, application/json", (DEFAULT_OUTPUT_FORMAT, True)),
+    ("application/json, image/png", ("png", False)),
+])
+def test_negotiation(accept, expected):
+    assert negotiate_output(accept) == expected
+
+
+def test_explicit_parameters_win():
+    assert negotiate_output("application/json", "png") == ("png", True)
+    assert negotiate_output("application/json", return_base64=False) == (DEFAULT_OUTPUT_FORMAT, False)
+    assert negotiate_output("image/webp", return_base64=True) == (DEFAULT_OUTPUT_FORMAT, True)
+    assert negotiate_output(None, "webp", True) == ("webp", True)
+
+
+@pytest.mark.parametrize("output_format", ["jpeg", "webp", "png"])
+def test_encoded_images_decode(output_format):
+    img = np.random.default_rng(0).integers(0, 255, (48, 64, 3), dtype=np.uint8)
+    decoded = cv2.imdecode(np.frombuffer(encode_image(img, output_format, 95), np.uint8), cv2.IMREAD_COLOR)
+    assert decoded.shape == img.shape
+    if output_format == "png":
+        np.testing.assert_array_equal(decoded, img)
+    with pytest.raises(ValueError):
+        encode_image(img, "gif")
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Checks for the bounded pipeline executor and the 503 it turns into"""
+import asyncio
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from executor import ExecutorSaturated, PipelineExecutor
+
+
+def test_admission_is_bounded_and_released():
+    executor = PipelineExecutor("thread", max_workers=2, max_queue=1, retry_after=7)
+    release = threading.Event()
+
+    def fail():
+        raise ValueError("broken image")
+
+    async def scenario():
+        running = [asyncio.create_task(executor.run(release.wait)) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert (executor.in_flight, executor.queued) == (2, 1)
+        with pytest.raises(ExecutorSaturated) as saturated:
+            await executor.run(release.wait)
+        assert saturated.value.retry_after == 7
+        with pytest.raises(ExecutorSaturated):
+            await executor.run_in_thread(release.wait)
+
+        release.set()
+        assert await asyncio.gather(*running) == [True] * 3
+        # A job that raises gives its slot back too
+        for _ in range(4):
+            with pytest.raises(ValueError):
+                await executor.run(fail)
+        assert (executor.in_flight, executor.queued) == (0, 0)
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        release.set()
+        executor.shutdown()
+
+
+def test_cancelled_requests_keep_their_slot_until_the_job_ends():
+    executor = PipelineExecutor("thread", max_workers=1, max_queue=0)
+    started, release = threading.Event(), threading.Event()
+
+    def job():
+        started.set()
+        release.wait()
+
+    async def scenario():
+        # The client disconnects while its job runs: the worker stays busy
+        request = asyncio.create_task(executor.run(job))
+        await asyncio.to_thread(started.wait)
+        request.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await request
+        assert executor.in_flight == 1
+        with pytest.raises(ExecutorSaturated):
+            await executor.run(job)
+
+        release.set()
+        for _ in range(100):
+            if executor.in_flight == 0:
+                break
+            await asyncio.sleep(0.01)
+        assert executor.in_flight == 0 and await executor.run(lambda: "admitted") == "admitted"
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        release.set()
+        executor.shutdown()
+
+
+def test_saturation_is_a_503_with_retry_after(monkeypatch):
+    async def saturated(*args, **kwargs):
+        raise ExecutorSaturated(7)
+
+    monkeypatch.setattr(main.executor, "run", saturated)
+    response = TestClient(main.app).post("/api/makeup/apply-base64", json={"image_base64": "aW1hZ2U="})
+    assert response.status_code == 503 and response.headers["Retry-After"] == "7"
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Checks that the Gradio app and the API share the rendering core and that importing it stays cheap"""
+import json
+import os
+import subprocess
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+import app
+from benchmark import HEAVY_MODULES, IMPORT_PROBE, synthetic_face, synthetic_landmarks
+from render import PREVIEW_MAX_SIDE, MakeupConfig, render_makeup
+
+
+@pytest.mark.parametrize("module", ["render", "landmarks", "batch", "app"])
+def test_import_skips_heavy_modules(module):
+    completed = subprocess.run([sys.executable, "-c", IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                               cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+                               check=True)
+    assert json.loads(completed.stdout.strip().splitlines()[-1])["loaded"] == []
+
+
+def test_process_image_renders_with_the_core(monkeypatch):
+    landmarks = synthetic_landmarks()
+    img = synthetic_face(480, 640, landmarks)
+    monkeypatch.setattr(app, "detect_landmarks", lambda image: landmarks)
+
+    rgb, status = app.process_image(img, True, "Wine", True, "Peach", 55, False, "Warm")
+    config = MakeupConfig(lipstick_color="Wine", blush_color="Peach", blush_intensity=55, apply_foundation=False)
+    expected, _ = render_makeup(img, config, [landmarks])
+    np.testing.assert_array_equal(cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR), expected)
+    assert status == "Applied: Lipstick, Blush (55%)"
+
+
+def test_progressive_preview_comes_first(monkeypatch):
+    landmarks = synthetic_landmarks()
+    img = synthetic_face(960, 1280, landmarks)
+    monkeypatch.setattr(app, "detect_landmarks", lambda image: landmarks)
+
+    steps = list(app.process_image_progressive(img, True, "Wine", True, "Peach", 55, True, "Warm"))
+    assert len(steps) == 2
+    (preview, preview_status), (full, status) = steps
+    assert max(preview.shape[:2]) == PREVIEW_MAX_SIDE and preview_status.startswith("Preview after")
+    assert full.shape == img.shape and status == app.process_image(img, True, "Wine", True, "Peach", 55, True, "Warm")[1]
+
+    # Images no larger than a preview only get the final result
+    small = synthetic_face(240, 320, landmarks)
+    assert len(list(app.process_image_progressive(small, True, "Wine", True, "Peach", 55, True, "Warm"))) == 1
+
+
+def test_process_image_without_face(monkeypatch):
+    monkeypatch.setattr(app, "detect_landmarks", lambda image: None)
+    img = np.full((64, 64, 3), 128, dtype=np.uint8)
+
+    assert app.process_image(img, True, "Red", True, "Pink", 50, True, "Medium")[1] == "No face detected"
+    assert app.process_image(None, True, "Red", True, "Pink", 50, True, "Medium") == (None, "No image provided")
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
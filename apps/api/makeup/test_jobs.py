@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""Checks for the persistent job queue: priority lanes, results, TTL eviction, restarts and shared databases"""
+import threading
+import time
+
+import pytest
+
+from jobs import JobQueue, JobQueueFull, JobResult
+
+
+def wait_for(queue: JobQueue, job_ids, timeout: float = 10.0) -> dict:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        jobs = {job_id: queue.get(job_id) for job_id in job_ids}
+        if all(job is not None and job["state"] in ("done", "failed") for job in jobs.values()):
+            return jobs
+        time.sleep(0.02)
+    raise TimeoutError(f"Jobs did not finish: {jobs}")
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = JobQueue(str(tmp_path), workers=1, bulk_workers=1, ttl=60, bulk_nice=0)
+    yield queue
+    queue.shutdown()
+
+
+def test_result_and_failure(queue):
+    def handler(params, data):
+        if data == b"bad":
+            raise ValueError("Invalid image file")
+        return JobResult(True, "Applied", data[::-1], "image/jpeg", {"faces": params["faces"]})
+
+    queue.register("apply", handler)
+    queue.start()
+    done = queue.submit("apply", {"faces": 2}, b"abc")["job_id"]
+    failed = queue.submit("apply", {"faces": 2}, b"bad")["job_id"]
+    jobs = wait_for(queue, [done, failed])
+
+    assert jobs[done]["success"] and jobs[done]["metadata"] == {"faces": 2}
+    with open(queue.result_path(done), "rb") as file:
+        assert file.read() == b"cba"
+    assert jobs[failed]["state"] == "failed" and jobs[failed]["error"] == "Invalid image file"
+    assert queue.result_path(failed) is None
+    assert queue.get("unknown") is None
+
+
+def test_interactive_jobs_run_before_bulk(queue):
+    order = []
+    release = threading.Event()
+
+    def handler(params, data):
+        release.wait()
+        order.append(params["name"])
+        return JobResult(True, "ok")
+
+    queue.register("apply", handler)
+    queue.start()
+    try:
+        first = queue.submit("apply", {"name": "first"}, b"x", "bulk")["job_id"]
+        while queue.get(first)["state"] != "running":
+            time.sleep(0.01)
+        jobs = [queue.submit("apply", {"name": f"bulk-{i}"}, b"x", "bulk")["job_id"] for i in range(3)]
+        jobs += [queue.submit("apply", {"name": f"interactive-{i}"}, b"x")["job_id"] for i in range(2)]
+        assert [queue.get(job_id)["position"] for job_id in jobs] == [2, 3, 4, 0, 1]
+    finally:
+        release.set()
+
+    wait_for(queue, [first] + jobs)
+    assert order == ["first", "interactive-0", "interactive-1", "bulk-0", "bulk-1", "bulk-2"]
+
+
+def test_bulk_jobs_are_kept_off_the_interactive_workers(tmp_path):
+    queue = JobQueue(str(tmp_path), workers=2, bulk_workers=1, ttl=60, bulk_nice=0)
+    running, release = [], threading.Event()
+
+    def handler(params, data):
+        running.append(params["name"])
+        release.wait()
+        return JobResult(True, "ok")
+
+    queue.register("apply", handler)
+    queue.start()
+    try:
+        bulk = [queue.submit("apply", {"name": f"bulk-{i}"}, b"x", "bulk")["job_id"] for i in range(3)]
+        time.sleep(0.3)
+        assert running == ["bulk-0"]
+        interactive = queue.submit("apply", {"name": "interactive"}, b"x")["job_id"]
+        deadline = time.monotonic() + 5
+        while "interactive" not in running and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert running == ["bulk-0", "interactive"]
+        release.set()
+        wait_for(queue, bulk + [interactive])
+    finally:
+        release.set()
+        queue.shutdown()
+
+
+def test_queue_limit(tmp_path):
+    queue = JobQueue(str(tmp_path), max_queued=2)
+    queue.register("apply", lambda params, data: JobResult(True, "ok"))
+    # Opened without workers, so jobs stay queued
+    queue.open()
+    queue.submit("apply", {}, b"x")
+    queue.submit("apply", {}, b"x")
+    with pytest.raises(JobQueueFull):
+        queue.submit("apply", {}, b"x")
+
+
+def test_expired_jobs_are_removed(tmp_path):
+    queue = JobQueue(str(tmp_path), workers=1, ttl=0.2, bulk_nice=0)
+    queue.register("apply", lambda params, data: JobResult(True, "ok", b"result", "image/jpeg"))
+    queue.start()
+    try:
+        job_id = queue.submit("apply", {}, b"x")["job_id"]
+        wait_for(queue, [job_id])
+        path = queue.result_path(job_id)
+        time.sleep(0.3)
+        assert queue.get(job_id) is None
+        queue._next_sweep = 0.0
+        queue._sweep()
+        assert queue.result_path(job_id) is None and not (tmp_path / "results" / job_id).exists()
+        assert path is not None and queue.counts() == {}
+    finally:
+        queue.shutdown()
+
+
+def test_running_jobs_of_live_processes_are_kept(tmp_path):
+    queue = JobQueue(str(tmp_path), workers=1, bulk_nice=0, lease=0.4)
+    release = threading.Event()
+    queue.register("apply", lambda params, data: release.wait() and JobResult(True, "first run"))
+    queue.start()
+    job_id = queue.submit("apply", {}, b"x")["job_id"]
+    while queue.get(job_id)["state"] != "running":
+        time.sleep(0.01)
+    # Another process opens the shared database while the job runs, for longer than the lease
+    other = JobQueue(str(tmp_path), workers=1, bulk_nice=0, lease=0.4)
+    other.register("apply", lambda params, data: JobResult(True, "stolen"))
+    other.start()
+    try:
+        time.sleep(1.0)
+        assert queue.get(job_id)["state"] == "running"
+        release.set()
+        assert wait_for(other, [job_id])[job_id]["status"] == "first run"
+    finally:
+        release.set()
+        queue.shutdown()
+        other.shutdown()
+
+
+def test_abandoned_jobs_run_after_a_restart(tmp_path):
+    crashed = JobQueue(str(tmp_path), lease=0.2)
+    crashed.register("apply", lambda params, data: JobResult(True, "first run"))
+    crashed.open()
+    job_id = crashed.submit("apply", {}, b"x")["job_id"]
+    # Simulate a crash: the job was claimed, then its worker stopped renewing the heartbeat
+    assert crashed._claim(("interactive",))["id"] == job_id
+    time.sleep(0.3)
+
+    restarted = JobQueue(str(tmp_path), workers=1, bulk_nice=0, lease=0.2)
+    restarted.register("apply", lambda params, data: JobResult(True, "second run"))
+    restarted.start()
+    try:
+        assert wait_for(restarted, [job_id])[job_id]["status"] == "second run"
+        # The crashed worker coming back late does not overwrite the new run
+        crashed._run({"id": job_id, "kind": "apply", "params": "{}"})
+        assert restarted.get(job_id)["status"] == "second run"
+    finally:
+        restarted.shutdown()
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Checks for the landmark cache: expiry, memory bounds and the disk tier shared between processes"""
+import os
+import time
+
+import numpy as np
+import pytest
+
+import cache
+from cache import CachedLandmarks, DiskTier, LandmarkCache
+
+
+def entry(size: int = 100, image_bytes: int = 0) -> CachedLandmarks:
+    face = np.random.default_rng(size).random((478, 3), dtype=np.float32)
+    image = np.zeros(image_bytes, np.uint8) if image_bytes else None
+    return CachedLandmarks([face], 1, b"x" * size, image)
+
+
+def test_entries_expire():
+    cache = LandmarkCache(ttl=0.05, directory=None)
+    cache.put("a", entry())
+    assert "a" in cache and cache.get("a") is not None
+    time.sleep(0.1)
+    assert "a" not in cache and cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_memory_is_bounded_by_entries_and_bytes():
+    cache = LandmarkCache(max_entries=2, max_bytes=1000, directory=None)
+    cache.put("a", entry())
+    cache.put("b", entry())
+    assert cache.get("a") is not None
+    cache.put("c", entry())
+    assert cache.get("b") is None and cache.get("a") is not None
+
+    # Uploaded and decoded bytes both count, the least recently used entries go first
+    cache.put("d", entry(100, 850))
+    assert cache.get("a") is None and cache.get("c") is None
+    cache.put("too large", entry(1001))
+    assert cache.get("too large") is None
+
+    stats = cache.stats()
+    assert (stats["entries"], stats["bytes"], stats["evictions"]) == (1, 950, 3)
+    assert (stats["hits"], stats["misses"]) == (2, 4)
+    # Cached images are shared between requests
+    assert not cache.get("d").image.flags.writeable
+
+
+def test_tokens_are_shared_through_the_disk_tier(tmp_path):
+    first = LandmarkCache(directory=str(tmp_path))
+    stored = entry(100, 3000)
+    first.put("token", stored)
+
+    # Another process sees the token, without the decoded image
+    second = LandmarkCache(directory=str(tmp_path))
+    assert "token" in second
+    found = second.get("token")
+    assert found.image is None and found.source == stored.source and found.searched == 1
+    np.testing.assert_array_equal(found.faces[0], stored.faces[0])
+    assert second.stats()["disk_hits"] == 0 and second.stats()["entries"] == 1
+
+    expired = LandmarkCache(ttl=-1, directory=str(tmp_path))
+    expired.put("old", entry())
+    assert second.get("old") is None and not (tmp_path / "old.landmarks").exists()
+    (tmp_path / "broken.landmarks").write_bytes(b"not landmarks")
+    assert "broken" not in second and not (tmp_path / "broken.landmarks").exists()
+
+    second.clear()
+    assert "token" not in LandmarkCache(directory=str(tmp_path))
+
+
+def test_uploads_stay_in_memory_unless_a_directory_is_set():
+    if not os.environ.get("MAKEUP_LANDMARK_CACHE_DIR"):
+        assert cache.LANDMARK_CACHE_DIR is None and not LandmarkCache().shared
+    assert LandmarkCache(directory="unused").shared
+
+
+def test_expired_files_are_swept_without_being_read(tmp_path):
+    tier = DiskTier(str(tmp_path), 10_000, ".landmarks", ttl=0.2)
+    tier.write("first", b"photo")
+    # Written by another process, never read here
+    (tmp_path / "other.landmarks").write_bytes(b"photo")
+    time.sleep(0.3)
+    tier._next_sweep = 0.0  # Sweeps run at most every ttl seconds
+    tier.write("fresh", b"photo")
+    assert sorted(os.listdir(tmp_path)) == ["fresh.landmarks"]
+    assert tier.stats()["expirations"] == 2 and tier.stats()["files"] == 1
+
+    # Expired files are neither read nor indexed by a new process
+    stale = tmp_path / "stale.landmarks"
+    stale.write_bytes(b"photo")
+    os.utime(stale, (time.time(), time.time() - 1))
+    assert DiskTier(str(tmp_path), 10_000, ".landmarks", ttl=0.5).read("stale") is None and not stale.exists()
+    os.utime(tmp_path / "fresh.landmarks", (time.time(), time.time() - 1))
+    restarted = DiskTier(str(tmp_path), 10_000, ".landmarks", ttl=0.5)
+    assert restarted.stats()["files"] == 0
+    restarted.write("new", b"photo")
+    assert sorted(os.listdir(tmp_path)) == ["new.landmarks"]
+
+
+def test_covers_the_decoded_size():
+    full = CachedLandmarks([], 1, b"", np.zeros((480, 640, 3), np.uint8))
+    assert full.covers(None) and full.covers(320)
+    reduced = CachedLandmarks([], 1, b"", np.zeros((240, 320, 3), np.uint8), max_side=320)
+    assert reduced.covers(320) and reduced.covers(200)
+    assert not reduced.covers(400) and not reduced.covers(None)
+    # Smaller than the bound it was decoded for, so the whole image
+    small = CachedLandmarks([], 1, b"", np.zeros((240, 320, 3), np.uint8), max_side=1000)
+    assert small.covers(None)
+    assert not CachedLandmarks([], 1, b"").covers(320)
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
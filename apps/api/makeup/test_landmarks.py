@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""Checks for the FaceMesh pool, with a stub standing in for MediaPipe, and for landmark normalization"""
+import queue
+
+import numpy as np
+import pytest
+
+import landmarks
+from landmarks import FaceMeshPool, normalize_landmarks
+
+
+class StubFaceMesh:
+    """Records how it is used; `fail_create` makes the constructor raise"""
+    created = []
+    fail_create = False
+
+    def __init__(self, static_image_mode: bool, max_num_faces: int):
+        if StubFaceMesh.fail_create:
+            raise RuntimeError("model failed to load")
+        self.static_image_mode = static_image_mode
+        self.max_num_faces = max_num_faces
+        self.processed = 0
+        self.closed = False
+        StubFaceMesh.created.append(self)
+
+    def process(self, image):
+        self.processed += 1
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture(autouse=True)
+def stub_face_mesh(monkeypatch):
+    StubFaceMesh.created, StubFaceMesh.fail_create = [], False
+    monkeypatch.setattr(landmarks, "load_face_mesh", lambda: StubFaceMesh)
+
+
+def test_instances_are_reused_and_bounded():
+    pool = FaceMeshPool(size=2, static_image_mode=False, max_num_faces=3)
+    with pool.acquire() as first:
+        with pool.acquire() as second:
+            assert first is not second
+            # Both instances are checked out, a third caller waits for one
+            with pytest.raises(queue.Empty):
+                with pool.acquire(timeout=0.01):
+                    pass
+    with pool.acquire() as again:
+        assert again is first
+    assert len(StubFaceMesh.created) == 2 and pool._created == 2
+    assert (first.static_image_mode, first.max_num_faces) == (False, 3)
+
+    pool.warmup()
+    assert len(StubFaceMesh.created) == 2 and first.processed == second.processed == 1
+
+
+def test_failed_instances_are_discarded():
+    pool = FaceMeshPool(size=1)
+    with pytest.raises(ValueError):
+        with pool.acquire() as broken:
+            raise ValueError("inference failed")
+    assert broken.closed and pool._created == 0
+    with pool.acquire() as replacement:
+        assert replacement is not broken
+
+    # A constructor that raises does not use up a slot of the pool
+    pool = FaceMeshPool(size=1)
+    StubFaceMesh.fail_create = True
+    with pytest.raises(RuntimeError):
+        with pool.acquire():
+            pass
+    assert pool._created == 0
+    StubFaceMesh.fail_create = False
+    with pool.acquire(timeout=1) as created:
+        assert not created.closed
+    assert pool._created == 1
+
+
+def test_close_with_instances_checked_out():
+    pool = FaceMeshPool(size=2)
+    with pool.acquire() as busy:
+        with pool.acquire() as idle:
+            assert idle is not busy
+        pool.close()
+        assert idle.closed and not busy.closed
+    # Returned after the pool was closed, so closed instead of pooled
+    assert busy.closed and all(face_mesh.closed for face_mesh in StubFaceMesh.created)
+    with pytest.raises(RuntimeError):
+        with pool.acquire():
+            pass
+
+
+def test_normalized_pixels_match_python_float_scaling():
+    points = np.random.default_rng(0).random((100_000, 3), dtype=np.float32)
+    mask = [10, 0, 99_999]
+    for height, width in [(480, 640), (4000, 3000), (1080, 1920)]:
+        expected = [[int(float(x) * width), int(float(y) * height)] for x, y, _ in points]
+        np.testing.assert_array_equal(normalize_landmarks(points, height, width), expected)
+        np.testing.assert_array_equal(normalize_landmarks(points, height, width, mask),
+                                      [expected[i] for i in mask])
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
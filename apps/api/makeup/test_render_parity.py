@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Parity check: the ROI-bounded lipstick and blush and the lookup-table gamma and foundation produce
+exactly the pixels of the original full-frame implementations, kept here as the reference
+"""
+import cv2
+import numpy as np
+import pytest
+
+from benchmark import synthetic_face, synthetic_landmarks
+from landmarks import normalize_landmarks
+from render import (BLUSH_COLORS, CHEEKS, FOUNDATION_PRESETS, LIPSTICK_COLORS, LOWER_LIP, UPPER_LIP, apply_blush,
+                    apply_foundation, apply_lipstick)
+from utils import face_skin_mask, gamma_correction, mask_skin
+
+# Centred, and pushed against the top left and bottom right corners so the ROIs are clipped by the frame
+OFFSETS = [(0.0, 0.0), (-0.45, -0.5), (0.4, 0.35)]
+
+
+def reference_lipstick(image, color_rgb, landmarks, alpha=0.4):
+    h, w = image.shape[:2]
+    mask = np.zeros_like(image)
+    lip_points = normalize_landmarks(landmarks, h, w, UPPER_LIP + LOWER_LIP)
+    cv2.fillPoly(mask, [lip_points.astype(np.int32)], color_rgb)
+    mask = cv2.GaussianBlur(mask, (15, 15), 3)
+    return cv2.addWeighted(image, 1.0, mask, alpha, 0)
+
+
+def reference_blush(image, color_rgb, landmarks, intensity=0.3, radius=40):
+    h, w = image.shape[:2]
+    mask = np.zeros_like(image)
+    for point in normalize_landmarks(landmarks, h, w, CHEEKS):
+        x, y = int(point[0]), int(point[1])
+        y_min, y_max = max(0, y-radius), min(h, y+radius+1)
+        x_min, x_max = max(0, x-radius), min(w, x+radius+1)
+
+        yy, xx = np.ogrid[y_min:y_max, x_min:x_max]
+        dist = np.sqrt((yy - y)**2 + (xx - x)**2)
+        gradient = np.zeros_like(dist, dtype=np.float32)
+        valid = dist <= radius
+        gradient[valid] = (1.0 + np.cos(np.pi * dist[valid] / radius)) / 2.0
+        for c in range(3):
+            mask[y_min:y_max, x_min:x_max, c] = np.maximum(mask[y_min:y_max, x_min:x_max, c],
+                                                           (color_rgb[c] * gradient).astype(np.uint8))
+
+    blur_rad = max(3, radius // 3)
+    if blur_rad % 2 == 0:
+        blur_rad += 1
+    mask = cv2.GaussianBlur(mask, (blur_rad, blur_rad), blur_rad // 2)
+    return cv2.addWeighted(image, 1.0, mask, intensity * 0.5, 0)
+
+
+def reference_gamma(src, gamma, coefficient=1):
+    dst = src / 255.
+    dst = coefficient * np.power(dst, gamma)
+    return (dst * 255).astype('uint8')
+
+
+def reference_foundation(image, preset_name, skin_mask):
+    preset = FOUNDATION_PRESETS.get(preset_name, FOUNDATION_PRESETS["Medium"])
+    intensity, gamma_val, warm_shift = preset["intensity"], preset["gamma"], preset["warm_shift"]
+    corrected = reference_gamma(image, gamma_val)
+    if warm_shift > 0:
+        corrected = corrected.astype(np.float32)
+        corrected[:, :, 2] = np.clip(corrected[:, :, 2] * (1.0 + warm_shift), 0, 255)
+        corrected = corrected.astype(np.uint8)
+
+    output = image.copy()
+    skin_pixels = skin_mask[:, :, 0] > 0
+    output[skin_pixels] = cv2.addWeighted(image[skin_pixels], 1.0 - intensity, corrected[skin_pixels], intensity, 0)
+    return output
+
+
+def face_at(offset):
+    landmarks = synthetic_landmarks()
+    landmarks[:, :2] += np.array(offset, dtype=np.float32)
+    return synthetic_face(480, 640, synthetic_landmarks()), landmarks
+
+
+@pytest.mark.parametrize("offset", OFFSETS)
+@pytest.mark.parametrize("shade", ["Red", "Wine", "Nude"])
+def test_lipstick(offset, shade):
+    img, landmarks = face_at(offset)
+    color = LIPSTICK_COLORS[shade]
+    expected = reference_lipstick(img, color, landmarks)
+    np.testing.assert_array_equal(apply_lipstick(img.copy(), color, landmarks), expected)
+
+
+@pytest.mark.parametrize("offset", OFFSETS)
+@pytest.mark.parametrize("shade", ["Pink", "Berry"])
+@pytest.mark.parametrize("intensity", [0.1, 0.5, 1.0])
+def test_blush(offset, shade, intensity):
+    img, landmarks = face_at(offset)
+    color = BLUSH_COLORS[shade]
+    expected = reference_blush(img, color, landmarks, intensity)
+    np.testing.assert_array_equal(apply_blush(img.copy(), color, landmarks, intensity), expected)
+
+
+@pytest.mark.parametrize("gamma", [0.5, 1.2, 1.75, 2.2])
+def test_gamma_correction(gamma):
+    img = synthetic_face(480, 640, synthetic_landmarks())
+    np.testing.assert_array_equal(gamma_correction(img, gamma), reference_gamma(img, gamma))
+    np.testing.assert_array_equal(gamma_correction(img, gamma, 2), reference_gamma(img, gamma, 2))
+
+
+@pytest.mark.parametrize("preset", list(FOUNDATION_PRESETS))
+def test_foundation(preset):
+    img, landmarks = face_at(OFFSETS[0])
+    for skin_mask in (mask_skin(img), face_skin_mask(img, landmarks)):
+        if isinstance(skin_mask, tuple):
+            mask, roi = skin_mask
+            skin_mask = np.zeros((*img.shape[:2], 1), dtype=np.uint8)
+            skin_mask[roi] = mask
+        expected = reference_foundation(img, preset, skin_mask)
+        np.testing.assert_array_equal(apply_foundation(img, preset, skin_mask=skin_mask), expected)
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
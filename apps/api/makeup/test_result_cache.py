@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""Checks for the two-tier rendered-result cache"""
+import os
+import time
+
+import pytest
+
+from cache import CachedResult, ResultCache, result_key
+from render import MakeupConfig, OutputOptions, compile_look
+
+
+def result(size: int, fill: bytes = b"x") -> CachedResult:
+    return CachedResult(fill * size, "token", [{"index": 0, "box": [1, 2, 3, 4]}])
+
+
+def test_memory_tier_is_a_bounded_lru():
+    cache = ResultCache(max_entries=2, max_bytes=1000, directory=None)
+    cache.put(["a"], result(100))
+    cache.put(["b"], result(100))
+    assert cache.get(["a"])[1] == "memory"
+    cache.put(["c"], result(100))
+
+    assert cache.get(["b"]) == (None, None)
+    assert cache.get(["missing", "c"])[1] == "memory"
+    cache.put(["big"], result(2000))
+    assert cache.get(["big"]) == (None, None)
+
+    stats = cache.stats()
+    assert (stats["memory_hits"], stats["misses"], stats["memory_evictions"]) == (2, 2, 1)
+    assert stats["entries"] == 2 and stats["bytes"] == 200
+
+
+def test_disk_tier_survives_a_restart_and_is_bounded(tmp_path):
+    cache = ResultCache(max_entries=1, directory=str(tmp_path), disk_bytes=10_000)
+    first = result(3000, b"1")
+    cache.put(["one", "alias"], first)
+    cache.put(["two"], result(3000, b"2"))
+
+    # Evicted from memory, still on disk, promoted back on a hit
+    found, tier = cache.get(["one"])
+    assert tier == "disk" and found.image == first.image and found.etag == first.etag
+    assert found.faces == first.faces and found.landmark_token == "token"
+    assert cache.get(["one"])[1] == "memory"
+
+    # A new process orders the files it finds by access time, which is coarse: make it unambiguous. The
+    # modification time is when the file was written, which expiry counts from
+    for age, key in enumerate(["alias", "two", "one"]):
+        path = tmp_path / f"{key}.result"
+        os.utime(path, (age, path.stat().st_mtime))
+    restarted = ResultCache(directory=str(tmp_path), disk_bytes=10_000)
+    assert restarted.get(["alias"])[0].image == first.image
+    # Over the disk bound the least recently used file goes: "two", "alias" was just read
+    restarted.put(["three"], result(3000, b"3"))
+    assert restarted.stats()["disk_bytes"] <= 10_000 and restarted.stats()["disk_evictions"] == 1
+    assert restarted.get(["two"]) == (None, None)
+    assert restarted.get(["one"])[1] == "disk"
+
+
+def test_unreadable_files_are_dropped(tmp_path):
+    cache = ResultCache(directory=str(tmp_path))
+    (tmp_path / "broken.result").write_bytes(b"not a cached result")
+    assert cache.get(["broken"]) == (None, None)
+    assert not os.listdir(tmp_path)
+
+
+def test_results_expire_in_both_tiers(tmp_path):
+    cache = ResultCache(max_entries=1, directory=str(tmp_path), ttl=0.2)
+    cache.put(["memory"], result(10))
+    cache.put(["disk"], result(10))
+    assert cache.get(["memory"])[1] == "disk" and cache.get(["disk"])[1] == "disk"
+    time.sleep(0.3)
+    assert cache.get(["memory"]) == (None, None) and cache.get(["disk"]) == (None, None)
+    assert not os.listdir(tmp_path) and cache.stats()["entries"] == 0
+
+    # Files nobody reads again are swept by the next write once expired
+    cache.put(["stale"], result(10))
+    time.sleep(0.3)
+    ResultCache(directory=str(tmp_path), ttl=0.2).put(["fresh"], result(10))
+    assert os.listdir(tmp_path) == ["fresh.result"]
+
+
+def test_etag_follows_the_image_bytes():
+    assert result(10).etag == result(10).etag != result(10, b"y").etag
+    assert result(10).etag.startswith('"') and result(10).etag.endswith('"')
+
+
+def test_keys_ignore_settings_that_do_not_change_the_output():
+    def key(config: MakeupConfig, options: OutputOptions = OutputOptions()):
+        return result_key("image", compile_look(config).key, options.key, 1)
+
+    assert key(MakeupConfig(lipstick_color="Unknown")) == key(MakeupConfig(lipstick_color="Red"))
+    assert key(MakeupConfig(apply_blush=False, blush_intensity=10)) == key(MakeupConfig(apply_blush=False))
+    assert key(MakeupConfig(blush_intensity=10)) != key(MakeupConfig())
+    assert key(MakeupConfig(), OutputOptions(quality=80)) != key(MakeupConfig())
+    assert (key(MakeupConfig(), OutputOptions(output_format="png", quality=80))
+            == key(MakeupConfig(), OutputOptions(output_format="png")))
+    assert result_key("image", 1) != result_key("other", 1)
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
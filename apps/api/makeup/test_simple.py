@@ -6,8 +6,9 @@ from PIL import Image
 from landmarks import detect_landmarks, normalize_landmarks
 from utils import gamma_correction, mask_skin
 
-# Import functions from app
-from app import apply_lipstick, apply_blush, apply_foundation, process_image, LIPSTICK_COLORS, BLUSH_COLORS
+# Import functions from the rendering core, app.py only loads Gradio when its UI is built
+from render import apply_lipstick, apply_blush, apply_foundation, LIPSTICK_COLORS, BLUSH_COLORS
+from app import process_image
 
 # Load test image
 print("Loading pic.jpg...")
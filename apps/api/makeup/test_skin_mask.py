@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""Checks for the landmark-guided skin mask used by foundation"""
+import cv2
+import numpy as np
+import pytest
+
+from benchmark import SKIN_BGR, synthetic_face, synthetic_landmarks
+from landmarks import normalize_landmarks
+from utils import (apply_feature, face_conn, face_skin_mask, gamma_correction, left_eye, lower_lip, mask_skin, right_eye,
+                   skin_foundation, upper_lip)
+
+HEIGHT, WIDTH = 480, 640
+
+
+def full_frame(mask: np.ndarray, roi) -> np.ndarray:
+    frame = np.zeros((HEIGHT, WIDTH), dtype=np.uint8)
+    frame[roi] = mask[..., 0]
+    return frame
+
+
+def polygon(landmarks: np.ndarray, indices) -> np.ndarray:
+    frame = np.zeros((HEIGHT, WIDTH), dtype=np.uint8)
+    cv2.fillPoly(frame, [normalize_landmarks(landmarks, HEIGHT, WIDTH, indices)], 1)
+    return frame
+
+
+def test_mask_stays_inside_the_face_oval():
+    landmarks = synthetic_landmarks()
+    img = synthetic_face(HEIGHT, WIDTH, landmarks)
+    # Skin-toned background, e.g. a hand or a wall, that the full-frame color test picks up
+    img[20:100, 20:120] = SKIN_BGR
+
+    mask, roi = face_skin_mask(img, landmarks)
+    assert mask.dtype == np.uint8 and mask.shape == (roi[0].stop - roi[0].start, roi[1].stop - roi[1].start, 1)
+    assert set(np.unique(mask)) <= {0, 1}
+
+    skin = full_frame(mask, roi)
+    assert mask_skin(img)[20:100, 20:120].all()
+    assert not skin[20:100, 20:120].any()
+    assert not (skin & (1 - polygon(landmarks, face_conn))).any()
+    # Inside the oval it agrees with the color test
+    inside = polygon(landmarks, face_conn).astype(bool) & (skin == 1)
+    assert (mask_skin(img)[..., 0][inside] == 1).all()
+
+
+def test_eyes_and_lips_are_excluded():
+    landmarks = synthetic_landmarks()
+    img = synthetic_face(HEIGHT, WIDTH, landmarks)
+    # Paint everything skin-toned so only the landmarks can exclude anything
+    img[:] = SKIN_BGR
+
+    skin = full_frame(*face_skin_mask(img, landmarks))
+    for feature in (left_eye, right_eye, upper_lip + lower_lip):
+        assert not (skin & polygon(landmarks, feature)).any()
+    # Cheeks and forehead are kept
+    for x, y in normalize_landmarks(landmarks, HEIGHT, WIDTH, [425, 205]):
+        assert skin[y, x] == 1
+    assert skin[int(HEIGHT * 0.32), WIDTH // 2] == 1
+
+
+@pytest.mark.parametrize("offset", [(-0.45, -0.5), (0.4, 0.35)])
+def test_face_clipped_by_the_frame(offset):
+    landmarks = synthetic_landmarks()
+    img = synthetic_face(HEIGHT, WIDTH, landmarks)
+    landmarks[:, :2] += np.array(offset, dtype=np.float32)
+
+    mask, (rows, cols) = face_skin_mask(img, landmarks)
+    assert 0 <= rows.start <= rows.stop <= HEIGHT and 0 <= cols.start <= cols.stop <= WIDTH
+    assert mask.shape[:2] == (rows.stop - rows.start, cols.stop - cols.start)
+
+
+def test_face_outside_the_frame():
+    landmarks = synthetic_landmarks()
+    img = synthetic_face(HEIGHT, WIDTH, landmarks)
+    landmarks[:, 0] += 2.0
+
+    mask, _ = face_skin_mask(img, landmarks)
+    assert mask.size == 0
+
+
+def test_foundation_stays_on_the_face():
+    landmarks = synthetic_landmarks()
+    img = synthetic_face(HEIGHT, WIDTH, landmarks)
+    # A skin-toned patch in the corner, away from the face
+    img[:40, :40] = SKIN_BGR
+
+    output = skin_foundation(img, landmarks)
+    face = full_frame(*face_skin_mask(img, landmarks)).astype(bool)
+    np.testing.assert_array_equal(output[face], gamma_correction(img, 1.75)[face])
+    np.testing.assert_array_equal(output[~face], img[~face])
+    np.testing.assert_array_equal(apply_feature(img, "foundation", landmarks, normalize=True), output)
+
+    # Without landmarks the whole frame is searched for skin, the patch included
+    anywhere = skin_foundation(img)
+    assert (anywhere[:40, :40] != img[:40, :40]).any()
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
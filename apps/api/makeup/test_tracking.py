@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""Checks for the optical-flow landmark tracker used by the video stream"""
+import cv2
+import numpy as np
+import pytest
+
+from benchmark import synthetic_face, synthetic_landmarks
+from tracking import TRACKED_POINTS, LandmarkTracker
+
+HEIGHT, WIDTH = 720, 1280
+
+
+@pytest.fixture(scope="module")
+def scene():
+    """A synthetic face with skin texture, the optical flow needs something to lock onto"""
+    landmarks = synthetic_landmarks()
+    noise = np.random.default_rng(0).integers(0, 255, (HEIGHT, WIDTH, 3), dtype=np.uint8)
+    img = cv2.addWeighted(synthetic_face(HEIGHT, WIDTH, landmarks), 0.8, cv2.GaussianBlur(noise, (5, 5), 1.5), 0.2, 0)
+    return img, landmarks
+
+
+def shifted(scene, dx: int, dy: int):
+    """The scene moved by (dx, dy) pixels, and its true landmarks"""
+    img, landmarks = scene
+    frame = cv2.warpAffine(img, np.float32([[1, 0, dx], [0, 1, dy]]), (WIDTH, HEIGHT), borderMode=cv2.BORDER_REFLECT)
+    moved = landmarks.copy()
+    moved[:, :2] += np.array([dx / WIDTH, dy / HEIGHT], dtype=np.float32)
+    return frame, moved
+
+
+def pixel_error(face: np.ndarray, truth: np.ndarray) -> np.ndarray:
+    return np.abs((face[TRACKED_POINTS, :2] - truth[TRACKED_POINTS, :2]) * (WIDTH, HEIGHT)).max(axis=1)
+
+
+def test_detects_on_keyframes_and_tracks_in_between(scene):
+    detections = []
+
+    def detect(img):
+        detections.append(tracker.frames)
+        return [truth]
+
+    tracker = LandmarkTracker(keyframe_interval=5, smoothing=0, detect=detect)
+    for i in range(12):
+        frame, truth = shifted(scene, 3 * i, 2 * i)
+        faces = tracker.process(frame)
+        assert len(faces) == 1 and faces[0].shape == truth.shape
+        assert pixel_error(faces[0], truth).max() < 1.5
+        assert tracker.detected == (i % 5 == 0)
+
+    assert detections == [0, 5, 10]
+    assert tracker.stats() == {"frames": 12, "detections": 3, "skipped_fraction": 0.75}
+
+
+def test_lost_tracking_detects_again(scene):
+    tracker = LandmarkTracker(keyframe_interval=30, detect=lambda img: [scene[1]])
+    tracker.process(scene[0])
+    tracker.process(shifted(scene, 2, 1)[0])
+    assert not tracker.detected
+
+    # A scene cut: nothing of the previous frame can be followed
+    cut = np.random.default_rng(1).integers(0, 255, scene[0].shape, dtype=np.uint8)
+    tracker.process(cut)
+    assert tracker.detected and tracker.detections == 2
+
+
+def test_no_face_detects_every_frame(scene):
+    tracker = LandmarkTracker(keyframe_interval=10, detect=lambda img: [])
+    for _ in range(3):
+        assert tracker.process(scene[0]) == []
+    assert tracker.detections == 3 and tracker.skipped_fraction == 0.0
+
+
+def test_smoothing_removes_jitter_but_follows_motion(scene):
+    rng = np.random.default_rng(2)
+    img, landmarks = scene
+    jitter = 0.6 / WIDTH
+
+    def noisy_detection(img):
+        noisy = landmarks.copy()
+        noisy[:, :2] += rng.normal(0, jitter, (len(landmarks), 2)).astype(np.float32)
+        return [noisy]
+
+    raw = LandmarkTracker(keyframe_interval=1, smoothing=0, detect=noisy_detection)
+    smoothed = LandmarkTracker(keyframe_interval=1, smoothing=0.5, detect=noisy_detection)
+    raw_spread = np.std([raw.process(img)[0][:, :2] for _ in range(20)], axis=0).mean()
+    smoothed_spread = np.std([smoothed.process(img)[0][:, :2] for _ in range(20)], axis=0).mean()
+    assert smoothed_spread < 0.8 * raw_spread
+
+    # A large jump is followed almost fully right away
+    smoothed._detect = lambda img: [shifted(scene, 40, 0)[1]]
+    face = smoothed.process(img)[0]
+    assert pixel_error(face, shifted(scene, 40, 0)[1]).max() < 2
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
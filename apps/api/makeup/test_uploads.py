@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Checks for the upload size limit, the JPEG header reader and reduced decoding"""
+import cv2
+import numpy as np
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from uploads import UploadLimitMiddleware, decode_image, fit_to_max_side, jpeg_size, reduced_decode_flag
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+
+    @app.post("/api/makeup/echo")
+    @app.post("/api/makeup/video")
+    @app.post("/other")
+    async def echo(request: Request):
+        return {"received": len(await request.body())}
+
+    app.add_middleware(UploadLimitMiddleware, max_bytes=100, path_limits={"/api/makeup/video": 1000})
+    return TestClient(app)
+
+
+def chunks(size: int, chunk: int = 30):
+    for start in range(0, size, chunk):
+        yield b"x" * min(chunk, size - start)
+
+
+def test_content_length_over_the_limit_is_refused(client):
+    assert client.post("/api/makeup/echo", content=b"x" * 100).json() == {"received": 100}
+    refused = client.post("/api/makeup/echo", content=b"x" * 101)
+    assert refused.status_code == 413 and refused.json()["detail"] == "Request body exceeds the 100 byte limit"
+    # Other limits per path, nothing outside the prefix
+    assert client.post("/api/makeup/video", content=b"x" * 1000).status_code == 200
+    assert client.post("/api/makeup/video", content=b"x" * 1001).status_code == 413
+    assert client.post("/other", content=b"x" * 5000).status_code == 200
+
+
+def test_chunked_body_is_counted_as_it_arrives(client):
+    # A generator body is sent chunked, without Content-Length
+    assert client.post("/api/makeup/echo", content=chunks(100)).json() == {"received": 100}
+    refused = client.post("/api/makeup/echo", content=chunks(200))
+    assert refused.status_code == 413 and refused.json()["detail"] == "Request body exceeds the 100 byte limit"
+
+
+def encoded(height: int, width: int, ext: str = ".jpg") -> bytes:
+    img = np.random.default_rng(0).integers(0, 255, (height, width, 3), dtype=np.uint8)
+    return cv2.imencode(ext, img)[1].tobytes()
+
+
+def test_jpeg_size():
+    photo = encoded(300, 200)
+    assert jpeg_size(photo) == (300, 200)
+    progressive = cv2.imencode(".jpg", np.zeros((64, 96, 3), np.uint8), [cv2.IMWRITE_JPEG_PROGRESSIVE, 1])[1]
+    assert jpeg_size(progressive.tobytes()) == (64, 96)
+
+    assert jpeg_size(encoded(300, 200, ".png")) is None
+    assert jpeg_size(b"") is None and jpeg_size(b"\xff\xd8") is None
+    # Cut off before or inside the start-of-frame segment
+    start_of_frame = photo.index(b"\xff\xc0")
+    assert jpeg_size(photo[:start_of_frame]) is None and jpeg_size(photo[:start_of_frame + 6]) is None
+    assert jpeg_size(b"\xff\xd8" + b"\x00" * 20) is None
+
+
+def test_reduced_decode_flag():
+    photo = encoded(1600, 1200)
+    assert reduced_decode_flag(photo, None) == cv2.IMREAD_COLOR
+    assert reduced_decode_flag(photo, 200) == cv2.IMREAD_REDUCED_COLOR_8
+    assert reduced_decode_flag(photo, 201) == cv2.IMREAD_REDUCED_COLOR_4
+    assert reduced_decode_flag(photo, 800) == cv2.IMREAD_REDUCED_COLOR_2
+    assert reduced_decode_flag(photo, 801) == cv2.IMREAD_COLOR
+    assert reduced_decode_flag(encoded(1600, 1200, ".png"), 200) == cv2.IMREAD_COLOR
+    assert reduced_decode_flag(photo[:10], 200) == cv2.IMREAD_COLOR
+
+
+def test_decode_fits_the_longest_side():
+    assert decode_image(encoded(1600, 1200), 500).shape == (500, 375, 3)
+    assert decode_image(encoded(1600, 1200, ".png"), 500).shape == (500, 375, 3)
+    assert decode_image(encoded(160, 120), 500).shape == (160, 120, 3)
+    img = np.zeros((10, 1000, 3), np.uint8)
+    assert fit_to_max_side(img, 100).shape == (1, 100, 3) and fit_to_max_side(img, None) is img
+    with pytest.raises(ValueError):
+        decode_image(b"not an image")
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
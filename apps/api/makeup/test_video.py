@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""Checks for the pipelined video renderer"""
+import threading
+
+import cv2
+import numpy as np
+import pytest
+
+import video
+from benchmark import synthetic_face, synthetic_landmarks
+from render import MakeupConfig, render_makeup
+
+HEIGHT, WIDTH, FRAMES = 240, 320, 24
+
+
+@pytest.fixture(scope="module")
+def clip(tmp_path_factory):
+    """A short clip of a synthetic face moving sideways, and its landmarks"""
+    landmarks = synthetic_landmarks()
+    face = synthetic_face(HEIGHT, WIDTH, landmarks)
+    path = str(tmp_path_factory.mktemp("video") / "clip.mp4")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), 24, (WIDTH, HEIGHT))
+    for i in range(FRAMES):
+        writer.write(np.roll(face, i, axis=1))
+    writer.release()
+    return path, landmarks
+
+
+def read_frames(path: str) -> list:
+    capture = cv2.VideoCapture(path)
+    frames = []
+    while True:
+        ok, frame = capture.read()
+        if not ok:
+            return frames
+        frames.append(frame)
+
+
+@pytest.mark.parametrize("video_format", sorted(video.VIDEO_FORMATS))
+def test_renders_every_frame(clip, tmp_path, video_format):
+    path, landmarks = clip
+    destination = str(tmp_path / f"out{video.VIDEO_FORMATS[video_format][0]}")
+    summary, timings = video.render_video(path, destination, MakeupConfig(lipstick_color="Wine"), video_format,
+                                          keyframe_interval=6, detect=lambda frame: [landmarks])
+
+    assert summary["frames"] == summary["face_frames"] == FRAMES
+    assert (summary["width"], summary["height"]) == (WIDTH, HEIGHT) and summary["fps"] == 24
+    assert summary["detection_skipped"] == 0.833 and summary["codec"] in video.VIDEO_FORMATS[video_format][1]
+    assert {"decode", "landmarks", "tracking", "lipstick", "encode"} <= set(timings.stages)
+
+    rendered = read_frames(destination)
+    assert len(rendered) == FRAMES
+    first = read_frames(path)[0]
+    expected, _ = render_makeup(first, MakeupConfig(lipstick_color="Wine"), [landmarks])
+    # Lossy codecs: the output is close to the rendered frame and clearly differs from the input
+    assert np.abs(rendered[0].astype(int) - expected).mean() < np.abs(rendered[0].astype(int) - first).mean()
+
+
+def test_downscales_and_keeps_frames_without_faces(clip, tmp_path):
+    destination = str(tmp_path / "out.mp4")
+    summary, _ = video.render_video(clip[0], destination, MakeupConfig(), max_side=160, detect=lambda frame: [])
+    assert summary["frames"] == FRAMES and summary["face_frames"] == 0
+    assert read_frames(destination)[0].shape == (120, 160, 3)
+
+
+def test_falls_back_to_the_next_codec(clip, tmp_path, monkeypatch):
+    # The preferred codec is one no build can encode, as H.264 with the opencv-python wheels
+    monkeypatch.setitem(video.VIDEO_FORMATS, "mp4", (".mp4", ("XXXX", "mp4v"), "video/mp4"))
+    assert video.video_fourccs("mp4") == ["mp4v"]
+    destination = str(tmp_path / "out.mp4")
+    summary, _ = video.render_video(clip[0], destination, MakeupConfig(), detect=lambda frame: [])
+    assert summary["codec"] == "mp4v" and len(read_frames(destination)) == FRAMES
+
+
+def test_invalid_and_too_long_clips(clip, tmp_path):
+    bogus = tmp_path / "bogus.mp4"
+    bogus.write_bytes(b"not a video")
+    with pytest.raises(ValueError):
+        video.render_video(str(bogus), str(tmp_path / "out.mp4"), MakeupConfig(), detect=lambda frame: [])
+    with pytest.raises(ValueError, match="frames"):
+        video.render_video(clip[0], str(tmp_path / "out.mp4"), MakeupConfig(), max_frames=10,
+                           detect=lambda frame: [])
+
+
+def test_failing_stage_stops_the_pipeline(clip, tmp_path):
+    threads = threading.active_count()
+    with pytest.raises(RuntimeError, match="Cannot write"):
+        video.render_video(clip[0], str(tmp_path / "missing" / "out.mp4"), MakeupConfig(), queue_size=1,
+                           detect=lambda frame: [clip[1]])
+    assert threading.active_count() == threads
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,179 @@
+"""
+Landmark tracking for video: FaceMesh on keyframes only, sparse optical flow on the frames in between.
+
+Running FaceMesh on every frame, even in tracking mode, keeps a CPU stream well below 30 fps. Between
+keyframes the lip, cheek, eye and face-oval landmarks are followed with pyramidal Lucas-Kanade flow on a
+downscaled grayscale frame, and every other landmark follows the face's similarity motion fitted to the
+tracked points. Each tracked point is checked by flowing it back to the previous frame; detection runs
+again on the next keyframe, or as soon as too few points survive that check. Small movements are
+smoothed over time to remove jitter, larger ones pass through so the landmarks do not lag behind.
+"""
+
+import os
+from typing import Callable, List, Optional
+
+import cv2
+import numpy as np
+
+from landmarks import MAX_FACES, create_tracker, process_faces
+from utils import cheeks, face_conn, left_eye, lower_lip, right_eye, upper_lip
+
+# Frames per full detection: detect on one, propagate with optical flow on the next N - 1 (1 = every frame)
+KEYFRAME_INTERVAL = int(os.environ.get("MAKEUP_TRACK_KEYFRAME_INTERVAL", 10))
+# Fraction of a face's tracked points that must pass the forward-backward check, otherwise detect again
+MIN_TRACKED = float(os.environ.get("MAKEUP_TRACK_MIN_TRACKED", 0.6))
+# Largest forward-backward flow error in pixels (at the flow resolution) for a point to count as tracked
+MAX_FLOW_ERROR = float(os.environ.get("MAKEUP_TRACK_MAX_FLOW_ERROR", 1.0))
+# Weight of the previous position for jitter-sized movements (0 disables smoothing)
+SMOOTHING = float(os.environ.get("MAKEUP_TRACK_SMOOTHING", 0.5))
+# Longest side of the grayscale frame the optical flow runs on
+FLOW_MAX_SIDE = int(os.environ.get("MAKEUP_TRACK_MAX_SIDE", 640))
+
+# Movements much smaller than this many flow pixels are smoothed, much larger ones are followed as is
+JITTER_PX = 1.5
+
+# The landmarks rendering depends on: lips, cheeks, the face oval and the eyes cut out of the skin mask
+TRACKED_POINTS = np.array(sorted(set(upper_lip + lower_lip + cheeks + face_conn + left_eye + right_eye)))
+
+LK_WINDOW = (21, 21)
+LK_LEVELS = 3
+# minEigThreshold rejects points in flat regions (e.g. mid-cheek), where the flow sticks at zero motion
+LK_PARAMS = dict(winSize=LK_WINDOW, maxLevel=LK_LEVELS, minEigThreshold=1e-3,
+                 criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03))
+
+
+def flow_input(src: np.ndarray, max_side: int = FLOW_MAX_SIDE) -> np.ndarray:
+    """
+    Grayscale copy of `src` downscaled so its longest side is at most `max_side`, aspect ratio kept.
+    Bilinear resizing of the color frame, then conversion: several times cheaper than INTER_AREA on a
+    full-HD frame, and the flow builds its own smoothed pyramid anyway.
+    """
+    height, width = src.shape[:2]
+    longest = max(height, width)
+    if max_side and longest > max_side:
+        scale = max_side / longest
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        src = cv2.resize(src, size, interpolation=cv2.INTER_LINEAR)
+    return cv2.cvtColor(src, cv2.COLOR_BGR2GRAY)
+
+
+class LandmarkTracker:
+    """
+    Follows up to `max_faces` faces through the frames of one video, in order; not thread-safe.
+    `process(frame)` returns one packed landmark array per face, like `landmarks.detect_faces`.
+    Detection uses a FaceMesh in tracking mode owned by the tracker, or the `detect` callable
+    (frame -> list of faces) when given; close the tracker when the video ends.
+    """
+
+    def __init__(self, max_faces: int = 1, keyframe_interval: int = KEYFRAME_INTERVAL,
+                 min_tracked: float = MIN_TRACKED, max_flow_error: float = MAX_FLOW_ERROR,
+                 smoothing: float = SMOOTHING, max_side: int = FLOW_MAX_SIDE, detect: Callable = None):
+        self.max_faces = max(1, min(max_faces, MAX_FACES))
+        self.keyframe_interval = max(1, keyframe_interval)
+        self.min_tracked = min_tracked
+        self.max_flow_error = max_flow_error
+        self.smoothing = smoothing
+        self.max_side = max_side
+        self._face_mesh = None
+        if detect is None:
+            self._face_mesh = create_tracker(self.max_faces)
+            detect = self._detect_face_mesh
+        self._detect = detect
+
+        self._gray = None
+        # Raw detected / tracked landmarks, flow always continues from these; `_output` are the smoothed ones
+        self._faces = []
+        self._output = []
+        self._since_keyframe = 0
+        self.frames = 0
+        self.detections = 0
+        # Whether the last processed frame ran detection
+        self.detected = False
+
+    def _detect_face_mesh(self, src: np.ndarray) -> List[np.ndarray]:
+        return process_faces(self._face_mesh, src)
+
+    @property
+    def skipped_fraction(self) -> float:
+        """Fraction of the processed frames whose landmarks came from optical flow instead of detection"""
+        return 1.0 - self.detections / self.frames if self.frames else 0.0
+
+    def stats(self) -> dict:
+        return {"frames": self.frames, "detections": self.detections,
+                "skipped_fraction": round(self.skipped_fraction, 3)}
+
+    def process(self, src: np.ndarray) -> List[np.ndarray]:
+        """The landmarks of every face in the next frame of the video, largest face first at the last keyframe"""
+        gray = flow_input(src, self.max_side)
+        faces = None
+        if (self._faces and self._since_keyframe + 1 < self.keyframe_interval
+                and self._gray is not None and self._gray.shape == gray.shape):
+            faces = self._track(gray)
+
+        self.detected = faces is None
+        if faces is None:
+            faces = self._detect(src)[:self.max_faces]
+            self.detections += 1
+            self._since_keyframe = 0
+        else:
+            self._since_keyframe += 1
+
+        self.frames += 1
+        self._gray = gray
+        self._faces = faces
+        self._output = self._smooth(faces, gray.shape)
+        return [face.copy() for face in self._output]
+
+    def _track(self, gray: np.ndarray) -> Optional[List[np.ndarray]]:
+        """The faces of the previous frame moved onto `gray`, None when they cannot be tracked reliably"""
+        h, w = gray.shape
+        scale = np.array([w, h], dtype=np.float32)
+        previous = (np.concatenate([face[TRACKED_POINTS, :2] for face in self._faces]) * scale).reshape(-1, 1, 2)
+        forward, status, _ = cv2.calcOpticalFlowPyrLK(self._gray, gray, previous, None, **LK_PARAMS)
+        backward, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self._gray, forward, None, **LK_PARAMS)
+        previous, forward, backward = previous[:, 0], forward[:, 0], backward[:, 0]
+
+        error = np.linalg.norm(backward - previous, axis=1)
+        inside = ((forward >= 0) & (forward < scale)).all(axis=1)
+        good = (status[:, 0] == 1) & (back_status[:, 0] == 1) & (error < self.max_flow_error) & inside
+
+        faces = []
+        count = len(TRACKED_POINTS)
+        for i, face in enumerate(self._faces):
+            part = slice(i * count, (i + 1) * count)
+            tracked = good[part]
+            if tracked.mean() < self.min_tracked:
+                return None
+            motion, _ = cv2.estimateAffinePartial2D(previous[part][tracked], forward[part][tracked],
+                                                    method=cv2.RANSAC, ransacReprojThreshold=2 * self.max_flow_error)
+            if motion is None:
+                return None
+            # Untracked landmarks follow the face's overall motion, tracked ones their own flow
+            points = face[:, :2] * scale @ motion[:, :2].T + motion[:, 2]
+            points[TRACKED_POINTS[tracked]] = forward[part][tracked]
+            moved = face.copy()
+            moved[:, :2] = points / scale
+            faces.append(moved)
+        return faces
+
+    def _smooth(self, faces: List[np.ndarray], shape) -> List[np.ndarray]:
+        """
+        Pulls each landmark towards its previous output position by up to `smoothing`, the less the further
+        it moved, so still faces stop jittering while moving faces are followed without lag
+        """
+        if not self.smoothing or len(faces) != len(self._output):
+            return faces
+        scale = np.array([shape[1], shape[0]], dtype=np.float32)
+        smoothed = []
+        for face, previous in zip(faces, self._output):
+            delta = face[:, :2] - previous[:, :2]
+            distance = np.linalg.norm(delta * scale, axis=1, keepdims=True)
+            face = face.copy()
+            face[:, :2] -= self.smoothing / (1 + (distance / JITTER_PX) ** 2) * delta
+            smoothed.append(face)
+        return smoothed
+
+    def close(self):
+        if self._face_mesh is not None:
+            self._face_mesh.close()
+            self._face_mesh = None
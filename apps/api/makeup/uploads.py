@@ -0,0 +1,152 @@
+"""
+Request input: upload size limit and image decoding.
+
+Request bodies are counted as they stream in and rejected with 413 as soon as they exceed the limit,
+before multipart or JSON parsing has buffered them. Images are decoded straight from the received bytes
+with `cv2.imdecode`, no PIL round-trip; JPEGs are decoded at a reduced scale when a smaller output was
+requested, so a 12MP photo rendered at 1280px never exists in memory at full resolution.
+"""
+
+import base64
+import binascii
+import os
+from typing import Optional
+
+import cv2
+import numpy as np
+# Plain Starlette, FastAPI handles its exceptions the same way; keeps decoding importable without FastAPI
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse
+
+# Largest accepted request body in bytes (0 disables the limit). Base64 bodies are a third larger than the image.
+MAX_UPLOAD_BYTES = int(os.environ.get("MAKEUP_MAX_UPLOAD_BYTES", 20 * 2 ** 20))
+
+# libjpeg can decode at 1/2, 1/4 and 1/8 scale while inverse-transforming, which is much cheaper than
+# decoding at full size and resizing
+REDUCED_DECODE_FLAGS = {8: cv2.IMREAD_REDUCED_COLOR_8, 4: cv2.IMREAD_REDUCED_COLOR_4, 2: cv2.IMREAD_REDUCED_COLOR_2}
+
+# Start-of-frame markers carry the image size; DHT (C4), JPG (C8) and DAC (CC) share the range but do not
+_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+class UploadLimitMiddleware:
+    """
+    ASGI middleware rejecting request bodies under `prefix` larger than `max_bytes` with 413.
+    `path_limits` ({path: max_bytes}) sets other limits for single paths, e.g. video uploads.
+    A too large Content-Length is refused without reading the body; otherwise the body is counted
+    chunk by chunk and the request fails as soon as the limit is crossed.
+    """
+
+    def __init__(self, app, max_bytes: int = MAX_UPLOAD_BYTES, prefix: str = "/api/makeup", path_limits: dict = None):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.path_limits = path_limits or {}
+
+    def detail(self, max_bytes: int = None) -> str:
+        return f"Request body exceeds the {max_bytes or self.max_bytes} byte limit"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+        max_bytes = self.path_limits.get(scope["path"], self.max_bytes)
+        if not max_bytes:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > max_bytes:
+            await JSONResponse({"detail": self.detail(max_bytes)}, status_code=413)(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_bytes:
+                    raise HTTPException(status_code=413, detail=self.detail(max_bytes))
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+def jpeg_size(data: bytes):
+    """
+    (height, width) read from a JPEG's start-of-frame header without decoding it, or None for
+    anything that is not a well-formed JPEG
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
+    i, n = 2, len(data)
+    while i + 9 <= n:
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:  # Fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:  # Markers without a length
+            i += 2
+            continue
+        if marker in _SOF_MARKERS:
+            return int.from_bytes(data[i + 5:i + 7], "big"), int.from_bytes(data[i + 7:i + 9], "big")
+        i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+    return None
+
+
+def reduced_decode_flag(data: bytes, max_side: Optional[int]) -> int:
+    """
+    The `cv2.imdecode` flag for `data`: the strongest JPEG reduction that still yields at least
+    `max_side` pixels on the longest side, or a full-size color decode
+    """
+    if not max_side:
+        return cv2.IMREAD_COLOR
+    size = jpeg_size(data)
+    if size is None:
+        return cv2.IMREAD_COLOR
+    longest = max(size)
+    for factor, flag in REDUCED_DECODE_FLAGS.items():
+        if -(-longest // factor) >= max_side:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def fit_to_max_side(img: np.ndarray, max_side: Optional[int]) -> np.ndarray:
+    """Downscales `img` so its longest side is at most `max_side`, keeping the aspect ratio"""
+    if not max_side:
+        return img
+    height, width = img.shape[:2]
+    longest = max(height, width)
+    if longest <= max_side:
+        return img
+    scale = max_side / longest
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+
+def decode_image(data: bytes, max_side: Optional[int] = None) -> np.ndarray:
+    """
+    Decodes an encoded image into a BGR array whose longest side is at most `max_side`.
+    Raises ValueError for data OpenCV cannot decode.
+    """
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), reduced_decode_flag(data, max_side))
+    if img is None:
+        raise ValueError("Invalid image file")
+    return fit_to_max_side(img, max_side)
+
+
+def decode_base64(image_str: str) -> bytes:
+    """
+    The bytes of a base64 image, given either bare or as a data URI.
+    Raises ValueError for malformed base64.
+    """
+    if image_str.startswith("data:"):
+        image_str = image_str.partition(",")[2]
+    try:
+        return base64.b64decode(image_str)
+    except binascii.Error as e:
+        raise ValueError(f"Invalid base64 image: {e}")
@@ -1,76 +1,137 @@
+from functools import lru_cache
+
 import cv2
 import numpy as np
 from landmarks import detect_landmarks, normalize_landmarks, plot_landmarks
-from mediapipe.python.solutions.face_detection import FaceDetection
 
 upper_lip = [61, 185, 40, 39, 37, 0, 267, 269, 270, 408, 415, 272, 271, 268, 12, 38, 41, 42, 191, 78, 76]
 lower_lip = [61, 146, 91, 181, 84, 17, 314, 405, 320, 307, 308, 324, 318, 402, 317, 14, 87, 178, 88, 95]
 face_conn = [10, 338, 297, 332, 284, 251, 389, 264, 447, 376, 433, 288, 367, 397, 365, 379, 378, 400, 377, 152,
              148, 176, 149, 150, 136, 172, 138, 213, 147, 234, 127, 162, 21, 54, 103, 67, 109]
 cheeks = [425, 205]
+left_eye = [33, 246, 161, 160, 159, 158, 157, 173, 133, 155, 154, 153, 145, 144, 163, 7]
+right_eye = [362, 398, 384, 385, 386, 387, 388, 466, 263, 249, 390, 373, 374, 380, 381, 382]
 
 
-def apply_makeup(src: np.ndarray, is_stream: bool, feature: str, show_landmarks: bool = False):
+def apply_makeup(src: np.ndarray, is_stream: bool, feature: str, show_landmarks: bool = False, tracker=None):
     """
     Takes in a source image and applies effects onto it.
+    For video pass a `tracking.LandmarkTracker` used for every frame in order: it only runs
+    detection on keyframes and follows the face with optical flow in between
     """
-    ret_landmarks = detect_landmarks(src, is_stream)
+    if tracker is not None:
+        faces = tracker.process(src)
+        ret_landmarks = faces[0] if faces else None
+    else:
+        ret_landmarks = detect_landmarks(src, is_stream)
     height, width, _ = src.shape
     feature_landmarks = None
     if feature == 'lips':
         feature_landmarks = normalize_landmarks(ret_landmarks, height, width, upper_lip + lower_lip)
-        mask = lip_mask(src, feature_landmarks, [153, 0, 157])
-        output = cv2.addWeighted(src, 1.0, mask, 0.4, 0.0)
+        mask, roi = lip_mask(src, feature_landmarks, [153, 0, 157])
+        output = blend_roi(src.copy(), mask, roi, 0.4)
     elif feature == 'blush':
         feature_landmarks = normalize_landmarks(ret_landmarks, height, width, cheeks)
-        mask = blush_mask(src, feature_landmarks, [153, 0, 157], 50)
-        output = cv2.addWeighted(src, 1.0, mask, 0.3, 0.0)
-    else:  # Defaults to blush for any other thing
-        skin_mask = mask_skin(src)
-        output = np.where(src * skin_mask >= 1, gamma_correction(src, 1.75), src)
+        mask, roi = blush_mask(src, feature_landmarks, [153, 0, 157], 50)
+        output = blend_roi(src.copy(), mask, roi, 0.3)
+    else:  # Defaults to foundation for any other thing
+        output = skin_foundation(src, ret_landmarks)
     if show_landmarks and feature_landmarks is not None:
         plot_landmarks(src, feature_landmarks, True)
     return output
 
 
-def apply_feature(src: np.ndarray, feature: str, landmarks: list, normalize: bool = False,
+def apply_feature(src: np.ndarray, feature: str, landmarks: np.ndarray, normalize: bool = False,
                   show_landmarks: bool = False):
     """
     Performs similar to `apply_makeup` but needs the landmarks explicitly
     Specifically implemented to reduce the computation on the server
+    `landmarks` are either pixel coordinates or, with `normalize`, the packed array from `detect_landmarks`;
+    foundation is limited to the face only with the packed array
     """
     height, width, _ = src.shape
+    packed = landmarks if normalize else None
     if normalize:
         landmarks = normalize_landmarks(landmarks, height, width)
     if feature == 'lips':
-        mask = lip_mask(src, landmarks, [153, 0, 157])
-        output = cv2.addWeighted(src, 1.0, mask, 0.4, 0.0)
+        mask, roi = lip_mask(src, landmarks, [153, 0, 157])
+        output = blend_roi(src.copy(), mask, roi, 0.4)
     elif feature == 'blush':
-        mask = blush_mask(src, landmarks, [153, 0, 157], 50)
-        output = cv2.addWeighted(src, 1.0, mask, 0.3, 0.0)
-    else:  # Does not require any landmarks for skin masking -> Foundation
-        skin_mask = mask_skin(src)
-        output = np.where(src * skin_mask >= 1, gamma_correction(src, 1.75), src)
+        mask, roi = blush_mask(src, landmarks, [153, 0, 157], 50)
+        output = blend_roi(src.copy(), mask, roi, 0.3)
+    else:  # Foundation
+        output = skin_foundation(src, packed)
     if show_landmarks:  # Refrain from using this during an API Call
         plot_landmarks(src, landmarks, True)
     return output
 
 
+def skin_foundation(src: np.ndarray, landmarks: np.ndarray = None):
+    """
+    Brightens the skin of the face given by its packed `landmarks`, only converting and testing the face's ROI.
+    Without landmarks every skin-toned pixel of the frame is brightened
+    """
+    if landmarks is None:
+        skin_mask = mask_skin(src)
+        return np.where(src * skin_mask >= 1, gamma_correction(src, 1.75), src)
+    skin_mask, roi = face_skin_mask(src, landmarks)
+    output = src.copy()
+    region = src[roi]
+    output[roi] = np.where(region * skin_mask >= 1, gamma_correction(region, 1.75), region)
+    return output
+
+
+def padded_roi(points: np.ndarray, pad: int, height: int, width: int):
+    """
+    Given a set of points, returns the (rows, cols) slices of their bounding box
+    grown by `pad` pixels on every side and clipped to the image.
+    Padding by at least half the blur kernel keeps blurring inside the ROI identical to blurring the full frame.
+    """
+    points = np.asarray(points)
+    x_min, y_min = points.min(axis=0) - pad
+    x_max, y_max = points.max(axis=0) + pad + 1
+    return (slice(min(height, max(0, int(y_min))), max(0, min(height, int(y_max)))),
+            slice(min(width, max(0, int(x_min))), max(0, min(width, int(x_max)))))
+
+
+def roi_is_empty(roi) -> bool:
+    rows, cols = roi
+    return rows.stop <= rows.start or cols.stop <= cols.start
+
+
+def blend_roi(dst: np.ndarray, mask: np.ndarray, roi, alpha: float):
+    """
+    Adds `alpha` times an ROI-sized `mask` onto the `roi` region of `dst`, in place.
+    Returns `dst` for convenience.
+    """
+    if roi_is_empty(roi):
+        return dst
+    region = dst[roi]
+    cv2.addWeighted(region, 1.0, mask, alpha, 0.0, dst=region)
+    return dst
+
+
 def lip_mask(src: np.ndarray, points: np.ndarray, color: list):
     """
     Given a src image, points of lips and a desired color
-    Returns a colored mask that can be added to the src with improved quality.
+    Returns a colored mask that can be added to the src with improved quality,
+    along with the (rows, cols) ROI of `src` the mask covers.
     Includes glossy finish, better blending, and edge feathering.
     """
-    mask = np.zeros_like(src)  # Create a mask
-    
     # Ensure points is proper type for cv2.fillPoly
     if isinstance(points, np.ndarray):
         points = points.astype(np.int32)
     else:
         points = np.array(points, dtype=np.int32)
-    
-    mask = cv2.fillPoly(mask, [points], color)  # Mask for the required facial feature
+
+    # Only the lips and enough margin for the blurs and erosion below are rendered
+    roi = padded_roi(points, 11 // 2 + 7 // 2 + 5 // 2 + 1, src.shape[0], src.shape[1])
+    rows, cols = roi
+    mask = np.zeros((rows.stop - rows.start, cols.stop - cols.start, src.shape[2]), dtype=src.dtype)
+    if roi_is_empty(roi):
+        return mask, roi
+
+    mask = cv2.fillPoly(mask, [points - (cols.start, rows.start)], color)  # Mask for the required facial feature
     
     # Multi-stage blurring for smoother, more natural edges
     mask = cv2.GaussianBlur(mask, (11, 11), 3)  # First pass - soften edges
@@ -87,17 +148,32 @@ def lip_mask(src: np.ndarray, points: np.ndarray, color: list):
     mask = (mask_float * 0.7 + eroded_float * 0.3) * 255
     mask = mask.astype(np.uint8)
     
-    return mask
+    return mask, roi
 
 
 def blush_mask(src: np.ndarray, points: np.ndarray, color: list, radius: int):
     """
     Given a src image, points of the cheeks, desired color and radius
-    Returns a colored mask that can be added to the src with improved quality.
+    Returns a colored mask that can be added to the src with improved quality,
+    along with the (rows, cols) ROI of `src` the mask covers.
     Includes gradient blending, soft feathering, and natural-looking diffusion.
     """
-    mask = np.zeros_like(src)  # Mask that will be used for the cheeks
-    
+    blur_radius = int(radius * 0.4)
+    if blur_radius % 2 == 0:
+        blur_radius += 1
+    blur_radius = max(3, blur_radius)  # Ensure minimum blur size
+
+    # Both cheeks plus the blur margin and the vignette windows; everything below works in ROI coordinates
+    points = np.asarray(points, dtype=np.int32)
+    vignette_ends = np.maximum(points - radius, 0) + 2 * radius
+    roi = padded_roi(np.vstack([points - radius, points + radius, vignette_ends]), blur_radius // 2 + 1,
+                     src.shape[0], src.shape[1])
+    rows, cols = roi
+    oy, ox = rows.start, cols.start
+    mask = np.zeros((rows.stop - oy, cols.stop - ox, src.shape[2]), dtype=src.dtype)
+    if roi_is_empty(roi):
+        return mask, roi
+
     # Create high-quality blush with gradient falloff
     for point in points:
         # Create a circular gradient mask for smooth transition
@@ -119,18 +195,12 @@ def blush_mask(src: np.ndarray, points: np.ndarray, color: list, radius: int):
         gradient[valid] = (1.0 + np.cos(np.pi * dist[valid] / radius)) / 2.0
         
         # Apply color with gradient opacity
+        region = mask[y_min - oy:y_max - oy, x_min - ox:x_max - ox]
         for c in range(3):  # For each color channel
             color_val = color[c] if c < len(color) else 0
-            mask[y_min:y_max, x_min:x_max, c] = np.maximum(
-                mask[y_min:y_max, x_min:x_max, c], 
-                (color_val * gradient).astype(np.uint8)
-            )
+            region[..., c] = np.maximum(region[..., c], (color_val * gradient).astype(np.uint8))
     
     # Apply Gaussian blur for ultra-smooth blending
-    blur_radius = int(radius * 0.4)
-    if blur_radius % 2 == 0:
-        blur_radius += 1
-    blur_radius = max(3, blur_radius)  # Ensure minimum blur size
     mask = cv2.GaussianBlur(mask, (blur_radius, blur_radius), radius // 3)
     
     # Apply vignette for natural feathering at edges
@@ -141,29 +211,59 @@ def blush_mask(src: np.ndarray, points: np.ndarray, color: list, radius: int):
         end_x = min(src.shape[1], x + 2 * radius)
         end_y = min(src.shape[0], y + 2 * radius)
         if end_y - y > 0 and end_x - x > 0:
-            region = mask[y:end_y, x:end_x]
+            region = mask[y - oy:end_y - oy, x - ox:end_x - ox]
             if region.size > 0:
                 vignetted = vignette(region, 8)
-                mask[y:end_y, x:end_x] = vignetted
+                mask[y - oy:end_y - oy, x - ox:end_x - ox] = vignetted
     
-    return mask
+    return mask, roi
 
 
-def mask_skin(src: np.ndarray):
+def skin_color_mask(src: np.ndarray) -> np.ndarray:
     """
-    Given a source image of a person (face image)
-    returns a mask that can be identified as the skin
+    Given a BGR image returns a single channel uint8 mask, 255 where the color is within the skin range
     """
     lower = np.array([0, 133, 77], dtype='uint8')  # The lower bound of skin color
     upper = np.array([255, 173, 127], dtype='uint8')  # Upper bound of skin color
     dst = cv2.cvtColor(src, cv2.COLOR_BGR2YCR_CB)  # Convert to YCR_CB
     skin_mask = cv2.inRange(dst, lower, upper)  # Get the skin
     kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5))
-    skin_mask = cv2.dilate(skin_mask, kernel, iterations=2)[..., np.newaxis]  # Dilate to fill in blobs
+    return cv2.dilate(skin_mask, kernel, iterations=2)  # Dilate to fill in blobs
+
+
+def mask_skin(src: np.ndarray):
+    """
+    Given a source image of a person (face image)
+    returns a mask that can be identified as the skin
+    Works on the whole frame and picks up anything skin-toned; prefer `face_skin_mask` when landmarks are known
+    """
+    skin_mask = skin_color_mask(src)[..., np.newaxis]
+    return (skin_mask // 255).astype("uint8")  # A binary mask containing only 1s and 0s
+
 
-    if skin_mask.ndim != 3:
-        skin_mask = np.expand_dims(skin_mask, axis=-1)
-    return (skin_mask / 255).astype("uint8")  # A binary mask containing only 1s and 0s
+def face_skin_mask(src: np.ndarray, landmarks: np.ndarray):
+    """
+    Given a source image and the packed landmark array of one face from `detect_landmarks`
+    returns the skin mask of that face along with the (rows, cols) ROI of `src` it covers.
+    Skin is what passes the color test of `mask_skin` inside the `face_conn` oval, minus the eyes and lips;
+    only the face's bounding box is converted and tested, so the cost scales with the face, not the frame.
+    The mask is ROI-sized (h, w, 1) and contains only 1s and 0s.
+    """
+    height, width = src.shape[:2]
+    oval = normalize_landmarks(landmarks, height, width, face_conn)
+    roi = padded_roi(oval, 1, height, width)
+    rows, cols = roi
+    region = np.zeros((rows.stop - rows.start, cols.stop - cols.start), dtype=np.uint8)
+    if roi_is_empty(roi):
+        return region[..., np.newaxis], roi
+
+    origin = (cols.start, rows.start)
+    cv2.fillPoly(region, [oval - origin], 1)
+    for feature in (left_eye, right_eye, upper_lip + lower_lip):
+        cv2.fillPoly(region, [normalize_landmarks(landmarks, height, width, feature) - origin], 0)
+    # 255 & 1 == 1, so the result is binary
+    cv2.bitwise_and(skin_color_mask(src[roi]), region, dst=region)
+    return region[..., np.newaxis], roi
 
 
 def face_mask(src: np.ndarray, points: np.ndarray):
@@ -208,12 +308,21 @@ def vignette(src: np.ndarray, sigma: int):
     return blurred
 
 
-def face_bbox(src: np.ndarray, offset_x: int = 0, offset_y: int = 0):
+def face_bbox(src: np.ndarray, offset_x: int = 0, offset_y: int = 0, landmarks: np.ndarray = None):
     """
     Performs face detection on a src image, return bounding box coordinates with
     an optional offset applied to the coordinates
+    When the packed landmark array from `detect_landmarks` is given the box is derived from it
+    directly and no detector is run
     """
     height, width, _ = src.shape
+    if landmarks is not None:
+        points = normalize_landmarks(landmarks, height, width, face_conn)
+        (x_min, y_min), (x_max, y_max) = points.min(axis=0), points.max(axis=0)
+        box_height, box_width = int(y_max - y_min) + offset_y, int(x_max - x_min) + offset_x
+        return (int(x_min) - offset_x, int(y_min) - offset_y), (box_height, box_width)
+    # Imported here, only this fallback needs MediaPipe's face detector
+    from mediapipe.python.solutions.face_detection import FaceDetection
     with FaceDetection(model_selection=0) as detector:  # 0 -> dist <= 2mts from the camera
         results = detector.process(cv2.cvtColor(src, cv2.COLOR_BGR2RGB))
         if not results.detections:
@@ -227,14 +336,45 @@ def face_bbox(src: np.ndarray, offset_x: int = 0, offset_y: int = 0):
     return (x_min, y_min), (box_height, box_width)
 
 
+@lru_cache(maxsize=64)
+def gamma_lut(gamma: float, coefficient: int = 1) -> np.ndarray:
+    """
+    256-entry lookup table equivalent to `gamma_correction` on uint8 input, cached per (gamma, coefficient)
+    """
+    table = np.arange(256, dtype=np.float64) / 255.
+    table = coefficient * np.power(table, gamma)
+    table = (table * 255).astype('uint8')
+    table.setflags(write=False)
+    return table
+
+
 def gamma_correction(src: np.ndarray, gamma: float, coefficient: int = 1):
     """
     Performs gamma correction on a source image
     gamma > 1 => Darker Image
     gamma < 1 => Brighted Image
+    uint8 images go through a cached lookup table instead of per-pixel float math
     """
-    dst = src.copy()
-    dst = dst / 255.  # Converted to float64
+    if src.dtype == np.uint8:
+        return cv2.LUT(src, gamma_lut(gamma, coefficient))
+    dst = src / 255.  # Converted to float64
     dst = coefficient * np.power(dst, gamma)
     dst = (dst * 255).astype('uint8')
     return dst
+
+
+@lru_cache(maxsize=64)
+def foundation_lut(intensity: float, gamma: float, warm_shift: float = 0.0) -> np.ndarray:
+    """
+    Folds a whole foundation look into a per-channel (256, 1, 3) lookup table for uint8 BGR images:
+    gamma correction, the warm shift on the red channel and the `intensity` blend with the original pixel
+    """
+    levels = np.repeat(np.arange(256, dtype=np.uint8)[:, np.newaxis, np.newaxis], 3, axis=2)
+    corrected = gamma_correction(levels, gamma, coefficient=1)
+    if warm_shift > 0:
+        corrected = corrected.astype(np.float32)
+        corrected[:, :, 2] = np.clip(corrected[:, :, 2] * (1.0 + warm_shift), 0, 255)
+        corrected = corrected.astype(np.uint8)
+    table = cv2.addWeighted(levels, 1.0 - intensity, corrected, intensity, 0)
+    table.setflags(write=False)
+    return table
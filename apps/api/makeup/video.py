@@ -0,0 +1,249 @@
+"""
+Video try-on: renders a look onto every frame of a clip.
+
+Decoding (`cv2.VideoCapture`), landmarks and rendering, and encoding (`cv2.VideoWriter`) run as a
+pipeline, each stage on its own thread and connected by bounded queues, so the three overlap and at
+most a few frames exist at any time: memory stays flat whatever the clip length. Frames are decoded
+and rendered into buffers borrowed from the buffer pool, the encoder gives them back once written.
+OpenCV releases the GIL inside decode, flow, blending and encode, which is where the time goes.
+Landmarks come from a `LandmarkTracker`: FaceMesh on keyframes, optical flow in between.
+Clips are read from and written to files, the container needs seekable output; audio is not kept.
+"""
+
+import functools
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+from typing import Optional
+
+import cv2
+
+from buffers import buffer_pool
+from metrics import Timings
+from render import MakeupConfig, render_makeup
+from tracking import KEYFRAME_INTERVAL, LandmarkTracker
+from uploads import fit_to_max_side
+
+logger = logging.getLogger(__name__)
+
+# format name -> (file extension, fourccs in order of preference, media type). Browsers only play H.264 (avc1)
+# in mp4, but OpenCV wheels ship FFmpeg without an H.264 encoder; MPEG-4 Part 2 (mp4v) is the fallback
+VIDEO_FORMATS = {
+    "mp4": (".mp4", ("avc1", "mp4v"), "video/mp4"),
+    "webm": (".webm", ("VP80",), "video/webm"),
+}
+# Frames waiting between two stages; bounds the memory of a render to a few frames
+VIDEO_QUEUE_SIZE = int(os.environ.get("MAKEUP_VIDEO_QUEUE_SIZE", 4))
+# Longest accepted clip in frames, longer ones are refused (0 disables)
+VIDEO_MAX_FRAMES = int(os.environ.get("MAKEUP_VIDEO_MAX_FRAMES", 1800))
+# Largest accepted /api/makeup/video upload in bytes, replaces MAKEUP_MAX_UPLOAD_BYTES for that endpoint
+VIDEO_MAX_UPLOAD_BYTES = int(os.environ.get("MAKEUP_VIDEO_MAX_UPLOAD_BYTES", 200 * 2 ** 20))
+# Used when the container does not tell the frame rate
+DEFAULT_FPS = 25.0
+
+# Marks the end of the frames in a stage queue
+_END = object()
+
+
+@functools.lru_cache(maxsize=None)
+def encodable(fourcc: str, extension: str) -> bool:
+    """Whether this OpenCV build can write `fourcc` video into an `extension` file, probed once per process"""
+    with tempfile.TemporaryDirectory(prefix="makeup-codec-") as directory:
+        writer = cv2.VideoWriter(os.path.join(directory, f"probe{extension}"), cv2.VideoWriter_fourcc(*fourcc),
+                                 DEFAULT_FPS, (64, 64))
+        try:
+            return writer.isOpened()
+        finally:
+            writer.release()
+
+
+def video_fourccs(video_format: str) -> list:
+    """The fourccs of `video_format` this OpenCV build can encode, in order of preference"""
+    extension, fourccs, _ = VIDEO_FORMATS[video_format]
+    available = [fourcc for fourcc in fourccs if encodable(fourcc, extension)]
+    if not available:
+        logger.warning("None of the %s codecs %s can be encoded", video_format, ", ".join(fourccs))
+    return available
+
+
+class PipelineStopped(Exception):
+    """Raised inside a stage when another stage failed and the pipeline is being torn down"""
+
+
+def _put(items: queue.Queue, item, stop: threading.Event):
+    while True:
+        if stop.is_set():
+            raise PipelineStopped()
+        try:
+            items.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def _get(items: queue.Queue, stop: threading.Event):
+    while True:
+        if stop.is_set():
+            raise PipelineStopped()
+        try:
+            return items.get(timeout=0.1)
+        except queue.Empty:
+            continue
+
+
+def probe_video(path: str) -> dict:
+    """Frame rate, size and (container-reported, possibly 0) frame count of a clip; ValueError if unreadable"""
+    capture = cv2.VideoCapture(path)
+    try:
+        if not capture.isOpened():
+            raise ValueError("Invalid video file")
+        return {
+            "fps": capture.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS,
+            "width": int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            "height": int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            "frame_count": max(0, int(capture.get(cv2.CAP_PROP_FRAME_COUNT))),
+        }
+    finally:
+        capture.release()
+
+
+def render_video(source: str, destination: str, config: MakeupConfig, video_format: str = "mp4",
+                 max_faces: int = 1, max_side: Optional[int] = None, keyframe_interval: int = KEYFRAME_INTERVAL,
+                 max_frames: int = VIDEO_MAX_FRAMES, queue_size: int = VIDEO_QUEUE_SIZE, detect=None):
+    """
+    Renders `config` onto every frame of the clip at `source` and writes the result to `destination`.
+    `max_side` downscales frames whose longest side is larger. `detect` replaces FaceMesh on keyframes,
+    see `LandmarkTracker`. Frames without a face are written unchanged.
+    Returns (summary, timings): the summary has `frames`, `face_frames`, `fps`, `width`, `height`, `codec`
+    (the fourcc written) and `detection_skipped`; the timings add up the busy time of each stage across the threads.
+    Raises ValueError for unreadable or too long clips.
+    """
+    info = probe_video(source)
+    if max_frames and info["frame_count"] > max_frames:
+        raise ValueError(f"Video has {info['frame_count']} frames, at most {max_frames} are accepted")
+    fourccs = video_fourccs(video_format)
+
+    stop = threading.Event()
+    decoded, rendered = queue.Queue(maxsize=queue_size), queue.Queue(maxsize=queue_size)
+    errors = []
+    decode_timings, encode_timings, timings = Timings(), Timings(), Timings()
+    summary = {"frames": 0, "face_frames": 0, "fps": info["fps"], "width": None, "height": None, "codec": None}
+
+    def run_stage(stage):
+        try:
+            stage()
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    def pooled_frame(shape):
+        """A frame buffer from the pool, or None to let OpenCV allocate one when the size is unknown"""
+        return buffer_pool.acquire(shape) if all(shape) else None
+
+    def release_frame(frame):
+        # Frames OpenCV allocated itself (unexpected size, downscaling) are not the pool's
+        try:
+            buffer_pool.release(frame)
+        except ValueError:
+            pass
+
+    def fit_frame(frame):
+        fitted = fit_to_max_side(frame, max_side)
+        if fitted is not frame:
+            release_frame(frame)
+        return fitted
+
+    def decode():
+        capture = cv2.VideoCapture(source)
+        try:
+            count = 0
+            while True:
+                with decode_timings.stage("decode"):
+                    buffer = pooled_frame((info["height"], info["width"], 3))
+                    ok, frame = capture.read(buffer)
+                    if frame is not buffer and buffer is not None:
+                        release_frame(buffer)
+                    if ok:
+                        frame = fit_frame(frame)
+                if not ok:
+                    break
+                count += 1
+                if max_frames and count > max_frames:
+                    raise ValueError(f"Video has more than {max_frames} frames")
+                _put(decoded, frame, stop)
+        finally:
+            capture.release()
+        _put(decoded, _END, stop)
+
+    def encode():
+        writer = None
+        try:
+            while True:
+                frame = _get(rendered, stop)
+                if frame is _END:
+                    break
+                with encode_timings.stage("encode"):
+                    if writer is None:
+                        height, width = frame.shape[:2]
+                        for fourcc in fourccs:
+                            writer = cv2.VideoWriter(destination, cv2.VideoWriter_fourcc(*fourcc), info["fps"],
+                                                     (width, height))
+                            if writer.isOpened():
+                                summary["codec"] = fourcc
+                                break
+                            writer.release()
+                        else:
+                            writer = None
+                            raise RuntimeError(f"Cannot write {video_format} video")
+                    writer.write(frame)
+                release_frame(frame)
+        finally:
+            if writer is not None:
+                writer.release()
+
+    tracker = LandmarkTracker(max_faces, keyframe_interval, detect=detect)
+    threads = [threading.Thread(target=run_stage, args=(stage,), name=f"makeup-video-{stage.__name__}", daemon=True)
+               for stage in (decode, encode)]
+    for thread in threads:
+        thread.start()
+
+    def render_frames():
+        while True:
+            frame = _get(decoded, stop)
+            if frame is _END:
+                break
+            start = time.perf_counter()
+            faces = tracker.process(frame)
+            timings.add("landmarks" if tracker.detected else "tracking", time.perf_counter() - start)
+            output = frame
+            if faces:
+                # The encoder may still hold earlier frames, so every frame gets its own buffer
+                output, _ = render_makeup(frame, config, faces, timings=timings, out=pooled_frame(frame.shape))
+                release_frame(frame)
+                summary["face_frames"] += 1
+            summary["frames"] += 1
+            summary["height"], summary["width"] = output.shape[:2]
+            _put(rendered, output, stop)
+        _put(rendered, _END, stop)
+
+    try:
+        # A failing stage sets `stop`, which unblocks and ends the other two
+        run_stage(render_frames)
+        for thread in threads:
+            thread.join()
+    finally:
+        tracker.close()
+    if errors:
+        raise errors[0]
+    if not summary["frames"]:
+        raise ValueError("Invalid video file")
+
+    summary["detection_skipped"] = round(tracker.skipped_fraction, 3)
+    timings.merge(decode_timings)
+    timings.merge(encode_timings)
+    return summary, timings
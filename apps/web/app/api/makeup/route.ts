@@ -120,6 +120,8 @@ export async function POST(request: NextRequest) {
       body: formData,
       headers: {
         // Don't set Content-Type - let fetch set it with the boundary
+        // The API answers with binary image bytes unless JSON is asked for
+        Accept: 'application/json',
       },
     });
 